@@ -3,14 +3,37 @@
 # On TOP of all of this, the user shall define FLOW.py which should
 # give him the desired trajectory operation output
 import logging
+import os
+import sys
 import warnings
 import pickle
 import random
 import datetime
 import string
-from utilFunctions import tokenize_trajectory, detokenize_trajectory
+from typing import TYPE_CHECKING
 from TrajPipeline.NewPipeline.constraintsClass import SpatialConstraints
-from TrajPipeline.NewPipeline.partioningClass import PartitioningModule, os
+from TrajPipeline.NewPipeline.modelPoolClass import ModelPool
+
+# h3, numpy and the pickled detokenization models are only imported by the
+# stages using them (see utilFunctions and partioningClass), so creating a
+# pipeline or running a stage without them stays fast
+if TYPE_CHECKING:
+    from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
+
+_TRAJECTORY_BATCH_MODULE = "TrajPipeline.NewPipeline.trajectoryBatchClass"
+
+
+def _is_trajectory_batch(obj) -> bool:
+    # A batch only exists once its module (and numpy) got imported, the check
+    # itself never imports it
+    module = sys.modules.get(_TRAJECTORY_BATCH_MODULE)
+    return module is not None and isinstance(obj, module.TrajectoryBatch)
+
+
+def _as_trajectory_batch(trajectories) -> "TrajectoryBatch":
+    from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
+
+    return TrajectoryBatch.coerce(trajectories)
 
 
 # Configure the logging
@@ -52,6 +75,7 @@ class TrajectoryPipeline:
         modify_trajectory_plugin: bool = False,
         modify_spatial_constraints: bool = False,
         use_predefined_spatial_constraints: bool = False,
+        model_pool: ModelPool | None = None,
     ):
         """
         Initializes the pipeline with needed params.
@@ -67,6 +91,9 @@ class TrajectoryPipeline:
             modify_spatial_constraints (bool): Whether to modify spatial constraints.
             use_predefined_spatial_constraints (bool): Whether to user predefined
                                                         spatial constraints or not.
+            model_pool (ModelPool, optional): A pool of loaded models shared with
+                                              other pipelines, a private one is
+                                              created otherwise.
         """
 
         self.mode = mode
@@ -81,14 +108,20 @@ class TrajectoryPipeline:
 
         # Initialize any other attributes or perform setup based on the parameters
         self.model = None
+        # In testing mode, the model serving every trajectory (routed per trajectory)
+        self.trajectory_models = None
         self.tokenizer = None
         self.spatial_constraints = None
         self.trajectory_plugin = None
         self.tokenized_trajectories = None
         self.trajectories_list = None
+        self.noise_filter_report = None
         self.input_attributes = None
         self.resolution = 10
         self.resolution_set_by_user = False
+        self.detokenization_tier = "cluster_centroid"
+        # Compression of the token codec for the store, None stores pickles
+        self.store_compression = None
         self.spatial_constraints = None
         self.user_did_define_spatial_constraints = False
         self.trajectories_got_tokenized = False
@@ -97,6 +130,11 @@ class TrajectoryPipeline:
         self.models_repository_path = os.path.join(current_directory, "modelsRepo")
         self.trajecotry_store_path = os.path.join(current_directory, "trajectoryStore")
         self.data_path_trajectory_store, self.metadata_path_trajectory_store = "", ""
+        # Inverted H3 cell index over the store, updated whenever a dataset is saved
+        self.cell_index = None
+        # Loaded models stay resident across runs of this pipeline (and of the
+        # pipelines sharing the pool)
+        self.model_pool = model_pool if model_pool is not None else ModelPool()
         logging.info("Initializing the pipeline with mode: %s", self.mode)
 
         if self.use_detokenization:
@@ -154,9 +192,11 @@ class TrajectoryPipeline:
             self.tokenized_trajectories = self.__tokenization_module(
                 self.trajectories_list
             )
+            self.trajectories_got_tokenized = True
         else:
             pass
             # @Youssef DO: I need to get the attributes here
+        self.__partioning_module_interface()
 
     def __save_trajectories_to_store(self, dataset):
         if self.use_tokenization and dataset is not None:
@@ -165,18 +205,34 @@ class TrajectoryPipeline:
             dataset_name = "".join(
                 random.choices(string.ascii_lowercase + string.digits, k=10)
             )
-            dataset_filename = os.path.join(
-                self.trajecotry_store_path, f"{dataset_name}.pkl"
-            )
-
-            # Save the tokenized trajectories to a .pkl file
-            with open(dataset_filename, "wb") as f:
-                pickle.dump(dataset, f)
+            if self.store_compression is not None:
+                from TrajPipeline.NewPipeline.tokenCodecClass import TokenStreamCodec
+
+                # Only the tokens are kept, delta + varint encoded
+                dataset_filename = os.path.join(
+                    self.trajecotry_store_path, f"{dataset_name}.h3z"
+                )
+                size = TokenStreamCodec(self.store_compression).write(
+                    dataset_filename, dataset
+                )
+                logging.info(f"Token stream encoded in {size} bytes.")
+            else:
+                dataset_filename = os.path.join(
+                    self.trajecotry_store_path, f"{dataset_name}.pkl"
+                )
+
+                # Save the tokenized trajectories to a .pkl file
+                with open(dataset_filename, "wb") as f:
+                    pickle.dump(dataset, f)
 
             # Create metadata
             metadata = {
                 "total_number_of_trajectories": len(dataset),
-                "total_number_of_tokens": sum(len(traj) for traj in dataset),
+                "total_number_of_tokens": (
+                    dataset.num_points
+                    if _is_trajectory_batch(dataset)
+                    else sum(len(traj) for traj in dataset)
+                ),
                 "date_of_data_storage": datetime.datetime.now().strftime(
                     "%Y-%m-%d %H:%M"
                 ),
@@ -194,9 +250,58 @@ class TrajectoryPipeline:
             logging.info(
                 f"Tokenized trajectories saved to {dataset_filename} with metadata."
             )
+            postings = self.get_cell_index().add_dataset(
+                dataset_name, dataset_filename, dataset
+            )
+            logging.info(f"Cell index updated with {postings} postings.")
             self.data_saved_to_trajectory_store = True
             return dataset_filename, metadata_filename
 
+    def get_cell_index(self):
+        """
+        Returns the inverted H3 cell index of the trajectory store, used to find
+        the stored trajectories passing through a cell, k-ring, polygon or
+        pyramid cell without unpickling the datasets.
+        """
+        if self.cell_index is None:
+            from TrajPipeline.NewPipeline.cellIndexClass import CellIndex
+
+            self.cell_index = CellIndex(
+                os.path.join(self.trajecotry_store_path, "cellIndex")
+            )
+        return self.cell_index
+
+    def rebuild_cluster_models(self, max_workers: int = 4):
+        """
+        Builds the detokenization centroids and bearing clusters from the
+        trajectory store and makes the detokenizer use them. Only the datasets
+        stored since the last build are read and only the cells they touch are
+        refitted.
+
+        Args:
+            max_workers (int): Number of processes fitting the cell clusters.
+
+        Returns:
+            ClusterModelBuilder: The builder holding the artifacts.
+        """
+        from TrajPipeline.NewPipeline.clusterBuilderClass import ClusterModelBuilder
+        from utilFunctions import get_detokenizer, load_tokenized_trajectories
+
+        builder = ClusterModelBuilder(
+            os.path.join(self.trajecotry_store_path, "clusterModels")
+        )
+        added = builder.add_store(
+            self.trajecotry_store_path, load_tokenized_trajectories
+        )
+        refitted = builder.fit(max_workers)
+        builder.save()
+        logging.info(
+            f"Cluster models rebuilt from {len(added)} new datasets, "
+            f"{refitted} cells refitted."
+        )
+        builder.install(get_detokenizer())
+        return builder
+
     def set_tokenization_resolution(self, resolution: int = 10):
         """
         Sets the resolution to be used if tokenization is enabled.
@@ -212,20 +317,81 @@ class TrajectoryPipeline:
         self.resolution = resolution
         self.resolution_set_by_user = True
 
-    def set_trajectories(self, trajectories: list[list[tuple[float, float]]]):
+    def set_detokenization_tier(self, tier: str = "cluster_centroid"):
+        """
+        Sets the strategy turning tokens back into points if de-tokenization is enabled.
+
+        Args:
+            tier (str): One of 'h3_centroid' (fastest), 'data_centroid',
+                        'cluster_centroid' (most precise, the default) and 'hybrid'
+                        (cluster models only where they move the points).
+
+        Returns:
+            None
         """
-        Sets the list of trajectories to be used if tokenization is enabled.
+        from utilFunctions import DETOKENIZATION_TIERS
+
+        if not self.use_detokenization:
+            raise ValueError("De-tokenization is not used. No need to set a tier.")
+        if tier not in DETOKENIZATION_TIERS:
+            raise ValueError(
+                f"Unknown detokenization tier {tier!r}, "
+                f"expected one of {', '.join(DETOKENIZATION_TIERS)}"
+            )
+        self.detokenization_tier = tier
+
+    def set_store_compression(self, compression: str | None = "zlib"):
+        """
+        Stores the tokenized datasets with the token codec instead of pickles.
+        The codec keeps the tokens only (the original coordinates are dropped),
+        which the models and the cell index need, at a fraction of the size.
 
         Args:
-            trajectories (list of list of tuples): List of trajectories, where each
-                                trajectory is a list of (latitude, longitude) tuples.
+            compression (str or None): 'none', 'zlib' or 'lzma' on top of the
+                                       delta + varint encoding, None for pickles.
+
+        Returns:
+            None
+        """
+        from TrajPipeline.NewPipeline.tokenCodecClass import COMPRESSIONS
+
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown token stream compression: {compression}")
+        self.store_compression = compression
+
+    def set_trajectories(
+        self,
+        trajectories: "TrajectoryBatch | list[list[tuple[float, float]]]",
+        noise_filter=None,
+    ):
+        """
+        Sets the trajectories to be used if tokenization is enabled.
+
+        Args:
+            trajectories (TrajectoryBatch or list of list of tuples): A batch, or a list
+                                of trajectories where each trajectory is a list of
+                                (latitude, longitude) tuples, stored as a batch.
+            noise_filter (NoiseFilter, optional): Drops the speed outliers, stationary
+                                points and too close points of the trajectories
+                                first, its report is kept in noise_filter_report.
 
         Returns:
             None
         """
         if not self.use_tokenization:
             raise ValueError("Tokenization is not used. No need to set trajectories.")
-        self.trajectories_list = trajectories
+        self.trajectories_list = _as_trajectory_batch(trajectories)
+        self.noise_filter_report = None
+        if noise_filter is not None:
+            self.trajectories_list, self.noise_filter_report = (
+                noise_filter.filter_batch(self.trajectories_list)
+            )
+            report = self.noise_filter_report
+            logging.info(
+                f"Noise filter dropped {report['points_in'] - report['points_out']} "
+                f"of {report['points_in']} points "
+                f"(estimated speedup x{report['estimated_speedup']:.2f})."
+            )
         logging.info("Trajectories set for tokenization.")
 
     def __setup_detokenization(self):
@@ -312,24 +478,30 @@ class TrajectoryPipeline:
         # Implementation for modifying trajectory plugin
 
     def __tokenization_module(
-        self, trajectories: list[list[tuple[float, float]]]
-    ) -> list[list[str]]:
+        self, trajectories: "TrajectoryBatch | list[list[tuple[float, float]]]"
+    ) -> "TrajectoryBatch | list[list[str]]":
         """
-        Tokenizes a list of trajectories.
+        Tokenizes a batch or a list of trajectories.
 
         Args:
-            trajectories (list of list of tuple[float, float]]): A list of trajectories,
-                                                    where each trajectory is a list of
-            (latitude, longitude) tuples.
+            trajectories (TrajectoryBatch or list of list of tuple[float, float]]): A batch,
+                                                    or a list of trajectories where each
+            trajectory is a list of (latitude, longitude) tuples.
 
         Returns:
-            list of list of str: A list of tokenized trajectories, where
+            TrajectoryBatch or list of list of str: The batch with its token column filled,
+                                    or for a list a list of tokenized trajectories, where
                                     each trajectory is a list of tokens.
         """
 
         if not self.resolution_set_by_user:
-            info = "Tokenization Resolution Set By Default to: " + self.resolution
+            info = "Tokenization Resolution Set By Default to: " + str(self.resolution)
             logging.info(info)
+        if _is_trajectory_batch(trajectories):
+            return trajectories.tokenize(self.resolution)
+
+        from utilFunctions import tokenize_trajectory
+
         tokenized_trajectories = [
             tokenize_trajectory(trajectory, self.resolution)
             for trajectory in trajectories
@@ -337,23 +509,32 @@ class TrajectoryPipeline:
         return tokenized_trajectories
 
     def __detokenization_module(
-        self, tokenized_trajectories: list[list[str]]
-    ) -> list[list[tuple[float, float]]]:
+        self, tokenized_trajectories: "TrajectoryBatch | list[list[str]]"
+    ) -> "TrajectoryBatch | list[list[tuple[float, float]]]":
         """
-        Detokenizes a list of tokenized trajectories.
+        Detokenizes a tokenized batch or a list of tokenized trajectories.
 
         Args:
-            tokenized_trajectories (list of list of str): A list of tokenized
-                        trajectories, where each trajectory is a list of tokens.
+            tokenized_trajectories (TrajectoryBatch or list of list of str): A tokenized
+                        batch, or a list of tokenized trajectories where each
+                        trajectory is a list of tokens.
 
         Returns:
-            list of list of tuple[float, float]]: A list of detokenized trajectories,
-                            where each trajectory is a list of
+            TrajectoryBatch or list of list of tuple[float, float]]: The batch with the
+                            detokenized points, or for a list a list of detokenized
+                            trajectories, where each trajectory is a list of
             (latitude, longitude) tuples.
         """
 
+        if _is_trajectory_batch(tokenized_trajectories):
+            from utilFunctions import detokenize_batch
+
+            return detokenize_batch(tokenized_trajectories, self.detokenization_tier)
+
+        from utilFunctions import detokenize_trajectory
+
         detokenized_trajectories = [
-            detokenize_trajectory(tokenized_trajectory)
+            detokenize_trajectory(tokenized_trajectory, self.detokenization_tier)
             for tokenized_trajectory in tokenized_trajectories
         ]
         return detokenized_trajectories
@@ -364,7 +545,11 @@ class TrajectoryPipeline:
         The user doesn't have access to this function
         """
 
-        module = PartitioningModule(models_repo_path=self.models_repository_path)
+        from TrajPipeline.NewPipeline.partioningClass import PartitioningModule
+
+        module = PartitioningModule(
+            models_repo_path=self.models_repository_path, model_pool=self.model_pool
+        )
         if (
             self.mode == "training"
             and self.trajectories_got_tokenized
@@ -374,13 +559,31 @@ class TrajectoryPipeline:
             module.update_repository(
                 self.data_path_trajectory_store, self.metadata_path_trajectory_store
             )
+            # The update invalidated the models of the updated cells, the hot
+            # ones are reloaded before the next requests need them
+            preloaded = self.model_pool.preload_hot_cells()
+            if preloaded:
+                logging.info(f"Preloaded {preloaded} hot cell models.")
 
         elif self.mode == "testing" and self.trajectories_got_tokenized:
-            logging.info("Fetching proper model from the models repo")
-            model_path = module.find_proper_model(self.tokenized_trajectories)
-            # @Youssef DO: I need a way to load the model after getting its path, TensorFlow
-            logging.info("Found proper model in the repo")
-            print(model_path)
+            from TrajPipeline.NewPipeline.routerClass import BatchRouter
+
+            logging.info("Routing the trajectories to their models in the repo")
+            # Every trajectory goes to its smallest enclosing occupied cell, the
+            # model of each routed cell is loaded once for its whole group
+            cells = []
+
+            def assign(model, batch):
+                cells.append(model)
+                return [model] * len(batch)
+
+            self.trajectory_models = BatchRouter(module).dispatch(
+                _as_trajectory_batch(self.tokenized_trajectories), assign
+            )
+            # A batch served by a single cell keeps the single model interface
+            self.model = cells[0] if len(cells) == 1 else None
+            logging.info(f"Routed the trajectories to {len(cells)} cell models")
+            logging.info("Model pool metrics: %s", self.model_pool.metrics())
         else:  # i.e. user entered other attributes
             # @Youssef DO: I need to think about this case
             pass
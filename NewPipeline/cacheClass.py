@@ -0,0 +1,278 @@
+"""Result Cache Module Definition"""
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# The cache the legacy pipeline serves testing outputs from. Model updates of the
+# NewPipeline invalidate this same directory, so they reach the served results.
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "Pipeline",
+    "ModelsRepo",
+    "resultCache",
+)
+
+
+def hash_tokenized_input(tokenized_trajectories) -> str:
+    """
+    Hashes the tokenized input of a request.
+
+    Args:
+        tokenized_trajectories (list of str): The tokenized lines sent to the model.
+
+    Returns:
+        str: The sha256 hex digest of the lines.
+    """
+    digest = hashlib.sha256()
+    for line in tokenized_trajectories or []:
+        digest.update(line.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    A persistent, size-bounded LRU cache for model outputs.
+
+    Entries are keyed by (model path, model version, mode, tokenized input hash,
+    generation params) and stored as one file per entry in `cache_dir`, next to an
+    `index.json` that keeps the LRU order and a `versions.json` with the current
+    version of every model path. Updating the model of a pyramid cell calls
+    `invalidate_model`, which bumps the version and drops its entries, so stale
+    outputs can never be served.
+
+    Several instances (threads or processes) may share a cache directory: every
+    write reloads the index and the versions under a file lock and writes them
+    back before releasing it, so no instance overwrites the puts or the version
+    bumps of another one with its stale in-memory state. Lookups take no file
+    lock: a hit reads the entry file and only records its recency in memory,
+    which is written to the index with the next write or `flush`. The directory
+    itself is only created by the first put or invalidation.
+
+    Attributes:
+        cache_dir (str): The directory holding the cached outputs.
+        max_entries (int): Maximum number of entries kept.
+        max_bytes (int): Maximum total size of the cached outputs.
+        hits (int): Number of lookups served from the cache.
+        misses (int): Number of lookups that had to run the model.
+    """
+
+    def __init__(self, cache_dir, max_entries=1024, max_bytes=512 * 1024 * 1024):
+        """
+        Initializes the cache and loads its index from disk if present.
+
+        Args:
+            cache_dir (str): The directory holding the cached outputs.
+            max_entries (int): Maximum number of entries kept.
+            max_bytes (int): Maximum total size of the cached outputs in bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.versions_path = os.path.join(cache_dir, "versions.json")
+        self.lock_path = os.path.join(cache_dir, "cache.lock")
+        self.entries = OrderedDict()
+        self.versions = {}
+        self.hits, self.misses = 0, 0
+        # Keys hit since the index was last written, in the order of their hits
+        self.recent_hits = OrderedDict()
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """
+        Loads the LRU index and the model versions from the cache directory.
+
+        The hits recorded in memory since the last write are applied on top of
+        the loaded LRU order.
+        """
+        self.entries, self.versions = OrderedDict(), self._load_versions()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file:
+                self.entries = OrderedDict(json.load(file))
+        for key in self.recent_hits:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+
+    def _load_versions(self):
+        # versions.json is replaced atomically, it can be read without the lock
+        if not os.path.exists(self.versions_path):
+            return {}
+        with open(self.versions_path, "r") as file:
+            return json.load(file)
+
+    @staticmethod
+    def _model_key(model_path):
+        # The same model may be referred to by relative and absolute paths
+        return os.path.abspath(str(model_path))
+
+    @contextmanager
+    def _locked(self):
+        # Serializes the threads of this instance and the other instances on the
+        # directory, and reloads the state they may have changed
+        with self._lock:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self.load()
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _dump(self, path, data):
+        # Write to a temporary file first so a crash never leaves a torn index
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+
+    def _save(self):
+        self._dump(self.index_path, list(self.entries.items()))
+        self._dump(self.versions_path, self.versions)
+        self.recent_hits.clear()
+
+    def model_version(self, model_path) -> int:
+        """Returns the current version of the model stored at model_path."""
+        return self._load_versions().get(self._model_key(model_path), 0)
+
+    def make_key(self, model_path, mode, tokenized_trajectories, params=None) -> str:
+        """
+        Builds the cache key of a request.
+
+        Args:
+            model_path (str): The path of the model (pyramid cell) serving the request.
+            mode (str): The pipeline mode, e.g. 'summarization_testing'.
+            tokenized_trajectories (list of str): The tokenized input, may be empty.
+            params (dict, optional): Generation params such as count, length and seed.
+
+        Returns:
+            str: The hex digest identifying the request.
+        """
+        model_path = self._model_key(model_path)
+        key_fields = [
+            model_path,
+            self.model_version(model_path),
+            mode,
+            hash_tokenized_input(tokenized_trajectories),
+            params or {},
+        ]
+        payload = json.dumps(key_fields, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.txt")
+
+    def get(self, key):
+        """
+        Returns the cached output for key, or None on a miss.
+        """
+        # Entry files are replaced atomically and only removed under the lock,
+        # an entry evicted meanwhile by another instance is a miss
+        try:
+            with open(self._entry_path(key), "r") as file:
+                content = file.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self.recent_hits[key] = None
+            self.recent_hits.move_to_end(key)
+            if key in self.entries:
+                self.entries.move_to_end(key)
+        return content
+
+    def flush(self):
+        """Writes the recency of the hits recorded in memory to the index."""
+        with self._lock:
+            if not self.recent_hits or not os.path.isdir(self.cache_dir):
+                return
+            with self._locked():
+                self._save()
+
+    def put(self, key, content: str, model_path):
+        """
+        Stores the output of a request and evicts the least recently used entries.
+
+        Args:
+            key (str): The key built by make_key.
+            content (str): The raw model output.
+            model_path (str): The model that produced the output, used for invalidation.
+        """
+        with self._locked():
+            entry_path = self._entry_path(key)
+            tmp_path = f"{entry_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file:
+                file.write(content)
+            os.replace(tmp_path, entry_path)
+            self.entries[key] = {
+                "model_path": self._model_key(model_path),
+                "size": len(content.encode("utf-8")),
+            }
+            self.entries.move_to_end(key)
+            self._evict()
+            self._save()
+
+    def _evict(self):
+        total_bytes = sum(entry["size"] for entry in self.entries.values())
+        while self.entries and (
+            len(self.entries) > self.max_entries or total_bytes > self.max_bytes
+        ):
+            key, entry = self.entries.popitem(last=False)
+            total_bytes -= entry["size"]
+            self._remove_file(key)
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def invalidate_model(self, model_path):
+        """
+        Bumps the version of a model and drops every entry it produced.
+
+        Args:
+            model_path (str): The path of the model (pyramid cell) that was updated.
+        """
+        model_path = self._model_key(model_path)
+        with self._locked():
+            self.versions[model_path] = self.versions.get(model_path, 0) + 1
+            stale_keys = [
+                key
+                for key, entry in self.entries.items()
+                if entry["model_path"] == model_path
+            ]
+            for key in stale_keys:
+                del self.entries[key]
+                self._remove_file(key)
+            self._save()
+
+    def clear(self):
+        """Removes every cached output, the model versions are kept."""
+        if not os.path.isdir(self.cache_dir):
+            return
+        with self._locked():
+            for key in list(self.entries):
+                self._remove_file(key)
+            self.entries.clear()
+            self._save()
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and the current size of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": sum(entry["size"] for entry in self.entries.values()),
+        }
@@ -0,0 +1,350 @@
+"""Cell Index Module Definition"""
+
+import fcntl
+import json
+import os
+import shutil
+import threading
+import uuid
+from contextlib import contextmanager
+
+import h3
+import numpy as np
+
+from TrajPipeline.NewPipeline.trajectoryBatchClass import (
+    TrajectoryBatch,
+    ints_to_tokens,
+    tokens_to_ints,
+)
+
+
+class CellIndex:
+    """
+    An inverted index over the trajectory store: H3 cell -> the trajectories
+    (dataset id, trajectory position) passing through it.
+
+    Every dataset gets its own segment, written once when the dataset is saved:
+    a sorted uint64 array of cells and the aligned int32 array of trajectory
+    positions, stored as .npy files and memory mapped on load. Besides the cells
+    of the tokens themselves, each trajectory is also posted under the parents
+    of its cells at the rollup resolutions, so a query for a coarse cell is a
+    single lookup. A lookup is a binary search per segment, then a slice of the
+    posting list, so queries cost time proportional to the result size.
+
+    Several instances (threads or processes) may share an index directory:
+    index.json is only rewritten under a file lock, after merging the entries
+    written by the others, and every version of a segment gets a directory of
+    its own, so memory mapped segments are never overwritten.
+
+    Attributes:
+        index_dir (str): The directory holding index.json and the segments.
+        rollup_resolutions (tuple of int): The coarser resolutions that get postings.
+        segments (dict): dataset id -> segment info (resolution, cells, trajectories).
+    """
+
+    def __init__(self, index_dir, rollup_resolutions=(3, 5, 7)):
+        """
+        Initializes the index and loads the segments found on disk.
+
+        Args:
+            index_dir (str): The directory holding the index.
+            rollup_resolutions (tuple of int): The resolutions of the parent cells
+                                               trajectories are also posted under.
+        """
+        self.index_dir = index_dir
+        self.rollup_resolutions = tuple(sorted(rollup_resolutions))
+        self.index_path = os.path.join(index_dir, "index.json")
+        self.lock_path = os.path.join(index_dir, "index.lock")
+        self.segments = {}
+        self._lock = threading.RLock()
+        self._index_stamp = None
+        os.makedirs(index_dir, exist_ok=True)
+        self.load()
+
+    def _stamp(self):
+        if not os.path.exists(self.index_path):
+            return None
+        stat = os.stat(self.index_path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def load(self):
+        """
+        Loads the segment list from index.json and memory maps the segments,
+        the segments already mapped are kept.
+        """
+        with self._lock:
+            stamp = self._stamp()
+            if stamp is None:
+                self.segments = {}
+                self._index_stamp = None
+                return
+            with open(self.index_path, "r") as file:
+                entries = json.load(file)
+            segments = {}
+            for dataset_id, entry in entries.items():
+                current = self.segments.get(dataset_id)
+                if current is not None and current["segment"] == entry["segment"]:
+                    segments[dataset_id] = current
+                    continue
+                segment_dir = os.path.join(self.index_dir, entry["segment"])
+                segments[dataset_id] = {
+                    **entry,
+                    "cells": np.load(
+                        os.path.join(segment_dir, "cells.npy"), mmap_mode="r"
+                    ),
+                    "trajectories": np.load(
+                        os.path.join(segment_dir, "trajectories.npy"), mmap_mode="r"
+                    ),
+                }
+            self.segments = segments
+            self._index_stamp = stamp
+
+    def refresh(self):
+        """Catches up with the segments written by other instances."""
+        if self._stamp() != self._index_stamp:
+            self.load()
+
+    @contextmanager
+    def _locked(self):
+        # Holds the index for this thread and other processes, on up to date entries
+        with self._lock:
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    self.load()
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _remove_segment(self, segment):
+        shutil.rmtree(os.path.join(self.index_dir, segment), ignore_errors=True)
+
+    def _save_entries(self):
+        entries = {
+            dataset_id: {
+                key: value
+                for key, value in segment.items()
+                if key not in ("cells", "trajectories")
+            }
+            for dataset_id, segment in self.segments.items()
+        }
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(entries, file, indent=4)
+        os.replace(tmp_path, self.index_path)
+        self._index_stamp = self._stamp()
+
+    def add_dataset(self, dataset_id, dataset_path, trajectories):
+        """
+        Indexes a tokenized dataset, replacing its previous segment if any.
+
+        Args:
+            dataset_id (str): The id of the dataset in the store.
+            dataset_path (str): The path of the dataset file.
+            trajectories (TrajectoryBatch or list of list of str): The tokenized trajectories.
+
+        Returns:
+            int: The number of postings of the new segment.
+        """
+        batch = TrajectoryBatch.coerce(trajectories)
+        if batch.tokens is None:
+            raise ValueError("Only tokenized datasets can be indexed")
+        owners = np.repeat(np.arange(len(batch), dtype=np.int32), batch.lengths())
+        # One posting per distinct (cell, trajectory) pair
+        pairs = np.unique(
+            np.stack((batch.tokens, owners.astype(np.uint64)), axis=1), axis=0
+        )
+        cells, postings = [pairs[:, 0]], [pairs[:, 1].astype(np.int32)]
+        resolution = None
+        if len(pairs):
+            unique_cells, inverse = np.unique(pairs[:, 0], return_inverse=True)
+            tokens = ints_to_tokens(unique_cells)
+            resolution = h3.h3_get_resolution(tokens[0])
+            for rollup in self.rollup_resolutions:
+                if rollup >= resolution:
+                    continue
+                parents = tokens_to_ints(h3.h3_to_parent(t, rollup) for t in tokens)
+                rolled = np.unique(
+                    np.stack((parents[inverse], pairs[:, 1]), axis=1), axis=0
+                )
+                cells.append(rolled[:, 0])
+                postings.append(rolled[:, 1].astype(np.int32))
+        cells = np.concatenate(cells)
+        postings = np.concatenate(postings)
+        order = np.argsort(cells, kind="stable")
+        cells, postings = cells[order], postings[order]
+
+        # A new directory per version, readers may still map the previous one
+        segment = f"segment_{dataset_id}_{uuid.uuid4().hex[:8]}"
+        segment_dir = os.path.join(self.index_dir, segment)
+        os.makedirs(segment_dir, exist_ok=True)
+        np.save(os.path.join(segment_dir, "cells.npy"), cells)
+        np.save(os.path.join(segment_dir, "trajectories.npy"), postings)
+        with self._locked():
+            previous = self.segments.get(str(dataset_id))
+            self.segments[str(dataset_id)] = {
+                "segment": segment,
+                "dataset_path": dataset_path,
+                "resolution": resolution,
+                "num_trajectories": len(batch),
+                "cells": cells,
+                "trajectories": postings,
+            }
+            self._save_entries()
+        if previous is not None:
+            self._remove_segment(previous["segment"])
+        return len(cells)
+
+    def remove_dataset(self, dataset_id):
+        with self._locked():
+            previous = self.segments.pop(str(dataset_id), None)
+            if previous is not None:
+                self._save_entries()
+        if previous is not None:
+            self._remove_segment(previous["segment"])
+
+    def _indexed_resolutions(self, segment):
+        if segment["resolution"] is None:
+            return ()
+        return tuple(
+            r for r in self.rollup_resolutions if r < segment["resolution"]
+        ) + (segment["resolution"],)
+
+    def _lookup_cells(self, cells, cell_resolutions, resolutions):
+        # Rewrites the query cells to the indexed resolutions of a segment:
+        # finer cells become their parent at the base resolution, coarser cells
+        # the nearest indexed resolution below them
+        lookup = set()
+        for cell, r in zip(cells, cell_resolutions):
+            if r in resolutions:
+                lookup.add(cell)
+            elif r > resolutions[-1]:
+                lookup.add(h3.h3_to_parent(cell, resolutions[-1]))
+            else:
+                finer = min(res for res in resolutions if res > r)
+                lookup.update(h3.h3_to_children(cell, finer))
+        return tokens_to_ints(sorted(lookup))
+
+    def query_cells(self, cells) -> dict:
+        """
+        Finds the trajectories passing through any of the given cells.
+
+        Args:
+            cells (iterable of str): H3 cells of any resolution.
+
+        Returns:
+            dict: dataset id -> sorted int array of trajectory positions, only
+                  datasets with at least one match are listed.
+        """
+        self.refresh()
+        cells = list(cells)
+        cell_resolutions = [h3.h3_get_resolution(cell) for cell in cells]
+        # Segments of the same resolution share the rewritten query cells
+        lookups = {}
+        results = {}
+        for dataset_id, segment in self.segments.items():
+            resolutions = self._indexed_resolutions(segment)
+            if not resolutions:
+                continue
+            if resolutions not in lookups:
+                lookups[resolutions] = self._lookup_cells(
+                    cells, cell_resolutions, resolutions
+                )
+            lookup = lookups[resolutions]
+            if (
+                not len(lookup)
+                or not len(segment["cells"])
+                or lookup[-1] < segment["cells"][0]
+                or lookup[0] > segment["cells"][-1]
+            ):
+                continue
+            starts = np.searchsorted(segment["cells"], lookup, side="left")
+            ends = np.searchsorted(segment["cells"], lookup, side="right")
+            hits = [
+                segment["trajectories"][start:end]
+                for start, end in zip(starts.tolist(), ends.tolist())
+                if end > start
+            ]
+            if hits:
+                results[dataset_id] = np.unique(np.concatenate(hits))
+        return results
+
+    def query_k_ring(self, cell, k=1) -> dict:
+        """Finds the trajectories passing within k cells of the given cell."""
+        return self.query_cells(h3.k_ring(cell, k))
+
+    def query_polygon(self, polygon, resolution=None) -> dict:
+        """
+        Finds the trajectories passing through a polygon, at the granularity of
+        the cells whose centers lie inside it.
+
+        Args:
+            polygon (list of tuples): The (lat, lon) vertices of the polygon.
+            resolution (int, optional): The resolution the polygon is filled at,
+                                        the finest indexed resolution by default.
+
+        Returns:
+            dict: dataset id -> sorted int array of trajectory positions.
+        """
+        if resolution is None:
+            self.refresh()
+            resolutions = [
+                s["resolution"]
+                for s in self.segments.values()
+                if s["resolution"] is not None
+            ]
+            if not resolutions:
+                return {}
+            resolution = max(resolutions)
+        geometry = {"type": "Polygon", "coordinates": [list(polygon)]}
+        cells = h3.polyfill(geometry, resolution)
+        # Compacting replaces full groups of children by their parent, which
+        # the rollup postings answer in one lookup
+        return self.query_cells(h3.compact(cells))
+
+    def query_bounds(self, bounds, resolution=None) -> dict:
+        """
+        Finds the trajectories passing through a (min_lat, max_lat, min_lon, max_lon) box.
+        """
+        lat_min, lat_max, lon_min, lon_max = bounds
+        polygon = [
+            (lat_min, lon_min),
+            (lat_min, lon_max),
+            (lat_max, lon_max),
+            (lat_max, lon_min),
+        ]
+        return self.query_polygon(polygon, resolution)
+
+    def query_pyramid_cell(self, partitioning_module, h, index, resolution=None):
+        """Finds the trajectories passing through a cell of the models pyramid."""
+        return self.query_bounds(
+            partitioning_module._calculate_bounds(h, index), resolution
+        )
+
+    def load_trajectories(self, results, loader) -> dict:
+        """
+        Loads the matching trajectories, opening only the datasets with matches.
+
+        Args:
+            results (dict): A query result, dataset id -> trajectory positions.
+            loader (callable): Function taking a dataset path and returning its
+                               trajectories, e.g. load_tokenized_trajectories.
+
+        Returns:
+            dict: dataset id -> TrajectoryBatch (or list) of the matching trajectories.
+        """
+        loaded = {}
+        for dataset_id, positions in results.items():
+            dataset = loader(self.segments[dataset_id]["dataset_path"])
+            if isinstance(dataset, TrajectoryBatch):
+                loaded[dataset_id] = dataset.take(positions)
+            else:
+                loaded[dataset_id] = [dataset[i] for i in positions.tolist()]
+        return loaded
+
+    def stats(self) -> dict:
+        return {
+            "datasets": len(self.segments),
+            "postings": sum(len(s["cells"]) for s in self.segments.values()),
+            "trajectories": sum(s["num_trajectories"] for s in self.segments.values()),
+        }
@@ -0,0 +1,388 @@
+"""Cluster Model Builder Module Definition"""
+
+import json
+import logging
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from TrajPipeline.NewPipeline.trajectoryBatchClass import (
+    TrajectoryBatch,
+    ints_to_tokens,
+)
+
+
+def incoming_bearings(batch: TrajectoryBatch) -> np.ndarray:
+    """
+    Computes the bearing in degrees from the previous point of every point of a
+    batch, NaN for the first point of each trajectory and for repeated points.
+    """
+    bearings = np.full(batch.num_points, np.nan)
+    if batch.num_points < 2:
+        return bearings
+    lat1, lat2 = np.radians(batch.lat[:-1]), np.radians(batch.lat[1:])
+    diff_lon = np.radians(batch.lon[1:] - batch.lon[:-1])
+    x = np.sin(diff_lon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(diff_lon)
+    bearings[1:] = (np.degrees(np.arctan2(x, y)) + 360) % 360
+    bearings[1:][(x == 0) & (y == 0)] = np.nan
+    # The first point of a trajectory has no incoming bearing
+    bearings[batch.offsets[:-1][batch.lengths() > 0]] = np.nan
+    return bearings
+
+
+def _group(cells, bins, counts, sums):
+    # Sums the rows sharing a (cell, bin) key, the result is sorted by cell then bin
+    if not len(cells):
+        return cells, bins, counts, sums
+    order = np.lexsort((bins, cells))
+    cells, bins, counts, sums = cells[order], bins[order], counts[order], sums[order]
+    starts = np.flatnonzero(
+        np.r_[True, (cells[1:] != cells[:-1]) | (bins[1:] != bins[:-1])]
+    )
+    return (
+        cells[starts],
+        bins[starts],
+        np.add.reduceat(counts, starts),
+        np.add.reduceat(sums, starts, axis=0),
+    )
+
+
+def _cell_starts(cells):
+    return np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+
+
+class BearingClusterModel:
+    """
+    Clusters of the incoming bearings of an H3 cell. Like the k-means models
+    it replaces, predict takes the angles as a (-1, 1) array and returns the
+    index of the nearest cluster, the distance being measured around the circle.
+
+    Attributes:
+        cluster_centers_ (np.ndarray): The (k, 1) bearings of the cluster centers.
+    """
+
+    def __init__(self, centers):
+        self.cluster_centers_ = np.asarray(centers, dtype=np.float64).reshape(-1, 1)
+
+    def predict(self, angles) -> np.ndarray:
+        angles = np.asarray(angles, dtype=np.float64).reshape(-1, 1)
+        distances = np.abs((angles - self.cluster_centers_.T + 180) % 360 - 180)
+        return distances.argmin(axis=1)
+
+
+def fit_bearing_clusters(bearings, weights, sums, max_clusters, iterations=20):
+    """
+    Weighted k-means on the circle over the bearing bins of a cell.
+
+    Args:
+        bearings (np.ndarray): The bearing of every non-empty bin.
+        weights (np.ndarray): The number of points of every bin.
+        sums (np.ndarray): The (lat, lon) sums of the points of every bin.
+        max_clusters (int): The maximum number of clusters.
+        iterations (int): Number of assignment/update rounds.
+
+    Returns:
+        tuple: (BearingClusterModel, means) where row i of means is the
+               (x, y, count) of cluster i, x and y being the mean longitude and
+               latitude of its points.
+    """
+
+    def distance(a, b):
+        return np.abs((a[:, None] - b[None, :] + 180) % 360 - 180)
+
+    k = min(max_clusters, len(bearings))
+    # Farthest point initialisation, starting from the heaviest bin
+    centers = [bearings[weights.argmax()]]
+    while len(centers) < k:
+        gaps = distance(bearings, np.array(centers)).min(axis=1) * weights
+        if not gaps.any():
+            break
+        centers.append(bearings[gaps.argmax()])
+    centers = np.array(centers)
+    angles = np.radians(bearings)
+    for _ in range(iterations):
+        labels = distance(bearings, centers).argmin(axis=1)
+        sin = np.bincount(labels, weights * np.sin(angles), len(centers))
+        cos = np.bincount(labels, weights * np.cos(angles), len(centers))
+        updated = (np.degrees(np.arctan2(sin, cos)) + 360) % 360
+        if np.allclose(updated, centers):
+            break
+        centers = updated
+    labels = distance(bearings, centers).argmin(axis=1)
+    counts = np.bincount(labels, weights, len(centers))
+    used = counts > 0
+    lat = np.bincount(labels, sums[:, 0], len(centers))[used] / counts[used]
+    lon = np.bincount(labels, sums[:, 1], len(centers))[used] / counts[used]
+    means = np.stack((lon, lat, counts[used]), axis=1)
+    return BearingClusterModel(centers[used]), means
+
+
+def _fit_cells(cells, bins, counts, sums, num_bins, max_clusters, min_count):
+    # Fits the bearing clusters of a chunk of cells, run in a worker process
+    bin_width = 360.0 / num_bins
+    models = {}
+    starts = _cell_starts(cells)
+    ends = np.r_[starts[1:], len(cells)]
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        directed = bins[start:end] >= 0
+        # The detokenizer ignores the models of cells with few points
+        if counts[start:end].sum() <= min_count or directed.sum() < 2:
+            continue
+        model, means = fit_bearing_clusters(
+            (bins[start:end][directed] + 0.5) * bin_width,
+            counts[start:end][directed].astype(np.float64),
+            sums[start:end][directed],
+            max_clusters,
+        )
+        if len(means) > 1:
+            models[int(cells[start])] = (model, means)
+    return models
+
+
+class ClusterModelBuilder:
+    """
+    Builds the detokenization artifacts, h3_clusters.pkl (data centroid and
+    point count of every cell) and h3_kmeans_clustering_all_models_precise.pkl
+    (bearing clusters of every cell), from the trajectory store.
+
+    The datasets are streamed one at a time. Their points are reduced, with
+    vectorized numpy operations, to additive statistics per (cell, bearing bin):
+    point count and coordinate sums. Bin -1 holds the points without an incoming
+    bearing. The statistics and the ids of the datasets already included are
+    persisted, so adding a dataset only merges its statistics and refits the
+    cells it touched, in parallel worker processes.
+
+    Attributes:
+        output_dir (str): The directory of the artifacts and statistics.
+        num_bins (int): Number of bearing bins, the resolution of the clustering.
+        max_clusters (int): Maximum number of bearing clusters per cell.
+        min_count (int): Cells with at most this many points get no clusters.
+        h3_clusters (dict): token -> {"x", "y", "current_count"}.
+        h3_kmeans (dict): token -> (model, means).
+        datasets (list): Ids of the datasets included in the statistics.
+    """
+
+    def __init__(self, output_dir, num_bins=36, max_clusters=4, min_count=20):
+        """
+        Initializes the builder and loads the statistics of previous builds.
+
+        Args:
+            output_dir (str): The directory of the artifacts and statistics.
+            num_bins (int): Number of bearing bins.
+            max_clusters (int): Maximum number of bearing clusters per cell.
+            min_count (int): Cells with at most this many points get no clusters.
+        """
+        self.output_dir = output_dir
+        self.num_bins = num_bins
+        self.max_clusters = max_clusters
+        self.min_count = min_count
+        self.stats_path = os.path.join(output_dir, "clusterStats.npz")
+        self.state_path = os.path.join(output_dir, "clusterStats.json")
+        self.clusters_path = os.path.join(output_dir, "h3_clusters.pkl")
+        self.kmeans_path = os.path.join(
+            output_dir, "h3_kmeans_clustering_all_models_precise.pkl"
+        )
+        self.cells = np.array([], dtype=np.uint64)
+        self.bins = np.array([], dtype=np.int16)
+        self.counts = np.array([], dtype=np.int64)
+        self.sums = np.empty((0, 2))
+        self.h3_clusters = {}
+        self.h3_kmeans = {}
+        self.datasets = []
+        self.dirty = set()
+        os.makedirs(output_dir, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """Loads the statistics and the artifacts written by the last save."""
+        if not os.path.exists(self.state_path):
+            return
+        with open(self.state_path, "r") as file:
+            state = json.load(file)
+        if state["num_bins"] != self.num_bins:
+            raise ValueError(
+                f"The statistics in {self.output_dir} use {state['num_bins']} bins"
+            )
+        self.datasets = state["datasets"]
+        # Cells merged into the statistics but not refitted before the save
+        self.dirty = {int(token, 16) for token in state.get("dirty", [])}
+        stats = np.load(self.stats_path)
+        self.cells, self.bins = stats["cells"], stats["bins"]
+        self.counts, self.sums = stats["counts"], stats["sums"]
+        with open(self.clusters_path, "rb") as file:
+            self.h3_clusters = pickle.load(file)
+        with open(self.kmeans_path, "rb") as file:
+            self.h3_kmeans = pickle.load(file)
+
+    def add_batch(self, batch: TrajectoryBatch) -> int:
+        """
+        Merges the statistics of a tokenized batch.
+
+        Returns:
+            int: The number of cells touched by the batch.
+        """
+        if batch.tokens is None:
+            raise ValueError("Only tokenized batches carry the cells of their points")
+        bearings = incoming_bearings(batch)
+        bins = np.full(batch.num_points, -1, dtype=np.int16)
+        directed = ~np.isnan(bearings)
+        bins[directed] = np.minimum(
+            (bearings[directed] * self.num_bins / 360).astype(np.int16),
+            self.num_bins - 1,
+        )
+        cells, bins, counts, sums = _group(
+            batch.tokens,
+            bins,
+            np.ones(batch.num_points, dtype=np.int64),
+            np.stack((batch.lat, batch.lon), axis=1),
+        )
+        touched = np.unique(cells)
+        self.dirty.update(touched.tolist())
+        self.cells, self.bins, self.counts, self.sums = _group(
+            np.concatenate((self.cells, cells)),
+            np.concatenate((self.bins, bins)),
+            np.concatenate((self.counts, counts)),
+            np.concatenate((self.sums, sums)),
+        )
+        return len(touched)
+
+    def add_dataset(self, dataset_id, trajectories) -> bool:
+        """
+        Merges the statistics of a dataset unless it was already included.
+
+        Returns:
+            bool: Whether the dataset was added.
+        """
+        if dataset_id in self.datasets:
+            logging.info(f"Skipping dataset {dataset_id}: already in the statistics.")
+            return False
+        # Lists of tokens carry no GPS points, the centroids would only echo H3
+        if not isinstance(trajectories, TrajectoryBatch):
+            logging.warning(
+                f"Skipping dataset {dataset_id}: stored as token lists without "
+                "GPS points, re-save it as a TrajectoryBatch to include it."
+            )
+            return False
+        self.add_batch(trajectories)
+        self.datasets.append(dataset_id)
+        return True
+
+    def add_store(self, store_path, loader) -> list:
+        """
+        Streams the datasets of the trajectory store and adds the new ones.
+
+        Args:
+            store_path (str): The trajectory store directory.
+            loader (callable): Function taking a dataset path and returning its
+                               trajectories, e.g. load_tokenized_trajectories.
+
+        Returns:
+            list: The ids of the added datasets.
+        """
+        added = []
+        for name in sorted(os.listdir(store_path)):
+            dataset_id, extension = os.path.splitext(name)
+            if extension == ".h3z":
+                # The token codec only keeps the tokens of the points
+                logging.warning(
+                    f"Skipping dataset {dataset_id}: token stream (.h3z) "
+                    "without GPS points."
+                )
+                continue
+            if extension != ".pkl":
+                continue
+            if dataset_id in self.datasets:
+                logging.info(
+                    f"Skipping dataset {dataset_id}: already in the statistics."
+                )
+                continue
+            if self.add_dataset(dataset_id, loader(os.path.join(store_path, name))):
+                added.append(dataset_id)
+        return added
+
+    def fit(self, max_workers=4, chunk_cells=2048) -> int:
+        """
+        Recomputes the centroids and bearing clusters of the cells touched
+        since the last fit, fitting chunks of cells in parallel processes.
+
+        Returns:
+            int: The number of refitted cells.
+        """
+        if not self.dirty:
+            return 0
+        dirty = np.array(sorted(self.dirty), dtype=np.uint64)
+        rows = np.isin(self.cells, dirty)
+        cells, bins = self.cells[rows], self.bins[rows]
+        counts, sums = self.counts[rows], self.sums[rows]
+
+        # Data centroids and point counts, summed over the bins of every cell
+        starts = _cell_starts(cells)
+        totals = np.add.reduceat(counts, starts)
+        centroids = np.add.reduceat(sums, starts, axis=0) / totals[:, None]
+        tokens = ints_to_tokens(cells[starts])
+        for token, (lat, lon), count in zip(
+            tokens, centroids.tolist(), totals.tolist()
+        ):
+            self.h3_clusters[token] = {"x": lon, "y": lat, "current_count": count}
+            self.h3_kmeans.pop(token, None)
+
+        bounds = np.r_[starts[::chunk_cells], len(cells)].tolist()
+        chunks = [
+            (
+                cells[a:b],
+                bins[a:b],
+                counts[a:b],
+                sums[a:b],
+                self.num_bins,
+                self.max_clusters,
+                self.min_count,
+            )
+            for a, b in zip(bounds[:-1], bounds[1:])
+        ]
+        if max_workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(_fit_cells, *zip(*chunks)))
+        else:
+            results = [_fit_cells(*chunk) for chunk in chunks]
+        for models in results:
+            for cell, model in models.items():
+                self.h3_kmeans[format(cell, "x")] = model
+        self.dirty.clear()
+        return len(tokens)
+
+    def _dump(self, path, write, binary=True):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb" if binary else "w") as file:
+            write(file)
+        os.replace(tmp_path, path)
+
+    def save(self):
+        """Writes the artifacts, then the statistics they were built from."""
+        self._dump(self.clusters_path, lambda f: pickle.dump(self.h3_clusters, f))
+        self._dump(self.kmeans_path, lambda f: pickle.dump(self.h3_kmeans, f))
+        self._dump(
+            self.stats_path,
+            lambda f: np.savez(
+                f,
+                cells=self.cells,
+                bins=self.bins,
+                counts=self.counts,
+                sums=self.sums,
+            ),
+        )
+        state = {
+            "num_bins": self.num_bins,
+            "datasets": self.datasets,
+            "dirty": [format(cell, "x") for cell in sorted(self.dirty)],
+        }
+        self._dump(self.state_path, lambda f: json.dump(state, f), binary=False)
+
+    def install(self, detokenizer):
+        """
+        Makes a DeTokenizer (or the legacy BERTImputer) use the built artifacts.
+        """
+        detokenizer.h3_clusters = self.h3_clusters
+        detokenizer.h3_kmeans = self.h3_kmeans
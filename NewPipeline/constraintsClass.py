@@ -3,6 +3,24 @@
 # some examples of dummy predefined rules
 
 
+class _PreviousTokens(list):
+    """
+    The tokens preceding a token in its trajectory, grown one token at a time
+    by check_batch, with a set behind membership tests.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._seen = set()
+
+    def append(self, token):
+        super().append(token)
+        self._seen.add(token)
+
+    def __contains__(self, token):
+        return token in self._seen
+
+
 def no_repeat_rule(token, previous_tokens):
     """
     Rule: The token should not be repeated in the trajectory.
@@ -86,3 +104,26 @@ class SpatialConstraints:
             if not rule(token, previous_tokens):
                 return False, rule
         return True, None
+
+    def check_batch(self, batch):
+        """
+        Checks every token of a tokenized TrajectoryBatch, each token against
+        the tokens preceding it in its trajectory.
+
+        Args:
+            batch (TrajectoryBatch): The tokenized trajectories.
+
+        Returns:
+            np.ndarray: A bool array with one entry per point, False where a rule failed.
+        """
+        import numpy as np
+
+        passed = np.ones(batch.num_points, dtype=bool)
+        for i in range(len(batch)):
+            start = int(batch.offsets[i])
+            # The rules see the same growing list instead of a copy per token
+            previous_tokens = _PreviousTokens()
+            for j, token in enumerate(batch.token_list(i)):
+                passed[start + j], _ = self.check_token(token, previous_tokens)
+                previous_tokens.append(token)
+        return passed
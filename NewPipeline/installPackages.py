@@ -1,18 +1,118 @@
 """
-Small module responsible to install packages that are imported
+Setup command installing the third party packages used by the pipelines.
+
+Run it once after cloning instead of installing on import:
+    python installPackages.py                  installs the missing packages
+    python installPackages.py --check          only lists the missing packages
+    python installPackages.py --import-budget  checks the import time budget
 """
 
+import importlib.util
+import os
 import subprocess
 import sys
+import time
+
+# import name -> pip requirement, the pipelines use the h3 v3 API
+REQUIRED_PACKAGES = {
+    "h3": "h3<4",
+    "numpy": "numpy",
+    "sklearn": "scikit-learn",
+}
+
+# module -> maximum import time in seconds in a fresh interpreter
+IMPORT_TIME_BUDGET = {
+    "TrajPipeline.NewPipeline.Pipeline": 0.5,
+    "TrajPipeline.NewPipeline.cacheClass": 0.2,
+    "TrajPipeline.NewPipeline.modelPoolClass": 0.2,
+}
 
 
 # Function to install a package if it's not already installed.
-def install_package(package):
+def install_package(package, requirement=None):
     """
     responsible to install a package that is imported
     to make sure the pipeline is runnable anywhere
     """
-    try:
-        __import__(package)
-    except ImportError:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", package])
+    if importlib.util.find_spec(package) is None:
+        subprocess.check_call(
+            [sys.executable, "-m", "pip", "install", requirement or package]
+        )
+
+
+def missing_packages():
+    """Returns the import names of the required packages that are not installed."""
+    return [
+        package
+        for package in REQUIRED_PACKAGES
+        if importlib.util.find_spec(package) is None
+    ]
+
+
+def install_requirements():
+    """Installs every missing package of REQUIRED_PACKAGES."""
+    for package in missing_packages():
+        install_package(package, REQUIRED_PACKAGES[package])
+
+
+def import_time(module):
+    """
+    Measures the import time of a module in a fresh interpreter, the cost paid
+    by every cold start of a CLI call or a serving process.
+
+    Returns:
+        float: The import time in seconds.
+    """
+    # The parent of the repository makes the TrajPipeline package importable
+    repository_parent = os.path.dirname(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    )
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"import {module}; print(time.perf_counter() - start)"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [repository_parent, os.path.dirname(os.path.abspath(__file__))]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def check_import_budget(budget=None):
+    """
+    Imports every module of the budget in a fresh interpreter.
+
+    Returns:
+        dict: module -> (import time, budget) of the modules over their budget.
+    """
+    budget = budget or IMPORT_TIME_BUDGET
+    over_budget = {}
+    for module, seconds in budget.items():
+        elapsed = import_time(module)
+        if elapsed > seconds:
+            over_budget[module] = (elapsed, seconds)
+    return over_budget
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        missing = missing_packages()
+        print("Missing packages:", ", ".join(missing) if missing else "none")
+        sys.exit(1 if missing else 0)
+    if "--import-budget" in sys.argv:
+        start = time.perf_counter()
+        over_budget = check_import_budget()
+        for module, (elapsed, seconds) in over_budget.items():
+            print(f"{module}: {elapsed:.3f}s, budget {seconds:.3f}s")
+        print(f"Import budget checked in {time.perf_counter() - start:.1f}s")
+        sys.exit(1 if over_budget else 0)
+    install_requirements()
+    print("All required packages are installed.")
@@ -0,0 +1,243 @@
+"""Model Pool Module Definition"""
+
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+
+
+def load_pickled_model(model_path):
+    """
+    Default loader, loads the model.pkl stored in a pyramid cell directory.
+
+    Args:
+        model_path (str): The model_path of the pyramid cell.
+
+    Returns:
+        object: The unpickled model.
+    """
+    with open(os.path.join(model_path, "model.pkl"), "rb") as f:
+        return pickle.load(f)
+
+
+def model_file_size(model_path, model):
+    """
+    Default size estimate of a resident model, the size of its files on disk.
+    """
+    if not model_path or not os.path.isdir(model_path):
+        return 0
+    return sum(
+        os.path.getsize(os.path.join(model_path, name))
+        for name in os.listdir(model_path)
+        if os.path.isfile(os.path.join(model_path, name))
+    )
+
+
+class _PendingLoad:
+    """A load in progress, waited for by the concurrent misses on its model."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.model, self.error, self.invalidated = None, None, False
+
+
+class ModelPool:
+    """
+    Keeps the most recently used pyramid-cell models resident in memory.
+
+    Models are keyed by the model_path of their cell and evicted in LRU order once
+    more than `max_models` are resident or their estimated size exceeds
+    `memory_budget_bytes`. Every request is counted per cell so the hottest cells
+    can be preloaded, e.g. right after their models were updated.
+
+    Models are loaded outside of the pool lock, requests for resident models
+    are never blocked by a load from disk. Concurrent misses on the same cell
+    share a single load.
+
+    Attributes:
+        loader (callable): Function taking a model_path and returning the model.
+        size_fn (callable): Function taking (model_path, model) and returning its size in bytes.
+        max_models (int): Maximum number of resident models.
+        memory_budget_bytes (int): Maximum total estimated size of the resident models.
+        models (OrderedDict): The resident models in LRU order, model_path -> (model, size).
+        request_counts (Counter): Number of requests received per model_path.
+        load_latencies (deque): Latencies of the last `latency_window` loads.
+    """
+
+    def __init__(
+        self,
+        loader=None,
+        max_models: int = 8,
+        memory_budget_bytes: int = 4 * 1024**3,
+        size_fn=None,
+        latency_window: int = 1024,
+    ):
+        """
+        Initializes an empty pool.
+
+        Args:
+            loader (callable, optional): Loads a model from its cell path, defaults to
+                                         unpickling model.pkl. Stub loaders can be used
+                                         for testing.
+            max_models (int): Maximum number of resident models.
+            memory_budget_bytes (int): Maximum total estimated size of the resident models.
+            size_fn (callable, optional): Estimates the size of a loaded model.
+            latency_window (int): Number of recent load latencies kept for the metrics.
+        """
+        self.loader = loader or load_pickled_model
+        self.size_fn = size_fn or model_file_size
+        self.max_models = max_models
+        self.memory_budget_bytes = memory_budget_bytes
+        self.models = OrderedDict()
+        self.request_counts = Counter()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.load_latencies = deque(maxlen=latency_window)
+        self.loads, self.total_load_seconds = 0, 0.0
+        # model_path -> _PendingLoad of the loads in progress
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, model_path):
+        return model_path in self.models
+
+    def __len__(self):
+        return len(self.models)
+
+    def get(self, model_path):
+        """
+        Returns the model stored at model_path, loading it on a miss.
+
+        Args:
+            model_path (str): The model_path of the pyramid cell.
+
+        Returns:
+            object: The resident model.
+        """
+        if model_path is None:
+            raise ValueError("The requested pyramid cell has no model")
+        with self._lock:
+            self.request_counts[model_path] += 1
+            if model_path in self.models:
+                self.hits += 1
+                self.models.move_to_end(model_path)
+                return self.models[model_path][0]
+            self.misses += 1
+        return self._load(model_path)
+
+    def get_for_cell(self, cell):
+        """Returns the model of a pyramid cell dictionary."""
+        return self.get(cell["model_path"])
+
+    def _load(self, model_path):
+        with self._lock:
+            if model_path in self.models:
+                return self.models[model_path][0]
+            pending = self._loading.get(model_path)
+            owner = pending is None
+            if owner:
+                pending = self._loading[model_path] = _PendingLoad()
+        if not owner:
+            # Another thread is loading this model, wait for its result
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.model
+
+        start = time.perf_counter()
+        try:
+            model = self.loader(model_path)
+            size = self.size_fn(model_path, model)
+        except BaseException as error:
+            with self._lock:
+                del self._loading[model_path]
+            pending.error = error
+            pending.done.set()
+            raise
+        latency = time.perf_counter() - start
+        with self._lock:
+            del self._loading[model_path]
+            self.load_latencies.append(latency)
+            self.loads += 1
+            self.total_load_seconds += latency
+            # A model invalidated while it was loading may be outdated already
+            if not pending.invalidated:
+                self.models[model_path] = (model, size)
+                self._evict(keep=model_path)
+        pending.model = model
+        pending.done.set()
+        return model
+
+    def _evict(self, keep=None):
+        total_bytes = sum(size for _, size in self.models.values())
+        while len(self.models) > 1 and (
+            len(self.models) > self.max_models or total_bytes > self.memory_budget_bytes
+        ):
+            model_path = next(iter(self.models))
+            if model_path == keep:
+                break
+            _, size = self.models.pop(model_path)
+            total_bytes -= size
+            self.evictions += 1
+
+    def preload(self, model_paths):
+        """
+        Loads models ahead of requests without counting them as requests.
+
+        Args:
+            model_paths (list of str): The model paths to make resident.
+
+        Returns:
+            int: The number of models loaded, models failing to load are skipped.
+        """
+        loaded = 0
+        for model_path in model_paths:
+            if model_path is None or model_path in self.models:
+                continue
+            try:
+                self._load(model_path)
+            except Exception as error:
+                logging.warning(f"Could not preload the model of {model_path}: {error}")
+                continue
+            loaded += 1
+        return loaded
+
+    def hot_cells(self, k=None):
+        """Returns the k most requested model paths."""
+        return [model_path for model_path, _ in self.request_counts.most_common(k)]
+
+    def preload_hot_cells(self, k=None):
+        """Preloads the k most requested models, by default as many as fit in the pool."""
+        return self.preload(self.hot_cells(k or self.max_models))
+
+    def invalidate(self, model_path):
+        """Drops a resident model, e.g. after its cell got a new model."""
+        with self._lock:
+            self.models.pop(model_path, None)
+            if model_path in self._loading:
+                self._loading[model_path].invalidated = True
+
+    def metrics(self) -> dict:
+        """Returns the hit rate, load latencies and residency of the pool."""
+        requests = self.hits + self.misses
+        with self._lock:
+            latencies = sorted(self.load_latencies)
+        return {
+            "requests": requests,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "evictions": self.evictions,
+            "loads": self.loads,
+            "mean_load_latency_s": (
+                self.total_load_seconds / self.loads if self.loads else 0.0
+            ),
+            # Over the last latency_window loads
+            "p95_load_latency_s": (
+                latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0
+            ),
+            "max_load_latency_s": latencies[-1] if latencies else 0.0,
+            "resident_models": len(self.models),
+            "resident_bytes": sum(size for _, size in self.models.values()),
+        }
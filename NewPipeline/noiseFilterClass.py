@@ -0,0 +1,215 @@
+"""Noise Filter Module Definition"""
+
+import time
+
+import numpy as np
+
+from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
+from TrajPipeline.NewPipeline.utilFunctions import haversine_meters
+
+
+def _owners(offsets: np.ndarray) -> np.ndarray:
+    """Index of the trajectory of every point."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def _steps(lat, lon, owners, rows):
+    """
+    Distance in meters from every point of rows to the next one, NaN for the
+    last point of a trajectory.
+    """
+    steps = np.full(len(rows), np.nan)
+    if len(rows) > 1:
+        same = owners[rows[1:]] == owners[rows[:-1]]
+        steps[:-1] = np.where(
+            same,
+            haversine_meters(
+                lat[rows[:-1]], lon[rows[:-1]], lat[rows[1:]], lon[rows[1:]]
+            ),
+            np.nan,
+        )
+    return steps
+
+
+class NoiseFilter:
+    """
+    Removes GPS noise from whole batches of trajectories with vectorized
+    haversine math, in three steps:
+
+    1. Implied speed outliers: a point reached and left faster than max_speed
+       is a teleport spike and dropped (an endpoint when the segment to it is
+       too fast but the one after is not). The speed uses the point timestamps,
+       or sample_interval seconds between points when there are none. Repeated
+       up to max_passes times, as dropping a spike can uncover the next one.
+    2. Stationary points: points within stationary_radius meters of the point
+       kept before them collapse into that point.
+    3. Distance based resampling: points closer than resample_meters to the
+       point kept before them are dropped, so the kept points are spaced by at
+       least resample_meters. Only original points are kept (no interpolation),
+       which keeps summaries aligned with their trajectories.
+
+    The first and last point of a trajectory and the protected points are
+    never dropped by steps 2 and 3, protected points are never dropped at all.
+    Steps 2 and 3 drop every other point of a run of too close points per
+    pass and compare the survivors to their new predecessor in the next one,
+    so a run of k points takes about log2(k) vectorized passes.
+
+    Set a threshold to None to skip its step.
+    """
+
+    def __init__(
+        self,
+        max_speed: float | None = 50.0,
+        sample_interval: float | None = None,
+        stationary_radius: float | None = 2.0,
+        resample_meters: float | None = 10.0,
+        max_passes: int = 3,
+    ):
+        """
+        Initializes the filter with its thresholds.
+
+        Args:
+            max_speed (float, optional): Fastest plausible speed in m/s.
+            sample_interval (float, optional): Seconds between two points of a
+                                               trajectory without timestamps, the
+                                               speed step is skipped for those
+                                               when it is None.
+            stationary_radius (float, optional): Radius of a stationary point in meters.
+            resample_meters (float, optional): Smallest spacing of the kept points in meters.
+            max_passes (int): Passes of the speed step.
+        """
+        self.max_speed = max_speed
+        self.sample_interval = sample_interval
+        self.stationary_radius = stationary_radius
+        self.resample_meters = resample_meters
+        self.max_passes = max_passes
+
+    def _speed_outliers(self, lat, lon, owners, timestamps, rows):
+        """Mask of the speed outliers among rows."""
+        steps = _steps(lat, lon, owners, rows)
+        if timestamps is not None:
+            durations = np.full(len(rows), np.nan)
+            durations[:-1] = timestamps[rows[1:]] - timestamps[rows[:-1]]
+            # Repeated timestamps make any movement infinitely fast
+            durations = np.maximum(durations, 1e-9)
+        else:
+            durations = self.sample_interval
+        with np.errstate(invalid="ignore"):
+            fast_next = steps / durations > self.max_speed
+            slow_next = steps / durations <= self.max_speed
+        fast_previous = np.r_[False, fast_next[:-1]]
+        slow_previous = np.r_[False, slow_next[:-1]]
+        first = np.r_[True, owners[rows[1:]] != owners[rows[:-1]]]
+        last = np.r_[first[1:], True]
+        spikes = fast_previous & fast_next
+        # Endpoints only have one segment, the one next to it tells who is off
+        spikes |= first & fast_next & np.r_[slow_next[1:], False]
+        spikes |= last & fast_previous & np.r_[False, slow_previous[:-1]]
+        return spikes
+
+    def _thin(self, lat, lon, owners, rows, protected, min_distance):
+        """Drops the points of rows closer than min_distance to their predecessor."""
+        while len(rows) > 1:
+            steps = _steps(lat, lon, owners, rows)
+            last = np.isnan(steps)
+            with np.errstate(invalid="ignore"):
+                close = np.r_[False, steps[:-1] < min_distance] & ~last
+            if protected is not None:
+                close &= ~protected[rows]
+            if not close.any():
+                break
+            # Every other point of a run of close points goes in this pass
+            run_starts = close & ~np.r_[False, close[:-1]]
+            starts = np.flatnonzero(run_starts)
+            run = np.maximum(np.cumsum(run_starts) - 1, 0)
+            position = np.arange(len(rows)) - starts[run]
+            rows = rows[~(close & (position % 2 == 0))]
+        return rows
+
+    def filter_arrays(self, lat, lon, offsets, timestamps=None, protected=None):
+        """
+        Filters flat point arrays of trajectories.
+
+        Args:
+            lat (np.ndarray): float64 latitudes of all points.
+            lon (np.ndarray): float64 longitudes of all points.
+            offsets (np.ndarray): Start of each trajectory, followed by the number of points.
+            timestamps (np.ndarray, optional): Timestamp in seconds of every point.
+            protected (np.ndarray, optional): bool mask of the points to keep anyway.
+
+        Returns:
+            tuple: (keep, report) with keep the bool mask of the kept points and
+                   report a dict with the number of points before and after,
+                   the points dropped by every step, the filtering time and the
+                   estimated downstream speedup (points before / after, the
+                   tokenization and de-tokenization costs being linear in points).
+        """
+        start = time.perf_counter()
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        owners = _owners(offsets)
+        rows = np.arange(len(lat))
+        report = {"trajectories": len(offsets) - 1, "points_in": len(lat)}
+
+        dropped = 0
+        use_speed = self.max_speed is not None and (
+            timestamps is not None or self.sample_interval is not None
+        )
+        for _ in range(self.max_passes if use_speed else 0):
+            outliers = self._speed_outliers(lat, lon, owners, timestamps, rows)
+            if protected is not None:
+                outliers &= ~protected[rows]
+            if not outliers.any():
+                break
+            dropped += int(outliers.sum())
+            rows = rows[~outliers]
+        report["dropped_speed"] = dropped
+
+        for step, distance in (
+            ("dropped_stationary", self.stationary_radius),
+            ("dropped_resampling", self.resample_meters),
+        ):
+            count = len(rows)
+            if distance is not None:
+                rows = self._thin(lat, lon, owners, rows, protected, distance)
+            report[step] = count - len(rows)
+
+        keep = np.zeros(len(lat), dtype=bool)
+        keep[rows] = True
+        report["points_out"] = len(rows)
+        report["dropped_fraction"] = 1 - len(rows) / len(lat) if len(lat) else 0.0
+        report["estimated_speedup"] = len(lat) / len(rows) if len(rows) else 1.0
+        report["seconds"] = time.perf_counter() - start
+        return keep, report
+
+    def filter_batch(self, batch: TrajectoryBatch, protected=None):
+        """
+        Filters a batch of trajectories.
+
+        Args:
+            batch (TrajectoryBatch): The trajectories, timestamps are used when present.
+            protected (np.ndarray, optional): bool mask of the points to keep anyway.
+
+        Returns:
+            tuple: (batch, report) with a new batch of the kept points, see filter_arrays.
+        """
+        keep, report = self.filter_arrays(
+            batch.lat, batch.lon, batch.offsets, batch.timestamps, protected
+        )
+        lengths = np.bincount(_owners(batch.offsets)[keep], minlength=len(batch))
+        offsets = np.zeros(len(batch) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        def pick(array):
+            return array[keep] if array is not None else None
+
+        filtered = TrajectoryBatch(
+            batch.lat[keep],
+            batch.lon[keep],
+            offsets,
+            batch.ids,
+            pick(batch.timestamps),
+            pick(batch.tokens),
+        )
+        return filtered, report
@@ -2,7 +2,17 @@
 
 import os
 import json
+import logging
+import math
+import uuid
+import h3
+import numpy as np
 from utilFunctions import load_metadata, load_tokenized_trajectories
+from TrajPipeline.NewPipeline.cacheClass import DEFAULT_CACHE_DIR, ResultCache
+from TrajPipeline.NewPipeline.modelPoolClass import ModelPool
+from TrajPipeline.NewPipeline.pyramidStoreClass import PyramidStore
+from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
+from TrajPipeline.NewPipeline.splitterClass import DatasetSplitter
 
 
 class PartitioningModule:
@@ -18,60 +28,103 @@ class PartitioningModule:
         H (int): The number of levels in the pyramid.
         L (int): The number of cells per level.
         pyramid (dict): The hierarchical pyramid structure where each level contains cells.
+        pyramid_store (PyramidStore): The persistent state of the pyramid, a snapshot plus
+        a log of the committed cell updates, shared safely by concurrent ingest workers.
+        extent (tuple): The geographic extent (min_lat, max_lat, min_lon, max_lon) covered
+        by the root cell, each height h splits it into a 2**h x 2**h grid.
+        projection (str): Either 'extent' (a lat/lon grid over the extent) or
+        'web_mercator' (the Web-Mercator tile hierarchy, zoom level h at height h).
         model_repo_dir (str): The directory where model files are stored, structured as
         height_level_index.
+        result_cache (ResultCache): Cache of model outputs, invalidated whenever the
+        model of a cell is updated.
+        model_pool (ModelPool): The warm pool of loaded models, shared across requests.
     """
 
-    def __init__(self, models_repo_path):
+    def __init__(self, models_repo_path, model_pool=None, result_cache=None):
         """
         Initializes the PartitioningModule with configurations read from a JSON file.
+
+        Args:
+            models_repo_path (str): The directory of the models repository.
+            model_pool (ModelPool, optional): A pool to keep loaded models across
+                                              instances, a private one is created otherwise.
+            result_cache (ResultCache, optional): The cache to invalidate on model
+                                                  updates, by default the one the
+                                                  testing outputs are served from.
         """
-        config_file = os.path.join(models_repo_path, "pyramidConfig.json")
-        self.pyramid_path = os.path.join(models_repo_path, "partioningPyramid.json")
+        config_file = os.path.join(models_repo_path, "pyramidConfigs.json")
+        self.pyramid_store = PyramidStore(models_repo_path)
+        self.pyramid_path = self.pyramid_store.snapshot_path
         self.config_file = config_file
         self.pyramid_height = 5
         self.pyramid_levels = 3
         self.build_pyramid_flag = False
-        self.pyramid = {}
+        self.extent = (-90.0, 90.0, -180.0, 180.0)
+        self.projection = "extent"
         self.model_repo_dir = models_repo_path
         self.tokens_threshold_per_cell = 20000
+        self.result_cache = (
+            result_cache if result_cache is not None else ResultCache(DEFAULT_CACHE_DIR)
+        )
+        self.model_pool = model_pool if model_pool is not None else ModelPool()
         self.load_config()
-        if self.build_pyramid_flag:
-            self.build_pyramid()
-        else:
-            self.load_pyramid()
-        print(self.pyramid)
+        # The pyramid is only built from scratch when asked or on first use, a
+        # built one holds the trained models and must not be wiped per instance
+        self.pyramid_store.load_or_build(
+            self._generate_pyramid, rebuild=self.build_pyramid_flag
+        )
+
+    @property
+    def pyramid(self):
+        return self.pyramid_store.pyramid
+
+    @pyramid.setter
+    def pyramid(self, pyramid):
+        self.pyramid_store.pyramid = pyramid
 
     def load_config(self):
         """
-        Loads the configuration parameters H and L from the JSON file.
+        Loads the configuration parameters H, L and the geographic extent from the JSON file.
         """
         with open(self.config_file, "r") as file:
             config = json.load(file)
             self.pyramid_height = config.get("H", 5)  # Default to 5 if not specified
             self.pyramid_levels = config.get("L", 3)  # Default to 3 if not specified
-            self.build_pyramid_flag = config.get("build_pyramid_from_scratch")
+            self.build_pyramid_flag = config.get("build_pyramid_from_scratch", False)
+            self.projection = config.get("projection", self.projection)
+            extent = config.get("extent")
+            if extent is not None:
+                self.extent = (
+                    float(extent["min_lat"]),
+                    float(extent["max_lat"]),
+                    float(extent["min_lon"]),
+                    float(extent["max_lon"]),
+                )
+        if self.projection not in ("extent", "web_mercator"):
+            raise ValueError(f"Unknown pyramid projection: {self.projection}")
+        min_lat, max_lat, min_lon, max_lon = self.extent
+        if min_lat >= max_lat or min_lon >= max_lon:
+            raise ValueError(f"Invalid pyramid extent: {self.extent}")
 
     def build_pyramid(self):
         """
         Builds the pyramid data structure for the models repository.
         """
-        self.pyramid = {}  # Reset the pyramid structure
-        for h in range(self.pyramid_height + 1):
-            self.pyramid[h] = self._generate_cells(h)
-        # Save the pyramid to the JSON file
-        with open(self.pyramid_path, "w") as file:
-            json.dump(self.pyramid, file, indent=4)
+        # Save the pyramid as a new snapshot, dropping the logged updates
+        self.pyramid_store.reset(self._generate_pyramid())
+
+    def _generate_pyramid(self):
+        """
+        Generates the empty cells of every height.
+        """
+        return {h: self._generate_cells(h) for h in range(self.pyramid_height + 1)}
 
     def load_pyramid(self):
         """
-        Loads the pyramid data structure from the JSON file.
+        Loads the pyramid data structure from its snapshot and update log.
         """
-        if os.path.exists(self.pyramid_path):
-            with open(self.pyramid_path, "r") as file:
-                self.pyramid = json.load(file)
-        else:
-            raise FileNotFoundError(f"Pyramid file not found at {self.pyramid_path}")
+        self.pyramid_store.load()
 
     def _generate_cells(self, h):
         """
@@ -86,31 +139,137 @@ class PartitioningModule:
                 "bounds": self._calculate_bounds(h, i),
                 "occupied": False,
                 "model_path": None,
+                "model_version": 0,
                 "num_tokens": 0,
             }
         return cells
 
+    def _normalize(self, lat, lon):
+        """
+        Maps coordinates to the unit square of the pyramid, u along the latitude
+        and v along the longitude axis.
+        """
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        if self.projection == "web_mercator":
+            lat = np.clip(lat, -85.05112878, 85.05112878)
+            u = 0.5 + np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) / (2 * np.pi)
+            v = (lon + 180.0) / 360.0
+            return u, v
+        min_lat, max_lat, min_lon, max_lon = self.extent
+        return (lat - min_lat) / (max_lat - min_lat), (lon - min_lon) / (
+            max_lon - min_lon
+        )
+
+    def _denormalize(self, u, v):
+        """
+        Inverse of _normalize for scalar values.
+        """
+        if self.projection == "web_mercator":
+            lat = math.degrees(2 * math.atan(math.exp((u - 0.5) * 2 * math.pi)))
+            return lat - 90.0, v * 360.0 - 180.0
+        min_lat, max_lat, min_lon, max_lon = self.extent
+        return (
+            min_lat + u * (max_lat - min_lat),
+            min_lon + v * (max_lon - min_lon),
+        )
+
     def _calculate_bounds(self, h, index):
         """
         Calculates the bounds for a cell at a given height and index.
+        The cells of height h form a 2**h x 2**h grid over the extent, indexed
+        row by row from the south west corner.
+        """
+        side = 2**h
+        row, col = divmod(index, side)
+        lat_start, lon_start = self._denormalize(row / side, col / side)
+        lat_end, lon_end = self._denormalize((row + 1) / side, (col + 1) / side)
+        return (lat_start, lat_end, lon_start, lon_end)
+
+    def cell_indices(self, lat, lon, h):
+        """
+        Vectorized inverse of _calculate_bounds, maps coordinates to the index of
+        the cell holding them at height h in O(1) per point.
+
+        Args:
+            lat (np.ndarray): Latitudes of the points.
+            lon (np.ndarray): Longitudes of the points.
+            h (int): The height of the pyramid level.
+
+        Returns:
+            np.ndarray: The cell indices, -1 for points outside of the pyramid.
         """
-        total_cells = 4**h
-        cell_size = 1 / (4**h)
-        lat_start = (index // int(total_cells**0.5)) * cell_size
-        lon_start = (index % int(total_cells**0.5)) * cell_size
-        return (lat_start, lat_start + cell_size, lon_start, lon_start + cell_size)
+        side = 2**h
+        u, v = self._normalize(lat, lon)
+        inside = (u >= 0) & (u <= 1) & (v >= 0) & (v <= 1)
+        # Points on the northern/eastern border belong to the last row/column
+        rows = np.clip(np.floor(np.nan_to_num(u) * side), 0, side - 1)
+        cols = np.clip(np.floor(np.nan_to_num(v) * side), 0, side - 1)
+        return np.where(inside, rows * side + cols, -1).astype(np.int64)
 
-    def update_repository(self, data_path, metadata_path):
+    def update_repository(self, data_path, metadata_path, split=True, max_workers=4):
         """
         Updates the model repository with a model.
 
         Args:
             data_path: The path for the new trajectory dataset to update the repository.
             metadata_path: The path for metadata of the new trajectory dataset to update the repository.
+            split (bool): Whether the dataset is distributed over the finest cells meeting
+                          the token threshold (see DatasetSplitter) instead of going as a
+                          whole to the smallest cell enclosing it.
+            max_workers (int): Number of cell sub-datasets written at the same time.
+
+        Returns:
+            dict: (height, index) -> number of tokens of every updated cell.
+        """
+        return self.update_repository_batch(
+            [(data_path, metadata_path)], split, max_workers
+        )
+
+    def update_repository_batch(self, datasets, split=True, max_workers=4):
+        """
+        Updates the model repository with several datasets in a single commit.
+
+        The datasets are checked, split and written to their cell directories
+        first, without holding the pyramid lock. The updates of all their cells
+        are then committed as one transaction, so either every dataset of the
+        batch lands in the pyramid or none does.
+
+        Args:
+            datasets (list of tuples): (data path, metadata path) of every dataset.
+            split (bool): See update_repository.
+            max_workers (int): Number of cell sub-datasets written at the same time.
+
+        Returns:
+            dict: (height, index) -> number of tokens of every updated cell, a cell
+                  updated by several datasets keeps the last one.
+        """
+        cell_updates = []
+        for data_path, metadata_path in datasets:
+            cell_updates.extend(
+                self._prepare_update(data_path, metadata_path, split, max_workers)
+            )
+        with self.pyramid_store.transaction() as transaction:
+            for h, index, cell_data_path, cell_tokens in cell_updates:
+                self._update_cell_with_model(
+                    self.pyramid[h][index],
+                    cell_data_path,
+                    cell_tokens,
+                    transaction=transaction,
+                )
+        return {(h, index): tokens for h, index, _, tokens in cell_updates}
+
+    def _prepare_update(self, data_path, metadata_path, split, max_workers):
+        """
+        Checks a dataset against the pyramid and writes its cell sub-datasets.
+
+        Returns:
+            list of tuples: (height, index, dataset path, number of tokens) of every cell to update.
         """
         new_trajectory_dataset = load_tokenized_trajectories(data_path)
         new_trajectory_dataset_metadata = load_metadata(metadata_path)
-        num_tokens = new_trajectory_dataset_metadata.get("total_number_of_tokens")
+        # Metadata values are stored as text
+        num_tokens = int(new_trajectory_dataset_metadata.get("total_number_of_tokens"))
         # Calculate the minimum bounding rectangle of all trajectories
         min_bounding_rectangle = self._calculate_mbr(new_trajectory_dataset)
 
@@ -119,18 +278,38 @@ class PartitioningModule:
 
         # Update the model repository
         if target_cell:
-            # Only add new model to cell, if #tokens is at least k*4**(H-l)
-            # @YoussefDo: Make sure this is correct, to get the dataset as number of tokens
-
             h = target_cell["height"]
-            if num_tokens >= (
-                self.tokens_threshold_per_cell * 4 ** (self.pyramid_height - h)
-            ):
-                self._update_cell_with_model(
-                    target_cell, new_trajectory_dataset, num_tokens
+            if not split:
+                # Only add new model to cell, if #tokens is at least k*4**(H-l)
+                # @YoussefDo: Make sure this is correct, to get the dataset as number of tokens
+                if num_tokens < (
+                    self.tokens_threshold_per_cell * 4 ** (self.pyramid_height - h)
+                ):
+                    raise ValueError("Not sufficient data to train a model.")
+                return [(h, target_cell["index"], data_path, num_tokens)]
+            # A split dataset only has to be dense enough for the finer cells it
+            # is spread over, what no cell can take is reported as unassigned
+            splitter = DatasetSplitter(self)
+            assigned, unassigned = splitter.split(new_trajectory_dataset)
+            if len(unassigned):
+                logging.warning(
+                    f"{len(unassigned)} trajectories of {data_path} are too sparse "
+                    "for any cell and were left out"
                 )
-            else:
-                raise ValueError("Not sufficient data to train a model.")
+            if not assigned:
+                return []
+            # Uniquely named sub-datasets, a concurrent worker writing to the
+            # same cell cannot overwrite the file a committed update points to
+            written = splitter.write_sub_datasets(
+                new_trajectory_dataset,
+                assigned,
+                max_workers,
+                tag=uuid.uuid4().hex[:12],
+            )
+            return [
+                (h, index, cell_data_path, cell_tokens)
+                for (h, index), (cell_data_path, _, cell_tokens) in written.items()
+            ]
         else:
             raise ValueError(
                 "No suitable cell found for the given trajectories in the pyramid."
@@ -141,17 +320,21 @@ class PartitioningModule:
         Calculates the minimum bounding rectangle (MBR) for a set of trajectories.
 
         Args:
-            trajectories (list of list of tuples): List of trajectories, where each trajectory is a list of (lat, lon) tuples.
+            trajectories (TrajectoryBatch or list of list of tuples): A batch, or a list of trajectories,
+            where each trajectory is a list of (lat, lon) tuples or of H3 tokens, in which case the
+            centroids of the tokens are used.
 
         Returns:
             tuple: A tuple representing the MBR (min_lat, max_lat, min_lon, max_lon).
         """
+        if isinstance(trajectories, TrajectoryBatch):
+            return trajectories.mbr()
         min_lat = min_lon = float("inf")
         max_lat = max_lon = float("-inf")
 
         for trajectory in trajectories:
             for point in trajectory:
-                lat, lon = point
+                lat, lon = h3.h3_to_geo(point) if isinstance(point, str) else point
                 min_lat = min(min_lat, lat)
                 max_lat = max(max_lat, lat)
                 min_lon = min(min_lon, lon)
@@ -159,16 +342,22 @@ class PartitioningModule:
 
         return (min_lat, max_lat, min_lon, max_lon)
 
-    def _find_enclosing_cell(self, bounding_rectangle):
+    def _find_enclosing_cell(self, bounding_rectangle, occupied_only=False):
         """
         Finds the smallest cell that fully encloses the given bounding rectangle.
+        If occupied_only is set, only cells holding a model are considered.
+        The candidate cell of each height is computed directly from the corners
+        of the rectangle, so no level is scanned.
         """
+        lat_min, lat_max, lon_min, lon_max = bounding_rectangle
         for h in reversed(range(self.pyramid_height + 1)):
-            for i, cell in self.pyramid[h].items():
-                if self._is_bounding_rectangle_enclosed(
-                    bounding_rectangle, cell["bounds"]
-                ):
-                    return cell
+            low, high = self.cell_indices([lat_min, lat_max], [lon_min, lon_max], h)
+            if low < 0 or low != high:
+                continue
+            cell = self.pyramid[h][int(low)]
+            if occupied_only and not cell["occupied"]:
+                continue
+            return cell
         return None
 
     def _is_bounding_rectangle_enclosed(self, rectangle, cell_bounds):
@@ -184,24 +373,51 @@ class PartitioningModule:
             and lon_max <= cell_lon_max
         )
 
-    def _update_cell_with_model(self, cell, dataset, num_tokens):
+    def _update_cell_with_model(self, cell, dataset, num_tokens, transaction=None):
         """
         Updates the cell with a new model and stores it in the models repository.
+        The update is committed through the pyramid store, in the given
+        transaction or in one of its own.
+
+        Args:
+            cell (dict): The cell to update.
+            dataset (str): The path of the dataset of the cell.
+            num_tokens (int): The number of tokens of the dataset.
+            transaction (PyramidTransaction, optional): The transaction the update joins.
         """
+        if transaction is None:
+            with self.pyramid_store.transaction() as transaction:
+                return self._update_cell_with_model(
+                    cell, dataset, num_tokens, transaction
+                )
         h = cell["height"]
         index = cell["index"]
         cell_path = os.path.join(self.model_repo_dir, f"{h}_{index}")
 
         # Create the directory if it doesn't exist
-        if not os.path.exists(cell_path):
-            os.makedirs(cell_path)
+        os.makedirs(cell_path, exist_ok=True)
 
-        # Define the model path
-        cell["model_path"] = cell_path
-        cell["occupied"] = True
+        # The transaction holds the state refreshed under the lock, other
+        # workers may have updated the cell since it was passed in
+        current = transaction.pyramid[h][index]
         # @YoussefDo: I need to think about the logic of integrating two datasets together
         # and linking the dataset in the trajectory story to this cell
-        cell["num_tokens"] = num_tokens
+        transaction.update_cell(
+            h,
+            index,
+            model_path=cell_path,
+            occupied=True,
+            num_tokens=num_tokens,
+            dataset_path=dataset,
+            # Outputs cached for the previous model of this cell are no longer valid
+            model_version=current.get("model_version", 0) + 1,
+        )
+
+        def invalidate():
+            self.result_cache.invalidate_model(cell_path)
+            self.model_pool.invalidate(cell_path)
+
+        transaction.after_commit(invalidate)
 
         # @YoussefDo: Implement logic to train and save the model in the cell_path
         # For example:
@@ -215,19 +431,30 @@ class PartitioningModule:
 
         Args:
             test_data: trajectory test data used to find proper model and load it in memory
+
+        Returns:
+            str: The model_path of the smallest occupied cell enclosing the test data.
         """
         # Calculate the minimum bounding rectangle of all trajectories
         min_bounding_rectangle = self._calculate_mbr(test_data)
 
-        # Find the smallest cell that fully encloses this minimum bounding rectangle
-        target_cell = self._find_enclosing_cell(min_bounding_rectangle)
+        # Find the smallest cell with a model that fully encloses this minimum bounding rectangle
+        target_cell = self._find_enclosing_cell(
+            min_bounding_rectangle, occupied_only=True
+        )
         if target_cell:  # Then we found a cell that encloses this trajectory data
-            # @YoussefDo: need to load the model here
-            model_path = target_cell["model_path"]
-            # Tensorflow load model
-            print(model_path)
-        else:
-            raise ValueError(
-                "No proper model found for requested trajectory query data"
-            )
-        pass
+            return target_cell["model_path"]
+        raise ValueError("No proper model found for requested trajectory query data")
+
+    def load_proper_model(self, test_data):
+        """
+        Finds the proper model for the passed query data and returns it loaded in
+        memory, served from the model pool when it is already resident.
+
+        Args:
+            test_data: trajectory test data used to find proper model and load it in memory
+
+        Returns:
+            object: The loaded model.
+        """
+        return self.model_pool.get(self.find_proper_model(test_data))
@@ -0,0 +1,226 @@
+"""Pyramid Store Module Definition"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PyramidTransaction:
+    """
+    The cell updates of one commit, collected while the store lock is held.
+
+    Attributes:
+        pyramid (dict): The current pyramid, refreshed when the transaction started.
+        updates (list): The (height, index, fields) updates of the transaction.
+        callbacks (list): Functions called once the transaction is committed.
+    """
+
+    def __init__(self, pyramid):
+        self.pyramid = pyramid
+        self.updates = []
+        self.callbacks = []
+
+    def update_cell(self, h, index, **fields):
+        """
+        Sets fields of a cell. Updates hold absolute values, so replaying the
+        log over a snapshot that already contains them changes nothing.
+        """
+        self.updates.append({"height": int(h), "index": int(index), "fields": fields})
+        # Later updates of the same transaction see the earlier ones
+        self.pyramid[int(h)][int(index)].update(fields)
+
+    def after_commit(self, callback):
+        """Registers a function called without arguments once the commit is durable."""
+        self.callbacks.append(callback)
+
+
+class PyramidStore:
+    """
+    Persistent state of the models pyramid: a JSON snapshot plus an
+    append-only log of committed transactions.
+
+    A transaction takes an exclusive file lock, catches up with the log lines
+    written by other processes, collects any number of cell updates (e.g. from
+    many datasets) and commits them as a single appended JSON line. Once the log
+    holds `compact_every` transactions, the pyramid is written as a new snapshot
+    (atomically, through a temporary file) and the log is emptied. Readers get
+    the snapshot with the log replayed on top. A commit torn by a crash is
+    never replayed and is cut off the log by the next commit.
+
+    Attributes:
+        snapshot_path (str): The pyramid snapshot, partioningPyramid.json.
+        log_path (str): The append-only update log.
+        lock_path (str): The file locked during transactions.
+        compact_every (int): Number of logged transactions triggering a compaction.
+        pyramid (dict): height -> index -> cell, the current state.
+    """
+
+    def __init__(self, models_repo_path, compact_every=100):
+        self.snapshot_path = os.path.join(models_repo_path, "partioningPyramid.json")
+        self.log_path = os.path.join(models_repo_path, "pyramidUpdates.log")
+        self.lock_path = os.path.join(models_repo_path, "pyramid.lock")
+        self.compact_every = compact_every
+        self.pyramid = {}
+        self.logged_transactions = 0
+        self._log_offset = 0
+        self._snapshot_stamp = None
+        self._thread_lock = threading.RLock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.snapshot_path)
+
+    def _stamp(self):
+        stat = os.stat(self.snapshot_path)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _apply(self, transaction):
+        for update in transaction["updates"]:
+            self.pyramid[update["height"]][update["index"]].update(update["fields"])
+
+    def load(self) -> dict:
+        """
+        Loads the snapshot and replays the log on top of it.
+
+        Returns:
+            dict: The pyramid, height -> index -> cell, with integer keys.
+        """
+        if not self.exists():
+            raise FileNotFoundError(f"Pyramid file not found at {self.snapshot_path}")
+        with open(self.snapshot_path, "r") as file:
+            pyramid = json.load(file)
+        # JSON turns the integer heights and indices into strings
+        self.pyramid = {
+            int(h): {int(i): cell for i, cell in cells.items()}
+            for h, cells in pyramid.items()
+        }
+        self._snapshot_stamp = self._stamp()
+        self._log_offset = 0
+        self.logged_transactions = 0
+        self._replay_log()
+        return self.pyramid
+
+    def _replay_log(self):
+        # Applies the transactions appended since the last read
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path, "r") as file:
+            file.seek(self._log_offset)
+            while True:
+                line = file.readline()
+                # A line without its newline is a commit still being written
+                if not line.endswith("\n"):
+                    break
+                self._apply(json.loads(line))
+                self.logged_transactions += 1
+                self._log_offset = file.tell()
+
+    def refresh(self) -> dict:
+        """Catches up with the transactions committed by other writers."""
+        if self._snapshot_stamp is None or self._stamp() != self._snapshot_stamp:
+            return self.load()
+        self._replay_log()
+        return self.pyramid
+
+    def _write_snapshot(self, pyramid):
+        # Replaces the snapshot with the given pyramid and empties the log
+        tmp_path = f"{self.snapshot_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(pyramid, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # The log only holds updates already in the snapshot now, replaying them
+        # after a crash right here would be harmless
+        with open(self.log_path, "w"):
+            pass
+        self.pyramid = pyramid
+        self._snapshot_stamp = self._stamp()
+        self._log_offset = 0
+        self.logged_transactions = 0
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Opens a transaction on the up to date pyramid. Its updates are committed
+        as one log line when the block exits without an exception, and dropped
+        (in memory too) otherwise.
+
+        Yields:
+            PyramidTransaction: Collects the cell updates.
+        """
+        with self._locked():
+            self.refresh()
+            transaction = PyramidTransaction(self.pyramid)
+            try:
+                yield transaction
+            except BaseException:
+                # Undo the in-memory changes of the failed transaction
+                self.load()
+                raise
+            if transaction.updates:
+                self._commit(transaction)
+        for callback in transaction.callbacks:
+            callback()
+
+    def _commit(self, transaction):
+        line = json.dumps({"time": time.time(), "updates": transaction.updates})
+        # Past the last replayed line there can only be the torn commit of a
+        # writer that crashed, appending after it would garble this commit
+        if (
+            os.path.exists(self.log_path)
+            and os.path.getsize(self.log_path) > self._log_offset
+        ):
+            os.truncate(self.log_path, self._log_offset)
+        with open(self.log_path, "a") as file:
+            file.write(line + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+            self._log_offset = file.tell()
+        self.logged_transactions += 1
+        if self.logged_transactions >= self.compact_every:
+            self._write_snapshot(self.pyramid)
+
+    def compact(self):
+        """Writes the current state as the snapshot and empties the log."""
+        with self._locked():
+            self.refresh()
+            self._write_snapshot(self.pyramid)
+
+    def reset(self, pyramid):
+        """Replaces the whole state, e.g. with a pyramid built from scratch."""
+        with self._locked():
+            self._write_snapshot(pyramid)
+
+    def load_or_build(self, build, rebuild=False) -> dict:
+        """
+        Loads the pyramid, or builds it when there is no snapshot yet.
+
+        The decision is taken under the store lock, so of several writers
+        starting on an empty store only the first one builds and the others
+        load its pyramid, instead of wiping the commits made in between.
+
+        Args:
+            build (callable): Returns a new pyramid, height -> index -> cell.
+            rebuild (bool): Whether to build a new pyramid even over an existing one.
+
+        Returns:
+            dict: The pyramid.
+        """
+        with self._locked():
+            if rebuild or not self.exists():
+                self._write_snapshot(build())
+                return self.pyramid
+            return self.load()
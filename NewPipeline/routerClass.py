@@ -0,0 +1,157 @@
+"""Batch Router Module Definition"""
+
+import numpy as np
+
+from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
+
+
+def trajectories_mbrs(trajectories) -> np.ndarray:
+    """
+    Calculates the minimum bounding rectangle of every trajectory at once.
+
+    Args:
+        trajectories (TrajectoryBatch or list of list of tuples): The trajectories,
+                                               lists hold (lat, lon) tuples.
+
+    Returns:
+        np.ndarray: An (N, 4) array of (min_lat, max_lat, min_lon, max_lon) rows,
+                    empty trajectories get NaN rows.
+    """
+    if isinstance(trajectories, TrajectoryBatch):
+        return trajectories.mbrs()
+    lengths = np.fromiter((len(t) for t in trajectories), dtype=np.int64)
+    mbrs = np.full((len(lengths), 4), np.nan)
+    non_empty = lengths > 0
+    if not non_empty.any():
+        return mbrs
+    points = np.array(
+        [point for trajectory in trajectories for point in trajectory], dtype=float
+    ).reshape(-1, 2)
+    starts = (np.cumsum(lengths) - lengths)[non_empty]
+    mbrs[non_empty, 0] = np.minimum.reduceat(points[:, 0], starts)
+    mbrs[non_empty, 1] = np.maximum.reduceat(points[:, 0], starts)
+    mbrs[non_empty, 2] = np.minimum.reduceat(points[:, 1], starts)
+    mbrs[non_empty, 3] = np.maximum.reduceat(points[:, 1], starts)
+    return mbrs
+
+
+class BatchRouter:
+    """
+    Routes many test trajectories at once to the smallest occupied pyramid cell
+    enclosing each of them, instead of a single cell for the whole batch.
+
+    Cells of one height form a regular grid, so the cell holding a coordinate is
+    found with index arithmetic. A trajectory fits in a cell of height h when both
+    corners of its MBR fall in that same cell, which is checked for all
+    trajectories in one vectorized pass per height, from the finest height up.
+
+    Attributes:
+        partitioning_module (PartitioningModule): The module owning the pyramid
+                                                  and the model pool.
+        occupied (dict): height -> boolean array telling which cells hold a model.
+    """
+
+    def __init__(self, partitioning_module):
+        """
+        Initializes the router from the current state of the pyramid.
+
+        Args:
+            partitioning_module (PartitioningModule): The module owning the pyramid.
+        """
+        self.partitioning_module = partitioning_module
+        self.occupied = {}
+        self.refresh()
+
+    def refresh(self):
+        """
+        Rebuilds the occupancy arrays, to be called after the pyramid got updated.
+        """
+        self.occupied = {}
+        for h, cells in self.partitioning_module.pyramid.items():
+            occupied = np.zeros(4 ** int(h), dtype=bool)
+            for index, cell in cells.items():
+                occupied[int(index)] = bool(cell["occupied"])
+            self.occupied[int(h)] = occupied
+
+    def route_mbrs(self, mbrs) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Assigns each MBR to its smallest enclosing occupied cell.
+
+        Args:
+            mbrs (np.ndarray): An (N, 4) array of (min_lat, max_lat, min_lon, max_lon).
+
+        Returns:
+            tuple: (heights, indices) int arrays of length N, -1 where no occupied
+                   cell encloses the MBR.
+        """
+        mbrs = np.asarray(mbrs, dtype=float).reshape(-1, 4)
+        heights = np.full(len(mbrs), -1, dtype=np.int64)
+        indices = np.full(len(mbrs), -1, dtype=np.int64)
+        unassigned = ~np.isnan(mbrs).any(axis=1)
+        for h in sorted(self.occupied, reverse=True):
+            if not unassigned.any():
+                break
+            if not self.occupied[h].any():
+                continue
+            low = self.partitioning_module.cell_indices(mbrs[:, 0], mbrs[:, 2], h)
+            high = self.partitioning_module.cell_indices(mbrs[:, 1], mbrs[:, 3], h)
+            fits = unassigned & (low >= 0) & (low == high)
+            fits[fits] = self.occupied[h][low[fits]]
+            heights[fits] = h
+            indices[fits] = low[fits]
+            unassigned &= ~fits
+        return heights, indices
+
+    def route(self, trajectories) -> dict:
+        """
+        Groups trajectories by the cell that should serve them.
+
+        Args:
+            trajectories (list of list of tuples): The (lat, lon) test trajectories.
+
+        Returns:
+            dict: (height, index) -> list of trajectory positions, trajectories
+                  no model can serve are grouped under None.
+        """
+        heights, indices = self.route_mbrs(trajectories_mbrs(trajectories))
+        groups = {}
+        order = np.lexsort((indices, heights))
+        keys = np.stack((heights[order], indices[order]), axis=1)
+        if len(keys) == 0:
+            return groups
+        boundaries = np.flatnonzero((keys[1:] != keys[:-1]).any(axis=1)) + 1
+        for chunk in np.split(order, boundaries):
+            h, index = int(heights[chunk[0]]), int(indices[chunk[0]])
+            key = None if h < 0 else (h, index)
+            groups[key] = chunk.tolist()
+        return groups
+
+    def dispatch(self, trajectories, run_batch):
+        """
+        Routes the trajectories and runs each group through its model in one call.
+
+        Args:
+            trajectories (list): The (lat, lon) test trajectories.
+            run_batch (callable): Called as run_batch(model, batch) for every cell,
+                                  must return one output per trajectory of the batch.
+
+        Returns:
+            list: The outputs in the order of the input trajectories.
+        """
+        outputs = [None] * len(trajectories)
+        for key, positions in self.route(trajectories).items():
+            if key is None:
+                raise ValueError(
+                    f"No proper model found for {len(positions)} requested trajectories"
+                )
+            h, index = key
+            cell = self.partitioning_module.pyramid[h][index]
+            model = self.partitioning_module.model_pool.get_for_cell(cell)
+            if isinstance(trajectories, TrajectoryBatch):
+                batch = trajectories.take(positions)
+            else:
+                batch = [trajectories[i] for i in positions]
+            batch_outputs = run_batch(model, batch)
+            for position, output in zip(positions, batch_outputs):
+                outputs[position] = output
+        return outputs
@@ -0,0 +1,145 @@
+"""Dataset Splitter Module Definition"""
+
+import os
+import pickle
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
+
+
+class DatasetSplitter:
+    """
+    Distributes the trajectories of a dataset over the finest pyramid cells that
+    can hold a model, instead of handing the whole dataset to the smallest cell
+    enclosing all of it.
+
+    A cell of height h can hold a model once it gets at least
+    tokens_threshold_per_cell * 4**(H - h) tokens. Every trajectory can go to any
+    cell enclosing its MBR. Starting from the cell enclosing the dataset, the
+    trajectories fully inside a child cell are always pushed down to it, down to
+    the finest cells, since data too sparse for a coarse cell can still be dense
+    enough for the finer ones (thresholds shrink 4x per level). The decision is
+    made on the way back up: a cell keeps what is left for it when it meets its
+    threshold, otherwise the leftovers (with the trajectories crossing its child
+    borders) roll up to the parent.
+
+    Attributes:
+        partitioning_module (PartitioningModule): The module owning the pyramid.
+    """
+
+    def __init__(self, partitioning_module):
+        """
+        Args:
+            partitioning_module (PartitioningModule): The module owning the pyramid.
+        """
+        self.partitioning_module = partitioning_module
+
+    def threshold(self, h) -> int:
+        module = self.partitioning_module
+        return module.tokens_threshold_per_cell * 4 ** (module.pyramid_height - h)
+
+    def split(self, trajectories) -> tuple[dict, np.ndarray]:
+        """
+        Assigns every trajectory to a pyramid cell.
+
+        Args:
+            trajectories (TrajectoryBatch or list): The tokenized (or raw) trajectories.
+
+        Returns:
+            tuple: ({(height, index): int array of trajectory positions}, int array
+                   of the positions no cell could take, i.e. empty trajectories or
+                   data too sparse for any enclosing cell).
+        """
+        module = self.partitioning_module
+        batch = TrajectoryBatch.coerce(trajectories)
+        mbrs = batch.mbrs()
+        tokens = batch.lengths()
+        valid = ~np.isnan(mbrs).any(axis=1)
+        positions = np.flatnonzero(valid)
+        if not len(positions):
+            return {}, np.arange(len(batch))
+
+        # The cell of every height fully enclosing each trajectory, -1 if none
+        cells_at = {}
+        for h in range(module.pyramid_height + 1):
+            low = module.cell_indices(mbrs[:, 0], mbrs[:, 2], h)
+            high = module.cell_indices(mbrs[:, 1], mbrs[:, 3], h)
+            cells_at[h] = np.where(valid & (low == high), low, -1)
+
+        top = module._find_enclosing_cell(batch.mbr())
+        if top is None:
+            return {}, np.arange(len(batch))
+
+        def visit(h, index, members):
+            assigned, leftovers = {}, []
+            if h < module.pyramid_height:
+                children = cells_at[h + 1][members]
+                leftovers.append(members[children < 0])
+                for child in np.unique(children[children >= 0]).tolist():
+                    child_members = members[children == child]
+                    child_assigned, child_left = visit(h + 1, child, child_members)
+                    assigned.update(child_assigned)
+                    leftovers.append(child_left)
+                left = np.concatenate(leftovers)
+            else:
+                left = members
+            if len(left) and tokens[left].sum() >= self.threshold(h):
+                assigned[(h, index)] = np.sort(left)
+                left = left[:0]
+            return assigned, left
+
+        assigned, left = visit(top["height"], top["index"], positions)
+        unassigned = np.sort(np.concatenate([left, np.flatnonzero(~valid)]))
+        return assigned, unassigned
+
+    def write_sub_datasets(self, dataset, assigned, max_workers=4, tag=None) -> dict:
+        """
+        Writes the sub-dataset and metadata of every assigned cell into its cell
+        directory of the models repository, in parallel.
+
+        Args:
+            dataset (TrajectoryBatch or list): The dataset that was split.
+            assigned (dict): The assignment returned by split.
+            max_workers (int): Number of sub-datasets written at the same time.
+            tag (str, optional): Suffix of the file names, dataset_<tag>.pkl and
+                                 metadata_<tag>.txt instead of dataset.pkl and metadata.txt.
+
+        Returns:
+            dict: (height, index) -> (data path, metadata path, number of tokens).
+        """
+        module = self.partitioning_module
+
+        def write(key):
+            h, index = key
+            positions = assigned[key]
+            if isinstance(dataset, TrajectoryBatch):
+                sub_dataset = dataset.take(positions)
+                num_tokens = sub_dataset.num_points
+            else:
+                sub_dataset = [dataset[i] for i in positions.tolist()]
+                num_tokens = sum(len(trajectory) for trajectory in sub_dataset)
+            cell_path = os.path.join(module.model_repo_dir, f"{h}_{index}")
+            os.makedirs(cell_path, exist_ok=True)
+            suffix = f"_{tag}" if tag else ""
+            data_path = os.path.join(cell_path, f"dataset{suffix}.pkl")
+            with open(data_path, "wb") as f:
+                pickle.dump(sub_dataset, f)
+            metadata = {
+                "total_number_of_trajectories": len(positions),
+                "total_number_of_tokens": num_tokens,
+                "date_of_data_storage": datetime.datetime.now().strftime(
+                    "%Y-%m-%d %H:%M"
+                ),
+                "type_of_data": "",
+            }
+            metadata_path = os.path.join(cell_path, f"metadata{suffix}.txt")
+            with open(metadata_path, "w") as f:
+                for name, value in metadata.items():
+                    f.write(f"{name}: {value}\n")
+            return key, (data_path, metadata_path, num_tokens)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return dict(executor.map(write, list(assigned)))
@@ -0,0 +1,335 @@
+"""Token Codec Module Definition"""
+
+import lzma
+import mmap
+import struct
+import time
+import zlib
+
+import numpy as np
+
+from TrajPipeline.NewPipeline.trajectoryBatchClass import (
+    TrajectoryBatch,
+    tokens_to_ints,
+)
+
+MAGIC = b"H3TZ"
+# magic, version, compression, number of trajectories, number of blocks
+HEADER = struct.Struct("<4sBBQQ")
+COMPRESSIONS = {"none": 0, "zlib": 1, "lzma": 2}
+
+
+def encode_varints(values: np.ndarray) -> np.ndarray:
+    """
+    LEB128 encodes uint64 values, 7 bits per byte with the high bit set on all
+    but the last byte of a value.
+
+    Returns:
+        np.ndarray: The uint8 encoded bytes.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        sizes += values >= np.uint64(1) << np.uint64(7 * k)
+    starts = np.zeros(len(values), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    out = np.empty(int(sizes.sum()), dtype=np.uint8)
+    for k in range(10):
+        present = sizes > k
+        if not present.any():
+            break
+        byte = (values[present] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (sizes[present] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[starts[present] + k] = (byte | more).astype(np.uint8)
+    return out
+
+
+def decode_varints(data: np.ndarray) -> np.ndarray:
+    """Inverse of encode_varints."""
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.array([], dtype=np.uint64)
+    ends = np.flatnonzero(data < 0x80)
+    starts = np.r_[0, ends[:-1] + 1]
+    owners = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = (np.arange(len(data)) - starts[owners]).astype(np.uint64) * np.uint64(7)
+    parts = (data & 0x7F).astype(np.uint64) << shifts
+    return np.add.reduceat(parts, starts)
+
+
+def delta_encode(tokens: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """
+    XORs every cell id with the previous one of its trajectory. Neighbouring
+    cells share the resolution, base cell and leading digits, so only the low
+    bits survive. The first cell of a trajectory is kept whole.
+    """
+    deltas = tokens.copy()
+    deltas[1:] ^= tokens[:-1]
+    firsts = offsets[:-1][np.diff(offsets) > 0]
+    deltas[firsts] = tokens[firsts]
+    return deltas
+
+
+def delta_decode(deltas: np.ndarray, offsets: np.ndarray) -> np.ndarray:
+    """Inverse of delta_encode."""
+    if not len(deltas):
+        return deltas
+    prefix = np.bitwise_xor.accumulate(deltas)
+    # The running XOR of everything before a trajectory cancels out
+    before = np.zeros(len(offsets) - 1, dtype=np.uint64)
+    starts = offsets[:-1]
+    inner = starts > 0
+    before[inner] = prefix[starts[inner] - 1]
+    lengths = np.diff(offsets)
+    return prefix ^ np.repeat(before, lengths)
+
+
+class TokenStreamCodec:
+    """
+    Compact binary format for the H3 token streams of a dataset.
+
+    Tokens are XOR-delta encoded within their trajectory and written as
+    varints, 1 to 3 bytes per token for ordinary trajectories instead of 16
+    bytes of hex text. The trajectories are grouped in blocks of about
+    block_size encoded bytes, each optionally compressed with zlib or lzma, and
+    an index maps every trajectory to its block and byte offset, so a single
+    trajectory is read by decoding a single block.
+
+    Attributes:
+        compression (str): 'none', 'zlib' or 'lzma'.
+        block_size (int): Target number of encoded bytes per block.
+        level (int): Compression level passed to zlib or lzma.
+    """
+
+    def __init__(self, compression="zlib", block_size=1 << 16, level=6):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown token stream compression: {compression}")
+        self.compression = compression
+        self.block_size = block_size
+        self.level = level
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "zlib":
+            return zlib.compress(data, self.level)
+        if self.compression == "lzma":
+            return lzma.compress(data, preset=self.level)
+        return data
+
+    def encode(self, trajectories) -> bytes:
+        """
+        Encodes a tokenized batch or lists of H3 tokens.
+
+        Returns:
+            bytes: The encoded dataset, read back with TokenStreamReader.
+        """
+        tokens, offsets = _token_columns(trajectories)
+        encoded = encode_varints(delta_encode(tokens, offsets))
+        # Byte offset of every trajectory in the encoded stream
+        token_bytes = np.zeros(len(tokens) + 1, dtype=np.int64)
+        token_bytes[1:] = np.flatnonzero(encoded < 0x80) + 1
+        byte_offsets = token_bytes[offsets]
+        # Trajectories are never split between blocks
+        block_of = byte_offsets[:-1] // self.block_size
+        _, first_trajectories = np.unique(block_of, return_index=True)
+        block_starts = np.r_[first_trajectories, len(offsets) - 1].astype(np.int64)
+        blocks = [
+            self._compress(encoded[byte_offsets[a] : byte_offsets[b]].tobytes())
+            for a, b in zip(block_starts[:-1].tolist(), block_starts[1:].tolist())
+        ]
+        block_bytes = np.zeros(len(blocks) + 1, dtype=np.uint64)
+        np.cumsum([len(block) for block in blocks], out=block_bytes[1:])
+        header = HEADER.pack(
+            MAGIC, 1, COMPRESSIONS[self.compression], len(offsets) - 1, len(blocks)
+        )
+        return b"".join(
+            [
+                header,
+                offsets.astype(np.uint64).tobytes(),
+                byte_offsets.astype(np.uint64).tobytes(),
+                block_starts.astype(np.uint64).tobytes(),
+                block_bytes.tobytes(),
+            ]
+            + blocks
+        )
+
+    def write(self, path, trajectories) -> int:
+        """Writes an encoded dataset, returns its size in bytes."""
+        data = self.encode(trajectories)
+        with open(path, "wb") as file:
+            file.write(data)
+        return len(data)
+
+
+def _token_columns(trajectories):
+    if isinstance(trajectories, TrajectoryBatch):
+        if trajectories.tokens is None:
+            raise ValueError("The batch is not tokenized")
+        return trajectories.tokens, trajectories.offsets
+    lengths = np.fromiter((len(t) for t in trajectories), dtype=np.int64)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    tokens = tokens_to_ints(token for tokens in trajectories for token in tokens)
+    return tokens, offsets
+
+
+class TokenStreamReader:
+    """
+    Reads an encoded dataset, from bytes or from a file. Only the index is read
+    up front, trajectories are decoded from their block on access and the last
+    decoded block is kept.
+    """
+
+    def __init__(self, source):
+        """
+        Args:
+            source (str or bytes): The path of an encoded file or its content.
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            self.data = memoryview(source)
+        else:
+            # Mapped, the blocks are read from disk when they are decoded
+            with open(source, "rb") as file:
+                self.data = memoryview(
+                    mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+        magic, version, compression, count, num_blocks = HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != 1:
+            raise ValueError("Not an encoded H3 token stream")
+        self.compression = {code: name for name, code in COMPRESSIONS.items()}[
+            compression
+        ]
+        position = HEADER.size
+
+        def array(length):
+            nonlocal position
+            values = np.frombuffer(self.data, np.uint64, length, position)
+            position += 8 * length
+            return values.astype(np.int64)
+
+        self.offsets = array(count + 1)
+        self.byte_offsets = array(count + 1)
+        self.block_starts = array(num_blocks + 1)
+        self.block_bytes = array(num_blocks + 1)
+        self.payload_start = position
+        self._cached_block, self._cached_data = None, None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_tokens(self) -> int:
+        return int(self.offsets[-1])
+
+    def _decompress(self, data: bytes) -> bytes:
+        if self.compression == "zlib":
+            return zlib.decompress(data)
+        if self.compression == "lzma":
+            return lzma.decompress(data)
+        return data
+
+    def _block(self, block):
+        if block != self._cached_block:
+            start = self.payload_start + self.block_bytes[block]
+            end = self.payload_start + self.block_bytes[block + 1]
+            self._cached_data = np.frombuffer(
+                self._decompress(bytes(self.data[start:end])), dtype=np.uint8
+            )
+            self._cached_block = block
+        return self._cached_data
+
+    def token_values(self, i) -> np.ndarray:
+        """The uint64 tokens of trajectory i, decoding only its block."""
+        if not 0 <= i < len(self):
+            raise IndexError("trajectory index out of range")
+        block = int(np.searchsorted(self.block_starts, i, side="right") - 1)
+        first = self.block_starts[block]
+        data = self._block(block)
+        base = self.byte_offsets[first]
+        deltas = decode_varints(
+            data[self.byte_offsets[i] - base : self.byte_offsets[i + 1] - base]
+        )
+        return np.bitwise_xor.accumulate(deltas) if len(deltas) else deltas
+
+    def token_list(self, i) -> list[str]:
+        return [format(value, "x") for value in self.token_values(i).tolist()]
+
+    def __getitem__(self, i):
+        return self.token_list(i)
+
+    def tokens(self) -> np.ndarray:
+        """All tokens, decoded in one vectorized pass."""
+        data = np.concatenate(
+            [self._block(b) for b in range(len(self.block_starts) - 1)]
+            or [np.array([], dtype=np.uint8)]
+        )
+        return delta_decode(decode_varints(data), self.offsets)
+
+    def to_batch(self) -> TrajectoryBatch:
+        """
+        All trajectories as a tokenized batch, the points being the centroids
+        of the cells (the stream keeps no coordinates).
+        """
+        import h3
+
+        tokens = self.tokens()
+        centroids = np.array(
+            [h3.h3_to_geo(format(value, "x")) for value in tokens.tolist()],
+            dtype=np.float64,
+        ).reshape(-1, 2)
+        return TrajectoryBatch(
+            centroids[:, 0], centroids[:, 1], self.offsets, tokens=tokens
+        )
+
+
+def read_token_file(path) -> TrajectoryBatch:
+    """Loads an encoded token file of the trajectory store as a batch."""
+    return TokenStreamReader(path).to_batch()
+
+
+def compression_report(trajectories, compressions=("none", "zlib", "lzma"), repeat=3):
+    """
+    Measures the size and speed of the codec on a tokenized dataset.
+
+    Args:
+        trajectories (TrajectoryBatch or list of list of str): The tokenized dataset.
+        compressions (tuple of str): The block compressions to measure.
+        repeat (int): Number of timed runs, the fastest is reported.
+
+    Returns:
+        dict: compression -> {"bytes", "bytes_per_token", "ratio_vs_text",
+              "ratio_vs_uint64", "encode_tokens_per_sec", "decode_tokens_per_sec",
+              "random_access_per_sec"}. The text baseline is 16 bytes per token
+              (15 hex digits and a separator), uint64 is 8 bytes per token.
+    """
+    tokens, _ = _token_columns(trajectories)
+    num_tokens = max(len(tokens), 1)
+    report = {}
+    for compression in compressions:
+        codec = TokenStreamCodec(compression)
+        encode_seconds = decode_seconds = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            data = codec.encode(trajectories)
+            encode_seconds = min(encode_seconds, time.perf_counter() - start)
+            start = time.perf_counter()
+            decoded = TokenStreamReader(data).tokens()
+            decode_seconds = min(decode_seconds, time.perf_counter() - start)
+        if not np.array_equal(decoded, tokens):
+            raise AssertionError(f"The {compression} token stream does not round trip")
+        reader = TokenStreamReader(data)
+        rng = np.random.default_rng(0)
+        picks = rng.integers(0, len(reader), size=min(1000, len(reader))).tolist()
+        start = time.perf_counter()
+        for i in picks:
+            reader.token_values(i)
+        access_seconds = time.perf_counter() - start
+        report[compression] = {
+            "bytes": len(data),
+            "bytes_per_token": len(data) / num_tokens,
+            "ratio_vs_text": 16 * num_tokens / len(data),
+            "ratio_vs_uint64": 8 * num_tokens / len(data),
+            "encode_tokens_per_sec": num_tokens / max(encode_seconds, 1e-9),
+            "decode_tokens_per_sec": num_tokens / max(decode_seconds, 1e-9),
+            "random_access_per_sec": len(picks) / max(access_seconds, 1e-9),
+        }
+    return report
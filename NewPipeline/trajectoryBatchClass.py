@@ -0,0 +1,263 @@
+"""Trajectory Batch Module Definition"""
+
+import numpy as np
+
+
+def tokens_to_ints(tokens) -> np.ndarray:
+    """Converts H3 tokens (hex strings) to a uint64 array."""
+    return np.fromiter((int(token, 16) for token in tokens), dtype=np.uint64)
+
+
+def ints_to_tokens(values) -> list[str]:
+    """Converts a uint64 array back to H3 tokens."""
+    return [format(value, "x") for value in values.tolist()]
+
+
+class TrajectoryBatch:
+    """
+    A batch of trajectories stored column wise in flat arrays.
+
+    The points of trajectory i are the rows offsets[i]:offsets[i + 1] of every
+    point array, so a trajectory costs two float64 coordinates (plus a uint64
+    token once tokenized) per point instead of a tuple of Python floats, and can
+    be sliced without copying.
+
+    Attributes:
+        lat (np.ndarray): float64 latitudes of all points.
+        lon (np.ndarray): float64 longitudes of all points.
+        offsets (np.ndarray): int64 array of length n + 1 with the start of each trajectory.
+        ids (list): Optional identifier of every trajectory.
+        timestamps (np.ndarray): Optional float64 timestamp of every point.
+        tokens (np.ndarray): Optional uint64 H3 token of every point.
+    """
+
+    def __init__(self, lat, lon, offsets, ids=None, timestamps=None, tokens=None):
+        """
+        Initializes the batch from its arrays.
+
+        Args:
+            lat (array-like): Latitudes of all points.
+            lon (array-like): Longitudes of all points.
+            offsets (array-like): Start of each trajectory, followed by the number of points.
+            ids (list, optional): Identifier of every trajectory.
+            timestamps (array-like, optional): Timestamp of every point.
+            tokens (array-like, optional): H3 token of every point as uint64.
+        """
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ids = list(ids) if ids is not None else None
+        self.timestamps = (
+            np.asarray(timestamps, dtype=np.float64) if timestamps is not None else None
+        )
+        self.tokens = (
+            np.asarray(tokens, dtype=np.uint64) if tokens is not None else None
+        )
+        if len(self.lat) != len(self.lon) or self.offsets[-1] != len(self.lat):
+            raise ValueError("Point arrays and offsets of the batch do not match")
+
+    @classmethod
+    def from_lists(cls, trajectories, ids=None):
+        """
+        Builds a batch from the legacy list form.
+
+        Args:
+            trajectories (list of list of tuples): Trajectories of (lat, lon) or
+                                                   (lat, lon, timestamp) tuples.
+            ids (list, optional): Identifier of every trajectory.
+
+        Returns:
+            TrajectoryBatch: The batch.
+        """
+        lengths = np.fromiter((len(t) for t in trajectories), dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        width = len(trajectories[lengths.argmax()][0]) if lengths.any() else 2
+        points = np.array(
+            [point for trajectory in trajectories for point in trajectory],
+            dtype=np.float64,
+        ).reshape(-1, width)
+        timestamps = points[:, 2] if width > 2 else None
+        return cls(points[:, 0], points[:, 1], offsets, ids, timestamps)
+
+    @classmethod
+    def from_token_lists(cls, tokenized_trajectories, ids=None):
+        """
+        Builds a batch from lists of H3 tokens, the points being their centroids.
+        """
+        import h3
+
+        lengths = np.fromiter((len(t) for t in tokenized_trajectories), dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = [token for tokens in tokenized_trajectories for token in tokens]
+        centroids = np.array(
+            [h3.h3_to_geo(token) for token in flat], dtype=np.float64
+        ).reshape(-1, 2)
+        return cls(
+            centroids[:, 0], centroids[:, 1], offsets, ids, tokens=tokens_to_ints(flat)
+        )
+
+    @classmethod
+    def coerce(cls, trajectories):
+        """
+        Returns trajectories as a TrajectoryBatch, converting the legacy list forms.
+        """
+        if isinstance(trajectories, cls):
+            return trajectories
+        trajectories = list(trajectories)
+        first = next((t for t in trajectories if len(t)), None)
+        if first is not None and isinstance(first[0], str):
+            return cls.from_token_lists(trajectories)
+        return cls.from_lists(trajectories)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_points(self) -> int:
+        return int(self.offsets[-1])
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the arrays of the batch."""
+        arrays = [self.lat, self.lon, self.offsets, self.timestamps, self.tokens]
+        return sum(array.nbytes for array in arrays if array is not None)
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def points(self, i):
+        """Returns the (lat, lon) arrays of trajectory i without copying."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.lat[start:end], self.lon[start:end]
+
+    def token_values(self, i) -> np.ndarray:
+        """Returns the uint64 tokens of trajectory i without copying."""
+        if self.tokens is None:
+            raise ValueError("The batch is not tokenized")
+        return self.tokens[self.offsets[i] : self.offsets[i + 1]]
+
+    def token_list(self, i) -> list[str]:
+        return ints_to_tokens(self.token_values(i))
+
+    def __getitem__(self, key):
+        """
+        batch[i] is trajectory i as a batch of one, batch[a:b] the trajectories
+        a to b. Both share the arrays of this batch.
+        """
+        if isinstance(key, slice):
+            first, last, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("Only contiguous slices share the batch arrays")
+        else:
+            first = key + len(self) if key < 0 else key
+            if not 0 <= first < len(self):
+                raise IndexError("trajectory index out of range")
+            last = first + 1
+        last = max(first, last)
+        start, end = self.offsets[first], self.offsets[last]
+
+        def view(array):
+            return array[start:end] if array is not None else None
+
+        return TrajectoryBatch(
+            view(self.lat),
+            view(self.lon),
+            self.offsets[first : last + 1] - start,
+            self.ids[first:last] if self.ids is not None else None,
+            view(self.timestamps),
+            view(self.tokens),
+        )
+
+    def take(self, positions):
+        """Returns a new batch with the trajectories at the given positions."""
+        positions = np.asarray(positions, dtype=np.int64)
+        lengths = self.lengths()[positions]
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        rows = np.concatenate(
+            [np.arange(self.offsets[i], self.offsets[i + 1]) for i in positions]
+            or [np.array([], dtype=np.int64)]
+        )
+
+        def pick(array):
+            return array[rows] if array is not None else None
+
+        return TrajectoryBatch(
+            self.lat[rows],
+            self.lon[rows],
+            offsets,
+            [self.ids[i] for i in positions] if self.ids is not None else None,
+            pick(self.timestamps),
+            pick(self.tokens),
+        )
+
+    def tolist(self, i):
+        """Returns trajectory i as a list of (lat, lon) tuples."""
+        lat, lon = self.points(i)
+        return list(zip(lat.tolist(), lon.tolist()))
+
+    def to_lists(self) -> list[list[tuple[float, float]]]:
+        """Returns the batch in the legacy list of (lat, lon) tuples form."""
+        lat, lon = self.lat.tolist(), self.lon.tolist()
+        bounds = self.offsets.tolist()
+        return [
+            list(zip(lat[start:end], lon[start:end]))
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+
+    def to_token_lists(self) -> list[list[str]]:
+        """Returns the tokens in the legacy list of H3 tokens form."""
+        if self.tokens is None:
+            raise ValueError("The batch is not tokenized")
+        tokens = ints_to_tokens(self.tokens)
+        bounds = self.offsets.tolist()
+        return [tokens[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def tokenize(self, resolution: int = 10):
+        """
+        Fills the token column with the H3 cell of every point.
+
+        Returns:
+            TrajectoryBatch: The batch itself.
+        """
+        import h3
+
+        self.tokens = tokens_to_ints(
+            h3.geo_to_h3(lat, lon, resolution)
+            for lat, lon in zip(self.lat.tolist(), self.lon.tolist())
+        )
+        return self
+
+    def mbr(self) -> tuple:
+        """
+        Returns the minimum bounding rectangle of the whole batch as
+        (min_lat, max_lat, min_lon, max_lon).
+        """
+        if not self.num_points:
+            inf = float("inf")
+            return (inf, -inf, inf, -inf)
+        return (
+            float(self.lat.min()),
+            float(self.lat.max()),
+            float(self.lon.min()),
+            float(self.lon.max()),
+        )
+
+    def mbrs(self) -> np.ndarray:
+        """
+        Returns an (N, 4) array with the MBR of every trajectory, NaN rows for
+        empty trajectories.
+        """
+        lengths = self.lengths()
+        mbrs = np.full((len(self), 4), np.nan)
+        non_empty = lengths > 0
+        if not non_empty.any():
+            return mbrs
+        starts = self.offsets[:-1][non_empty]
+        mbrs[non_empty, 0] = np.minimum.reduceat(self.lat, starts)
+        mbrs[non_empty, 1] = np.maximum.reduceat(self.lat, starts)
+        mbrs[non_empty, 2] = np.minimum.reduceat(self.lon, starts)
+        mbrs[non_empty, 3] = np.maximum.reduceat(self.lon, starts)
+        return mbrs
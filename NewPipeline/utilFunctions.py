@@ -1,19 +1,18 @@
-# Use this subroutine to install a package to make sure it will be imported successfully
+# Dependencies are installed once with `python installPackages.py`, not on import
 import math
 import pickle
 import os
+import threading
 import h3
 import numpy as np
-from installPackages import install_package
+from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
 
-# """Install a package before importing it"""
-install_package("h3")
-install_package("os")
-install_package("pickle")
-install_package("math")
-install_package("numpy")
-install_package("logging")
-install_package("warnings")
+# Detokenization strategies turning a token back into a point, from the fastest to
+# the most precise: the H3 cell center, the centroid of the data seen in the cell,
+# the centroid of the bearing cluster matching the incoming direction, and the
+# clusters only for the cells where they move the point by at least
+# hybrid_min_shift meters (see DeTokenizer)
+DETOKENIZATION_TIERS = ("h3_centroid", "data_centroid", "cluster_centroid", "hybrid")
 
 
 def token2centroid_h3_yx(lat: float, lon: float, res: int) -> str:
@@ -57,30 +56,111 @@ def tokenize_trajectory(
     return tokens
 
 
-def detokenize_trajectory(tokenized_trajectory: list[str]) -> list[tuple[float, float]]:
+def haversine_meters(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """
+    Vectorized great circle distance in meters between two sets of points.
+    """
+    lat1, lon1, lat2, lon2 = (
+        np.radians(np.asarray(value, dtype=np.float64))
+        for value in (lat1, lon1, lat2, lon2)
+    )
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def select_hybrid_cells(h3_clusters, h3_kmeans, min_shift) -> set:
+    """
+    Selects the cells where the hybrid tier uses the clustering model.
+
+    Args:
+        h3_clusters (dict): The data centroid and point count per H3 token.
+        h3_kmeans (dict): The (model, means) clustering per H3 token.
+        min_shift (float): Minimum mean distance in meters between the cluster
+                           means and the data centroid of a cell.
+
+    Returns:
+        set: The tokens whose clustering model moves the points by at least
+             min_shift meters on average.
+    """
+    cells = set()
+    for token, (_, means) in h3_kmeans.items():
+        cluster = h3_clusters.get(token)
+        if cluster is None or cluster["current_count"] <= 20:
+            continue
+        means = np.asarray(means, dtype=np.float64)
+        shifts = haversine_meters(means[:, 1], means[:, 0], cluster["y"], cluster["x"])
+        weights = means[:, 2] if means[:, 2].sum() > 0 else None
+        if np.average(shifts, weights=weights) >= min_shift:
+            cells.add(token)
+    return cells
+
+
+def detokenize_trajectory(
+    tokenized_trajectory: list[str], tier: str = "cluster_centroid"
+) -> list[tuple[float, float]]:
     """
     Detokenizes a list of H3 tokens into a list of (latitude, longitude) tuples.
 
     Args:
         tokenized_trajectory (list of str): A list of H3 tokens (strings) representing a trajectory.
-        bertImputerInstance: An instance of the class that contains the token2point_cluster_centroid method.
+        tier (str): The detokenization strategy, one of DETOKENIZATION_TIERS.
 
     Returns:
         list of tuples: A list of tuples where each tuple contains two floats representing (latitude, longitude).
     """
+    token2point = get_detokenizer().tier_function(tier)
     detokenized_trajectory = []
     previous_point = None
 
     for token in tokenized_trajectory:
         if h3.h3_is_valid(token):
-            point = DeTokenizer.token2point_cluster_centroid(token, previous_point)
+            point = token2point(token, previous_point)
             previous_point = point
             detokenized_trajectory.append((round(point.y, 6), round(point.x, 6)))
 
     return detokenized_trajectory
 
 
+def detokenize_batch(
+    batch: TrajectoryBatch, tier: str = "cluster_centroid"
+) -> TrajectoryBatch:
+    """
+    Detokenizes the token column of a batch.
+
+    Args:
+        batch (TrajectoryBatch): A tokenized batch.
+        tier (str): The detokenization strategy, one of DETOKENIZATION_TIERS.
+
+    Returns:
+        TrajectoryBatch: A batch with the same offsets, ids and tokens whose points
+                         are the detokenized coordinates.
+    """
+    token2point = get_detokenizer().tier_function(tier)
+    tokens = batch.to_token_lists()
+    lat = np.empty(batch.num_points)
+    lon = np.empty(batch.num_points)
+    position = 0
+    for trajectory_tokens in tokens:
+        previous_point = None
+        for token in trajectory_tokens:
+            point = token2point(token, previous_point)
+            previous_point = point
+            lat[position], lon[position] = round(point.y, 6), round(point.x, 6)
+            position += 1
+    return TrajectoryBatch(
+        lat, lon, batch.offsets, batch.ids, batch.timestamps, batch.tokens
+    )
+
+
 def load_tokenized_trajectories(pickle_file_path):
+    # Datasets stored with the token codec (see tokenCodecClass) end in .h3z
+    if pickle_file_path.endswith(".h3z"):
+        from TrajPipeline.NewPipeline.tokenCodecClass import read_token_file
+
+        return read_token_file(pickle_file_path)
     with open(pickle_file_path, "rb") as f:
         tokenized_trajectories = pickle.load(f)
     return tokenized_trajectories
@@ -90,8 +170,10 @@ def load_metadata(metadata_file_path):
     metadata = {}
     with open(metadata_file_path, "r") as f:
         for line in f:
-            key, value = line.strip().split(": ", 1)
-            metadata[key] = value
+            # Empty values are written as "key: ", the trailing space is stripped
+            key, separator, value = line.partition(":")
+            if separator:
+                metadata[key.strip()] = value.strip()
     return metadata
 
 
@@ -153,12 +235,17 @@ class DeTokenizer(object):
     precomputed cluster centroids from a dataset.
     3. Cluster centroid method: Converts tokens to geographical points using
     clustering models, adjusting the results based on previous points.
+    4. Hybrid method: The cluster centroid method for the cells where the clusters
+    move the points by at least hybrid_min_shift meters on average, the data
+    centroid method elsewhere.
 
     Attributes:
         h3_clusters (dict): A dictionary mapping H3 tokens to cluster data,
         including 'x' and 'y' coordinates.
         h3_kmeans (dict): A dictionary mapping H3 tokens to clustering models
         used for predicting points.
+        hybrid_min_shift (float): Mean shift in meters from the data centroid a
+        cluster model must cause to be used by the hybrid method.
 
     Methods:
         token2point_h3_centroid(token):
@@ -168,25 +255,74 @@ class DeTokenizer(object):
         token2point_cluster_centroid(token, previous_point):
             Converts an H3 token to a geographical point using clustering models
             and adjusts based on previous points.
+        token2point_hybrid(token, previous_point):
+            Uses the clustering model of the token only where it matters.
+        tier_function(tier):
+            Returns the token2point method of a detokenization tier.
     """
 
-    def __init__(self):
+    def __init__(self, hybrid_min_shift: float = 5.0):
         # adjust data dir as needed.
         # data_dir = "."
-        data_dir = os.path.dirname(os.path.abspath(__file__))
-        with open(f"{data_dir}/h3_clusters.pkl", "rb") as file:
-            self.h3_clusters = pickle.load(file)
-        with open(
-            f"{data_dir}/h3_kmeans_clustering_all_models_precise.pkl", "rb"
-        ) as file:
-            self.h3_kmeans = pickle.load(file)
-
-    def token2point_h3_centroid(self, token):
+        self.data_dir = os.path.dirname(os.path.abspath(__file__))
+        # The pickles (the k-means ones need scikit-learn) are loaded on first use
+        self._h3_clusters, self._h3_kmeans = None, None
+        self._lock = threading.Lock()
+        self.hybrid_min_shift = hybrid_min_shift
+        self._hybrid_cells = None
+
+    def _load(self, filename):
+        with open(os.path.join(self.data_dir, filename), "rb") as file:
+            return pickle.load(file)
+
+    @property
+    def h3_clusters(self):
+        """Cluster data per H3 token, loaded on first access."""
+        if self._h3_clusters is None:
+            with self._lock:
+                if self._h3_clusters is None:
+                    self._h3_clusters = self._load("h3_clusters.pkl")
+        return self._h3_clusters
+
+    @h3_clusters.setter
+    def h3_clusters(self, value):
+        self._h3_clusters = value
+        self._hybrid_cells = None
+
+    @property
+    def h3_kmeans(self):
+        """Clustering models per H3 token, loaded on first access."""
+        if self._h3_kmeans is None:
+            with self._lock:
+                if self._h3_kmeans is None:
+                    self._h3_kmeans = self._load(
+                        "h3_kmeans_clustering_all_models_precise.pkl"
+                    )
+        return self._h3_kmeans
+
+    @h3_kmeans.setter
+    def h3_kmeans(self, value):
+        self._h3_kmeans = value
+        self._hybrid_cells = None
+
+    @property
+    def hybrid_cells(self):
+        """
+        The tokens whose clustering model moves the points by at least
+        hybrid_min_shift meters on average, computed on first access.
+        """
+        if self._hybrid_cells is None:
+            self._hybrid_cells = select_hybrid_cells(
+                self.h3_clusters, self.h3_kmeans, self.hybrid_min_shift
+            )
+        return self._hybrid_cells
+
+    def token2point_h3_centroid(self, token, previous_point=None):
         """Tokenize a point into a token"""
         y, x = h3.h3_to_geo(token)
         return Point(x, y)
 
-    def token2point_data_centroid(self, token):
+    def token2point_data_centroid(self, token, previous_point=None):
         """Tokenize a point into a token"""
         if token in self.h3_clusters:
             cluster = self.h3_clusters[token]
@@ -214,3 +350,34 @@ class DeTokenizer(object):
         m, means = self.h3_kmeans[token]
         x, y, _ = means[m.predict(np.array([angle]).reshape(-1, 1))][0]
         return Point(x, y)
+
+    def token2point_hybrid(self, token, previous_point):
+        """Tokenize a point into a token"""
+        if token in self.hybrid_cells:
+            return self.token2point_cluster_centroid(token, previous_point)
+        return self.token2point_data_centroid(token)
+
+    def tier_function(self, tier):
+        """
+        Returns the token2point method of a tier of DETOKENIZATION_TIERS, called
+        with the token and the previous point.
+        """
+        if tier not in DETOKENIZATION_TIERS:
+            raise ValueError(
+                f"Unknown detokenization tier {tier!r}, "
+                f"expected one of {', '.join(DETOKENIZATION_TIERS)}"
+            )
+        return getattr(self, f"token2point_{tier}")
+
+
+_detokenizer = None
+
+
+def get_detokenizer():
+    """
+    Returns the shared DeTokenizer, created on the first detokenization.
+    """
+    global _detokenizer
+    if _detokenizer is None:
+        _detokenizer = DeTokenizer()
+    return _detokenizer
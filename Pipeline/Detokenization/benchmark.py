@@ -0,0 +1,104 @@
+"""Throughput and accuracy benchmark of the detokenization tiers"""
+
+import sys
+import time
+
+import h3
+import numpy as np
+
+from TrajPipeline.NewPipeline.utilFunctions import (
+    DETOKENIZATION_TIERS,
+    haversine_meters,
+)
+from TrajPipeline.Pipeline.Detokenization.detokenization import BERTImputer
+from TrajPipeline.Pipeline.Tokenization.parsing import readTrajectoriesJson
+
+
+def tokenizeParsedTrajectories(parsed, resolution=10):
+    # The tokens of every trajectory of a ParsedTrajectories batch
+    lats, lons = parsed.lat.tolist(), parsed.lon.tolist()
+    bounds = parsed.offsets.tolist()
+    return [
+        [h3.geo_to_h3(lats[j], lons[j], resolution) for j in range(start, end)]
+        for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+
+
+def detokenizeWith(token2point, tokenized):
+    # Flat lat/lon arrays of the detokenized points, each trajectory starting
+    # without a previous point like detokenizeLine does
+    lats, lons = [], []
+    for tokens in tokenized:
+        previous_point = None
+        for token in tokens:
+            point = token2point(token, previous_point)
+            previous_point = point
+            lats.append(point.y)
+            lons.append(point.x)
+    return np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64)
+
+
+def benchmarkTiers(parsed, imputer=None, tiers=DETOKENIZATION_TIERS, resolution=10):
+    """
+    Detokenizes the tokens of held-out GPS trajectories with every tier and
+    compares the points to the original GPS points.
+
+    Args:
+        parsed (ParsedTrajectories): The held-out trajectories, data the cluster
+                                     models were not built from.
+        imputer: A BERTImputer, or any object whose tierFunction(tier) (or
+                 tier_function(tier), like the NewPipeline DeTokenizer) returns
+                 the token2point method of a tier.
+        tiers (tuple of str): The tiers to benchmark.
+        resolution (int): The H3 resolution the trajectories are tokenized at.
+
+    Returns:
+        dict: tier -> {"points", "seconds", "points_per_sec", "mean_error_m",
+              "median_error_m", "p95_error_m"}.
+    """
+    imputer = imputer or BERTImputer()
+    tier_function = getattr(imputer, "tierFunction", None) or imputer.tier_function
+    tokenized = tokenizeParsedTrajectories(parsed, resolution)
+    # Loads the pickles and the hybrid cells outside of the timed sections
+    detokenizeWith(tier_function("hybrid"), tokenized[:1])
+
+    results = {}
+    for tier in tiers:
+        token2point = tier_function(tier)
+        start = time.perf_counter()
+        lats, lons = detokenizeWith(token2point, tokenized)
+        seconds = time.perf_counter() - start
+        errors = haversine_meters(parsed.lat, parsed.lon, lats, lons)
+        results[tier] = {
+            "points": len(errors),
+            "seconds": seconds,
+            "points_per_sec": len(errors) / seconds if seconds > 0 else float("inf"),
+            "mean_error_m": float(errors.mean()) if len(errors) else 0.0,
+            "median_error_m": float(np.median(errors)) if len(errors) else 0.0,
+            "p95_error_m": float(np.percentile(errors, 95)) if len(errors) else 0.0,
+        }
+    return results
+
+
+def formatBenchmark(results):
+    # One line per tier, for the console
+    lines = [
+        f"{'tier':<18}{'points/sec':>14}{'mean err (m)':>14}"
+        f"{'median (m)':>12}{'p95 (m)':>10}"
+    ]
+    for tier, result in results.items():
+        lines.append(
+            f"{tier:<18}{result['points_per_sec']:>14,.0f}"
+            f"{result['mean_error_m']:>14.2f}{result['median_error_m']:>12.2f}"
+            f"{result['p95_error_m']:>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+# Example usage:
+#   python benchmark.py heldOutTrajectories.json [resolution]
+# with the held-out file in the pipeline input format ("id", "trajectory").
+if __name__ == "__main__":
+    _, parsed = readTrajectoriesJson(sys.argv[1])
+    resolution = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print(formatBenchmark(benchmarkTiers(parsed, resolution=resolution)))
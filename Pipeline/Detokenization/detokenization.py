@@ -3,10 +3,14 @@ import warnings
 import pickle
 import math
 import numpy as np
-from tqdm import tqdm
-from random import random
 import os
+import threading
 import json
+from TrajPipeline.NewPipeline.utilFunctions import (
+    DETOKENIZATION_TIERS,
+    select_hybrid_cells,
+)
+from TrajPipeline.Pipeline.Tokenization.runLength import expandRuns
 
 warnings.filterwarnings("ignore")
 
@@ -35,19 +39,60 @@ def calculate_bearing(pointA, pointB):
 
 
 class BERTImputer(object):
-    h3_clusters = None
-    h3_kmeans = None
-
-    def __init__(self):
+    def __init__(self, hybrid_min_shift=5.0):
         # adjust data dir as needed.
         # data_dir = "."
-        data_dir = os.path.dirname(os.path.abspath(__file__))
-        with open(f"{data_dir}/h3_clusters.pkl", "rb") as file:
-            self.h3_clusters = pickle.load(file)
-        with open(
-            f"{data_dir}/h3_kmeans_clustering_all_models_precise.pkl", "rb"
-        ) as file:
-            self.h3_kmeans = pickle.load(file)
+        self.data_dir = os.path.dirname(os.path.abspath(__file__))
+        # The pickles are only loaded by the first detokenization, training runs
+        # and short lived processes never pay for unpickling the sklearn models
+        self._h3_clusters, self._h3_kmeans = None, None
+        self._lock = threading.Lock()
+        # Mean distance in meters the cluster model must move the points of a
+        # cell away from its data centroid to be used in the hybrid tier
+        self.hybrid_min_shift = hybrid_min_shift
+        self._hybrid_cells = None
+
+    def _load(self, filename):
+        with open(os.path.join(self.data_dir, filename), "rb") as file:
+            return pickle.load(file)
+
+    @property
+    def h3_clusters(self):
+        if self._h3_clusters is None:
+            with self._lock:
+                if self._h3_clusters is None:
+                    self._h3_clusters = self._load("h3_clusters.pkl")
+        return self._h3_clusters
+
+    @h3_clusters.setter
+    def h3_clusters(self, value):
+        self._h3_clusters = value
+        self._hybrid_cells = None
+
+    @property
+    def h3_kmeans(self):
+        if self._h3_kmeans is None:
+            with self._lock:
+                if self._h3_kmeans is None:
+                    self._h3_kmeans = self._load(
+                        "h3_kmeans_clustering_all_models_precise.pkl"
+                    )
+        return self._h3_kmeans
+
+    @h3_kmeans.setter
+    def h3_kmeans(self, value):
+        self._h3_kmeans = value
+        self._hybrid_cells = None
+
+    @property
+    def hybrid_cells(self):
+        # Cells whose cluster model moves the points by at least hybrid_min_shift
+        # meters on average, computed on first use of the hybrid tier
+        if self._hybrid_cells is None:
+            self._hybrid_cells = select_hybrid_cells(
+                self.h3_clusters, self.h3_kmeans, self.hybrid_min_shift
+            )
+        return self._hybrid_cells
 
     def token2point_h3_centroid(self, token, previous_point=None):
         y, x = h3.h3_to_geo(token)
@@ -78,6 +123,20 @@ class BERTImputer(object):
         x, y, _ = means[m.predict(np.array([angle]).reshape(-1, 1))][0]
         return Point(x, y)
 
+    def token2point_hybrid(self, token, previous_point):
+        if token in self.hybrid_cells:
+            return self.token2point_cluster_centroid(token, previous_point)
+        return self.token2point_data_centroid(token, None)
+
+    def tierFunction(self, tier):
+        # The token2point method of a tier of DETOKENIZATION_TIERS
+        if tier not in DETOKENIZATION_TIERS:
+            raise ValueError(
+                f"Unknown detokenization tier {tier!r}, "
+                f"expected one of {', '.join(DETOKENIZATION_TIERS)}"
+            )
+        return getattr(self, f"token2point_{tier}")
+
 
 def readTrajectoriesFile(file):
     with open(file, "r") as f:
@@ -85,8 +144,17 @@ def readTrajectoriesFile(file):
     return lines
 
 
-def detokenizeLine(line, bertImputerInstance, mode):
+def splitLine(line):
+    # Run-length collapsed lines carry "<rN>" dwell tokens, expand them first
     elements = line.split()
+    if "<r" in line:
+        elements = expandRuns(elements)
+    return elements
+
+
+def detokenizeLine(line, bertImputerInstance, mode, tier="cluster_centroid"):
+    token2point = bertImputerInstance.tierFunction(tier)
+    elements = splitLine(line)
     detokenized_trajectory = []
     previous_point = None
     is_summary = False
@@ -103,9 +171,7 @@ def detokenizeLine(line, bertImputerInstance, mode):
             is_summary = True
         elif element not in ("<original>", "<summary>", "<end>", "<pad>"):
             if h3.h3_is_valid(element):
-                point = bertImputerInstance.token2point_cluster_centroid(
-                    element, previous_point
-                )
+                point = token2point(element, previous_point)
                 previous_point = point
                 detokenized_trajectory.append(f"{round(point.y,6)} {round(point.x,6)}")
                 # Add a comma if it's not the last element
@@ -116,46 +182,144 @@ def detokenizeLine(line, bertImputerInstance, mode):
     return result
 
 
-def detokenizeTrajectories(input_file, bertImputerInstance, mode):
+def detokenizeTrajectories(
+    input_file, bertImputerInstance, mode, tier="cluster_centroid"
+):
     lines = readTrajectoriesFile(input_file)
     detokenizedTrajectories = []
     for line in lines:
-        detokenized_line = detokenizeLine(line, bertImputerInstance, mode)
+        detokenized_line = detokenizeLine(line, bertImputerInstance, mode, tier)
         # print(detokenized_line)
         detokenizedTrajectories.append(detokenized_line)
     return detokenizedTrajectories
 
 
-def writeDetokenizedTrajectories(detokenized_trajectories, output_file, mode):
-    detokenized_data = []
-    for idx, detokenized in enumerate(detokenized_trajectories, start=1):
-        detokenized = detokenized.strip()
-        # print(detokenized)
-        trajectory_dict = {}
-        if mode == "summarization_testing":
-            if detokenized.startswith("<original>"):
-                parts = detokenized.split(", <end> <summary>")
+def iterDetokenizeLineArrays(line, bertImputerInstance, mode, tier="cluster_centroid"):
+    # Same walk over the tokens as detokenizeLine, but the points are kept as
+    # numbers: returns (trajectory, summary) where each part is a (lats, lons)
+    # pair of float lists and summary is None when the line has no summary part
+    token2point = bertImputerInstance.tierFunction(tier)
+    lats, lons = [], []
+    trajectory, summary = (lats, lons), None
+    previous_point = None
+    for element in splitLine(line):
+        if element == "<end>":
+            if summary is not None:
+                break
+            if mode == "summarization_testing":
+                lats, lons = [], []
+                summary = (lats, lons)
+        elif element not in ("<original>", "<summary>", "<end>", "<pad>"):
+            if h3.h3_is_valid(element):
+                point = token2point(element, previous_point)
+                previous_point = point
+                lats.append(point.y)
+                lons.append(point.x)
+    return trajectory, summary
+
 
+def iterDetokenizeTrajectories(
+    input_file, bertImputerInstance, mode, tier="cluster_centroid"
+):
+    # Reads the tokenized file line by line instead of loading it whole
+    with open(input_file, "r") as f:
+        for line in f:
+            yield iterDetokenizeLineArrays(line, bertImputerInstance, mode, tier)
+
+
+def roundCoordinates(values):
+    # round(value, 6) of every value as a list, numpy rounds the scaled floats
+    # while round() of a Python float rounds its exact decimal value. Both only
+    # differ within float error of a tie, those few values go through round().
+    array = np.asarray(values, dtype=np.float64)
+    rounded = np.round(array, 6).tolist()
+    fractions = np.abs(np.modf(array * 1e6)[0])
+    for i in np.flatnonzero(np.abs(fractions - 0.5) < 1e-6).tolist():
+        rounded[i] = round(values[i], 6)
+    return rounded
+
+
+def formatPoints(lats, lons):
+    # "lat lon,lat lon,..." with the points rounded to 6 decimals, the same text
+    # as f"{round(lat, 6)} {round(lon, 6)}" per point
+    return ",".join(map("{} {}".format, roundCoordinates(lats), roundCoordinates(lons)))
+
+
+class DetokenizedTrajectoriesWriter:
+    """
+    Streams detokenized trajectories to disk record by record.
+
+    With compact=False the output is byte for byte what json.dump(records,
+    indent=4) produced before, with compact=True one compact JSON object is
+    written per line (JSONL). Points can be passed as (lats, lons) sequences
+    or as already formatted strings.
+
+    Records go to a temporary file that replaces output_file on close, a run
+    that dies halfway never leaves a truncated output behind.
+    """
+
+    def __init__(self, output_file, mode, compact=False, buffer_size=1 << 20):
+        self.output_file = output_file
+        self.mode = mode
+        self.compact = compact
+        self.count = 0
+        self.tmp_file = f"{output_file}.{os.getpid()}.tmp"
+        self.file = open(self.tmp_file, "w", buffering=buffer_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(discard=exc_type is not None)
+
+    def write(self, trajectory, summary=None):
+        record = {"id": str(self.count + 1), "trajectory": self._points(trajectory)}
+        if summary is not None and self.mode == "summarization_testing":
+            record["summary"] = self._points(summary)
+        self.writeRecord(record)
+
+    def writeRecord(self, record):
+        if self.compact:
+            self.file.write(json.dumps(record, separators=(",", ":")))
+            self.file.write("\n")
+        else:
+            self.file.write("[\n    " if self.count == 0 else ",\n    ")
+            self.file.write(json.dumps(record, indent=4).replace("\n", "\n    "))
+        self.count += 1
+
+    def _points(self, points):
+        if isinstance(points, str):
+            return points
+        lats, lons = points
+        return formatPoints(lats, lons)
+
+    def close(self, discard=False):
+        if self.file.closed:
+            return
+        if discard:
+            self.file.close()
+            os.remove(self.tmp_file)
+            return
+        if not self.compact:
+            self.file.write("[]" if self.count == 0 else "\n]")
+        self.file.close()
+        os.replace(self.tmp_file, self.output_file)
+
+
+def writeDetokenizedTrajectories(
+    detokenized_trajectories, output_file, mode, compact=False
+):
+    with DetokenizedTrajectoriesWriter(output_file, mode, compact) as writer:
+        for detokenized in detokenized_trajectories:
+            detokenized = detokenized.strip()
+            if mode != "summarization_testing":
+                writer.write(detokenized)
+            elif not detokenized.startswith("<original>"):
+                writer.writeRecord({})
+            else:
+                parts = detokenized.split(", <end> <summary>")
                 original_points = parts[0].replace("<original>", "").strip()
-                # print(original_points)
-                trajectory_dict = {
-                    "id": str(idx),
-                    "trajectory": original_points,
-                }
+                summary_points = None
                 if len(parts) > 1:
                     summary_points = parts[1].replace(", <end>", "").strip()
-                    trajectory_dict = {
-                        "id": str(idx),
-                        "trajectory": original_points,
-                        "summary": summary_points,
-                    }
-                    # trajectory_dict["summary"] = summary_points
-        else:
-            trajectory_dict = {
-                "id": str(idx),
-                "trajectory": detokenized,
-            }
-        detokenized_data.append(trajectory_dict)
-
-    with open(output_file, "w") as f:
-        json.dump(detokenized_data, f, indent=4)
+                writer.write(original_points, summary_points)
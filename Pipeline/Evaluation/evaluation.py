@@ -0,0 +1,468 @@
+"""Vectorized quality metrics of detokenized trajectories and summaries"""
+
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+from h3.api import basic_int as h3int
+
+from TrajPipeline.Pipeline.Tokenization.parsing import parseTrajectoryStrings
+from TrajPipeline.Pipeline.runManifest import atomicFile
+
+# Per trajectory metrics, in the column order of the metrics file. Distances are
+# in meters, the trajectory metrics compare the detokenized trajectory to the
+# original GPS points and the summary metrics the generated summary to the
+# ground truth one. A metric that can't be computed (e.g. no ground truth
+# summary) is NaN.
+EVALUATION_METRICS = (
+    "trajectory_points",
+    "summary_points",
+    "compression_ratio",
+    "trajectory_hausdorff_m",
+    "trajectory_frechet_m",
+    "summary_hausdorff_m",
+    "summary_frechet_m",
+    "token_precision",
+    "token_recall",
+)
+
+# Haversine term stacks of one vectorized step hold at most this many entries
+DISTANCE_BUDGET = 1 << 18
+
+
+def paddedPoints(parsed, indices, width):
+    # (len(indices), width) lat/lon arrays of some trajectories, NaN padded
+    lengths = np.diff(parsed.offsets)[indices]
+    lat = np.full((len(indices), width), np.nan)
+    lon = np.full((len(indices), width), np.nan)
+    rows = np.repeat(np.arange(len(indices)), lengths)
+    starts = parsed.offsets[indices]
+    columns = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    points = np.repeat(starts, lengths) + columns
+    lat[rows, columns] = parsed.lat[points]
+    lon[rows, columns] = parsed.lon[points]
+    return lat, lon
+
+
+def halfAngles(lat, lon):
+    # sin and cos of the half latitudes and half longitudes, and cos of the
+    # latitudes, of padded points
+    half_lat, half_lon = np.radians(lat) / 2, np.radians(lon) / 2
+    return (
+        np.sin(half_lat),
+        np.cos(half_lat),
+        np.sin(half_lon),
+        np.cos(half_lon),
+        np.cos(2 * half_lat),
+    )
+
+
+def haversineTerms(lat_a, lon_a, lat_b, lon_b):
+    """
+    (P, n, m) haversine terms between the points of P pairs of padded
+    trajectories, padding gives infinite terms.
+
+    The term a = sin²(Δφ/2) + cos φ1 cos φ2 sin²(Δλ/2) grows with the distance
+    2R·asin(√a), so minima and maxima can be taken over the terms and only the
+    results are converted to meters (haversineFromTerms). The half angle
+    differences are expanded as sin(x - y) = sin x cos y - cos x sin y from
+    per point values, the (P, n, m) stack itself needs no trigonometry.
+    """
+    sin_lat_a, cos_lat_a, sin_lon_a, cos_lon_a, cos_a = (
+        value[:, :, None] for value in halfAngles(lat_a, lon_a)
+    )
+    sin_lat_b, cos_lat_b, sin_lon_b, cos_lon_b, cos_b = (
+        value[:, None, :] for value in halfAngles(lat_b, lon_b)
+    )
+    sin_dlat = sin_lat_b * cos_lat_a - cos_lat_b * sin_lat_a
+    sin_dlon = sin_lon_b * cos_lon_a - cos_lon_b * sin_lon_a
+    terms = sin_dlat * sin_dlat + (cos_a * cos_b) * (sin_dlon * sin_dlon)
+    terms[np.isnan(terms)] = np.inf
+    return terms
+
+
+def haversineFromTerms(terms):
+    # Great circle distance in meters of haversine terms, same radius as haversine_meters
+    return 2 * 6371008.8 * np.arcsin(np.sqrt(np.minimum(terms, 1.0)))
+
+
+def hausdorffDistances(terms, lengths_a, lengths_b):
+    # Symmetric Hausdorff distance of every pair of a term stack, as a term
+    valid_a = np.arange(terms.shape[1]) < lengths_a[:, None]
+    valid_b = np.arange(terms.shape[2]) < lengths_b[:, None]
+    forward = np.where(valid_a, terms.min(axis=2), -np.inf).max(axis=1)
+    backward = np.where(valid_b, terms.min(axis=1), -np.inf).max(axis=1)
+    return np.maximum(forward, backward)
+
+
+def frechetDistances(terms, lengths_a, lengths_b):
+    """
+    Discrete Fréchet distance of every pair of a term stack, as a term.
+
+    The coupling table is filled one anti-diagonal at a time: cell (i, j) only
+    depends on (i, j - 1) and (i - 1, j) of the previous anti-diagonal and on
+    (i - 1, j - 1) of the one before. The stack is first skewed so that
+    anti-diagonal k is row k indexed by i, then each step is a handful of
+    vectorized operations over all pairs and all cells of the diagonal.
+    Padded cells hold infinite terms and never reach a valid cell.
+    """
+    pairs, n, m = terms.shape
+    skewed = np.full((pairs, n + m - 1, n), np.inf)
+    i, j = np.divmod(np.arange(n * m), m)
+    skewed[:, i + j, i] = terms.reshape(pairs, n * m)
+    # Every pair ends on the anti-diagonal of its last cell
+    last = lengths_a + lengths_b - 2
+    result = np.empty(pairs)
+    before, previous = None, skewed[:, 0]
+    for k in range(n + m - 1):
+        if k > 0:
+            best = previous.copy()
+            np.minimum(best[:, 1:], previous[:, :-1], out=best[:, 1:])
+            if before is not None:
+                np.minimum(best[:, 1:], before[:, :-1], out=best[:, 1:])
+            np.maximum(best, skewed[:, k], out=best)
+            before, previous = previous, best
+        done = np.flatnonzero(last == k)
+        result[done] = previous[done, lengths_a[done] - 1]
+    return result
+
+
+def trajectoryDistances(parsed_a, parsed_b):
+    """
+    Hausdorff and discrete Fréchet distances between trajectory i of parsed_a
+    and trajectory i of parsed_b, for every i.
+
+    Pairs are sorted by size and processed in groups whose padded term
+    stacks fit in DISTANCE_BUDGET entries.
+
+    Returns:
+        tuple: (hausdorff, frechet) float64 arrays in meters.
+    """
+    lengths_a = np.diff(parsed_a.offsets)
+    lengths_b = np.diff(parsed_b.offsets)
+    hausdorff = np.full(len(lengths_a), np.nan)
+    frechet = np.full(len(lengths_a), np.nan)
+    order = np.argsort(lengths_a * lengths_b, kind="stable")
+    order = order[(lengths_a[order] > 0) & (lengths_b[order] > 0)]
+    start = 0
+    while start < len(order):
+        # Sorted sizes grow, the group ends before its padded size exceeds the budget
+        end = start + 1
+        width_a, width_b = lengths_a[order[start]], lengths_b[order[start]]
+        while end < len(order):
+            next_a = max(width_a, lengths_a[order[end]])
+            next_b = max(width_b, lengths_b[order[end]])
+            if (end - start + 1) * next_a * next_b > DISTANCE_BUDGET:
+                break
+            width_a, width_b = next_a, next_b
+            end += 1
+        indices = order[start:end]
+        terms = haversineTerms(
+            *paddedPoints(parsed_a, indices, width_a),
+            *paddedPoints(parsed_b, indices, width_b),
+        )
+        hausdorff[indices] = hausdorffDistances(
+            terms, lengths_a[indices], lengths_b[indices]
+        )
+        frechet[indices] = frechetDistances(
+            terms, lengths_a[indices], lengths_b[indices]
+        )
+        start = end
+    return haversineFromTerms(hausdorff), haversineFromTerms(frechet)
+
+
+def uniqueTokens(parsed, resolution):
+    # (trajectory index, token) of every distinct token of every trajectory,
+    # sorted by trajectory then token
+    tokens = np.fromiter(
+        (
+            h3int.geo_to_h3(lat, lon, resolution)
+            for lat, lon in zip(parsed.lat.tolist(), parsed.lon.tolist())
+        ),
+        dtype=np.uint64,
+        count=len(parsed.lat),
+    )
+    owners = np.repeat(np.arange(len(parsed)), np.diff(parsed.offsets))
+    order = np.lexsort((tokens, owners))
+    owners, tokens = owners[order], tokens[order]
+    distinct = np.ones(len(tokens), dtype=bool)
+    distinct[1:] = (owners[1:] != owners[:-1]) | (tokens[1:] != tokens[:-1])
+    return owners[distinct], tokens[distinct]
+
+
+def tokenPrecisionRecall(predicted, reference, resolution=10):
+    """
+    Token level precision and recall of the predicted trajectories against the
+    reference ones, both tokenized at the given H3 resolution and compared as
+    sets of cells.
+
+    Returns:
+        tuple: (precision, recall) float64 arrays, NaN where the reference
+               trajectory is empty and, for precision, where the predicted
+               one is empty.
+    """
+    count = len(predicted)
+    owners_p, tokens_p = uniqueTokens(predicted, resolution)
+    owners_r, tokens_r = uniqueTokens(reference, resolution)
+    # A token shared by both sides of a pair shows up as two equal neighbours
+    owners = np.concatenate([owners_p, owners_r])
+    tokens = np.concatenate([tokens_p, tokens_r])
+    order = np.lexsort((tokens, owners))
+    owners, tokens = owners[order], tokens[order]
+    shared = (owners[1:] == owners[:-1]) & (tokens[1:] == tokens[:-1])
+    matches = np.bincount(owners[1:][shared], minlength=count).astype(np.float64)
+    predicted_counts = np.bincount(owners_p, minlength=count)
+    reference_counts = np.bincount(owners_r, minlength=count)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.where(
+            (predicted_counts > 0) & (reference_counts > 0),
+            matches / predicted_counts,
+            np.nan,
+        )
+        recall = np.where(reference_counts > 0, matches / reference_counts, np.nan)
+    return precision, recall
+
+
+def evaluateChunk(
+    trajectories, summaries, reference_trajectories, reference_summaries, resolution
+):
+    """
+    Metrics of one chunk of detokenized records against their references.
+
+    Args:
+        trajectories (list of str): Detokenized trajectories.
+        summaries (list of str or None): Generated summaries, None when the
+                                         output has no summaries.
+        reference_trajectories (list of str): The original trajectories.
+        reference_summaries (list of str or None): The ground truth summaries.
+        resolution (int): The H3 resolution of the token metrics.
+
+    Returns:
+        dict: metric name -> float64 array, see EVALUATION_METRICS.
+    """
+    count = len(trajectories)
+    nan = np.full(count, np.nan)
+    detokenized = parseTrajectoryStrings(trajectories)
+    original = parseTrajectoryStrings(reference_trajectories)
+    metrics = dict.fromkeys(EVALUATION_METRICS, nan)
+    metrics["trajectory_points"] = np.diff(original.offsets).astype(np.float64)
+    (
+        metrics["trajectory_hausdorff_m"],
+        metrics["trajectory_frechet_m"],
+    ) = trajectoryDistances(detokenized, original)
+    if summaries is not None:
+        generated = parseTrajectoryStrings(summaries)
+        summary_points = np.diff(generated.offsets).astype(np.float64)
+        metrics["summary_points"] = summary_points
+        with np.errstate(divide="ignore", invalid="ignore"):
+            metrics["compression_ratio"] = np.where(
+                summary_points > 0,
+                metrics["trajectory_points"] / summary_points,
+                np.nan,
+            )
+        if reference_summaries is not None:
+            truth = parseTrajectoryStrings(reference_summaries)
+            (
+                metrics["summary_hausdorff_m"],
+                metrics["summary_frechet_m"],
+            ) = trajectoryDistances(generated, truth)
+            (
+                metrics["token_precision"],
+                metrics["token_recall"],
+            ) = tokenPrecisionRecall(generated, truth, resolution)
+    return metrics
+
+
+def iterJsonRecords(path, buffer_size=1 << 20):
+    # Streams the records of a JSON array file (the indented detokenized
+    # output) or of a JSONL file (the compact one) without loading it whole
+    decoder = json.JSONDecoder()
+    with open(path, "r") as file:
+        buffer, position, eof = "", 0, False
+        while True:
+            # Skips the array brackets and the separators between records
+            while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+                position += 1
+            if position == len(buffer):
+                if eof:
+                    return
+                buffer, position = file.read(buffer_size), 0
+                eof = not buffer
+                continue
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                more = file.read(buffer_size)
+                eof = not more
+                buffer, position = buffer[position:] + more, 0
+                continue
+            yield record
+            position = end
+
+
+def summarizeMetrics(metrics):
+    # Mean, median and 95th percentile of every metric, NaNs left out
+    summary = {"trajectories": int(len(metrics["trajectory_points"]))}
+    for name in EVALUATION_METRICS:
+        values = metrics[name][~np.isnan(metrics[name])]
+        summary[name] = {
+            "count": int(len(values)),
+            "mean": float(values.mean()) if len(values) else None,
+            "median": float(np.median(values)) if len(values) else None,
+            "p95": float(np.percentile(values, 95)) if len(values) else None,
+        }
+    return summary
+
+
+def evaluateDetokenizedOutput(
+    detokenized_path,
+    reference_trajectories,
+    reference_summaries=None,
+    metrics_path=None,
+    resolution=10,
+    chunk_size=2048,
+    max_workers=None,
+):
+    """
+    Evaluates a detokenized output file against the original data.
+
+    The output is streamed in chunks that are evaluated in parallel processes,
+    at most two chunks per worker are in flight, so memory stays bounded for
+    outputs of any size. Records are matched to the references by position.
+    The workers are spawned rather than forked, as the caller may run in a
+    thread of a process holding locks and large models (e.g. a JobRunner).
+
+    Args:
+        detokenized_path (str): The detokenized output (JSON array or JSONL).
+        reference_trajectories (list of str): The original trajectories.
+        reference_summaries (list of str, optional): The ground truth summaries.
+        metrics_path (str, optional): CSV file receiving the metrics of every
+                                      trajectory, one row per record.
+        resolution (int): The H3 resolution of the token metrics.
+        chunk_size (int): Records per parallel task.
+        max_workers (int, optional): Worker processes, 0 evaluates in this process.
+
+    Returns:
+        tuple: (metrics, summary) with metrics a dict of metric name -> float64
+               array over all records and summary the summarizeMetrics dict.
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if reference_summaries is not None and not any(reference_summaries):
+        reference_summaries = None
+
+    def chunks():
+        records = iterJsonRecords(detokenized_path)
+        start = 0
+        while True:
+            batch = [record for _, record in zip(range(chunk_size), records)]
+            if not batch:
+                return
+            end = start + len(batch)
+            if end > len(reference_trajectories):
+                raise ValueError(
+                    f"{detokenized_path} has more records than the "
+                    f"{len(reference_trajectories)} reference trajectories"
+                )
+            has_summaries = all("summary" in record for record in batch)
+            yield (
+                [record["trajectory"] for record in batch],
+                [record["summary"] for record in batch] if has_summaries else None,
+                reference_trajectories[start:end],
+                reference_summaries[start:end] if reference_summaries else None,
+                resolution,
+            )
+            start = end
+
+    results, ids = [], itertools.count(1)
+    output = (
+        atomicFile(metrics_path)
+        if metrics_path is not None
+        else contextlib.nullcontext()
+    )
+    with output as file:
+        writer = None
+        if file is not None:
+            writer = csv.writer(file, lineterminator="\n")
+            writer.writerow(("id",) + EVALUATION_METRICS)
+
+        def collect(metrics):
+            results.append(metrics)
+            if writer is not None:
+                columns = [metrics[name].tolist() for name in EVALUATION_METRICS]
+                for row in zip(*columns):
+                    writer.writerow((str(next(ids)),) + row)
+
+        if max_workers == 0:
+            for args in chunks():
+                collect(evaluateChunk(*args))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                pending = collections.deque()
+                for args in chunks():
+                    pending.append(executor.submit(evaluateChunk, *args))
+                    if len(pending) >= 2 * max_workers:
+                        collect(pending.popleft().result())
+                while pending:
+                    collect(pending.popleft().result())
+
+    count = sum(len(chunk["trajectory_points"]) for chunk in results)
+    if count != len(reference_trajectories):
+        print(
+            f"Warning: {detokenized_path} has {count} records for "
+            f"{len(reference_trajectories)} reference trajectories"
+        )
+    metrics = {
+        name: (
+            np.concatenate([chunk[name] for chunk in results])
+            if results
+            else np.zeros(0)
+        )
+        for name in EVALUATION_METRICS
+    }
+    return metrics, summarizeMetrics(metrics)
+
+
+def formatSummary(summary):
+    # One line per metric, for the console
+    lines = [
+        f"{summary['trajectories']} trajectories",
+        f"{'metric':<26}{'mean':>12}{'median':>12}{'p95':>12}",
+    ]
+    for name in EVALUATION_METRICS:
+        stats = summary[name]
+        if stats["count"] == 0:
+            continue
+        lines.append(
+            f"{name:<26}{stats['mean']:>12.3f}{stats['median']:>12.3f}"
+            f"{stats['p95']:>12.3f}"
+        )
+    return "\n".join(lines)
+
+
+# Example usage:
+#   python evaluation.py detokenizedTrajectories.json trajectories.json [metrics.csv]
+# with the original data in the pipeline input format ("trajectory", "summary").
+if __name__ == "__main__":
+    with open(sys.argv[2], "r") as file:
+        data = json.load(file)
+    _, summary = evaluateDetokenizedOutput(
+        sys.argv[1],
+        [item["trajectory"] for item in data],
+        [item.get("summary", "") for item in data],
+        metrics_path=sys.argv[3] if len(sys.argv) > 3 else None,
+    )
+    print(formatSummary(summary))
@@ -0,0 +1,380 @@
+"""Local asyncio service with dynamic micro-batching on top of the pipeline"""
+
+import asyncio
+import random
+import threading
+import time
+
+import numpy as np
+
+from TrajPipeline.Pipeline.Tokenization.parsing import parseTrajectoryStrings
+from TrajPipeline.Pipeline.Tokenization.tokenization import iterTokenizeTrajectories
+from TrajPipeline.Pipeline.Detokenization.detokenization import (
+    formatPoints,
+    iterDetokenizeLineArrays,
+)
+
+
+class StubModel:
+    """
+    Offline stand-in for the transformer, used to test the service.
+
+    summarize keeps every `step`-th token of the original as the summary and
+    generate samples tokens from `vocabulary`.
+    """
+
+    def __init__(self, vocabulary=None, step=2, seed=0):
+        self.vocabulary = list(vocabulary or [])
+        self.step = step
+        self.random = random.Random(seed)
+
+    def summarize(self, lines):
+        outputs = []
+        for line in lines:
+            original = line.split("<end>")[0].replace("<original>", "").split()
+            summary = original[:: self.step]
+            outputs.append(
+                f'<original> {" ".join(original)} <end> <summary> {" ".join(summary)} <end>'
+            )
+        return outputs
+
+    def generate(self, lengths):
+        if not self.vocabulary:
+            raise ValueError("StubModel needs a vocabulary to generate trajectories")
+        return [
+            " ".join(self.random.choice(self.vocabulary) for _ in range(length))
+            for length in lengths
+        ]
+
+
+class ScriptModel:
+    """
+    Adapter running the model scripts of a TrajectoryPipeline for a batch.
+    The pipeline writes the model output to the model_output_path of its run.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        # The pipeline holds the state of one model call at a time
+        self.lock = threading.Lock()
+
+    def _run(self, mode, expected):
+        self.pipeline.mode = mode
+        # The output file is the same for every call, after a failure it still
+        # holds the output of the previous batch
+        if self.pipeline.modelsRepository() is False:
+            raise RuntimeError(f"The {mode} model script failed")
+        with open(self.pipeline.model_output_path, "r") as f:
+            outputs = [line.rstrip("\n") for line in f]
+        if len(outputs) != expected:
+            raise RuntimeError(
+                f"The {mode} model script returned {len(outputs)} outputs "
+                f"for {expected} requests"
+            )
+        return outputs
+
+    def summarize(self, lines):
+        with self.lock:
+            self.pipeline.tokenized_trajectories = list(lines)
+            return self._run("summarization_testing", len(lines))
+
+    def generate(self, lengths):
+        by_length = {}
+        # The generation script takes one length per call
+        with self.lock:
+            for length in sorted(set(lengths)):
+                count = lengths.count(length)
+                self.pipeline.trajectories_count = count
+                self.pipeline.trajectories_length = length
+                by_length[length] = self._run("generation_testing", count)
+        return [by_length[length].pop(0) for length in lengths]
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches for a synchronous handler.
+
+    A batch is dispatched as soon as it holds `max_batch_size` requests or its
+    oldest request waited `max_latency` seconds. The handler runs in a worker
+    thread so the event loop keeps accepting requests meanwhile.
+
+    Every request is first passed through `prepare` (validation, tokenization)
+    on its own, a request it rejects fails alone and the others of the batch
+    go on to the handler. The handler returns one result per item, an
+    Exception instance as a result fails only the request it belongs to.
+    """
+
+    def __init__(self, handler, max_batch_size=32, max_latency=0.01, prepare=None):
+        self.handler = handler
+        self.prepare = prepare
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = None
+        self.task = None
+        self.batch_sizes = []
+        # The requests of the batch being handled, failed too if stopped meanwhile
+        self._current = []
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # No request is left waiting for a batch that will never run
+        pending = self._current
+        self._current = []
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        for _, future in pending:
+            if not future.done():
+                future.set_exception(RuntimeError("The service was stopped"))
+
+    async def submit(self, item):
+        if self.task is None:
+            raise RuntimeError("The service is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    def _process(self, items):
+        # Runs in the worker thread, returns one result or exception per item
+        outcomes = [None] * len(items)
+        ready = []
+        for i, item in enumerate(items):
+            try:
+                ready.append((i, self.prepare(item) if self.prepare else item))
+            except Exception as e:
+                outcomes[i] = e
+        if not ready:
+            return outcomes
+        try:
+            results = list(self.handler([item for _, item in ready]))
+            if len(results) != len(ready):
+                # The results can't be matched to their requests anymore
+                raise RuntimeError(
+                    f"The handler returned {len(results)} results for {len(ready)} requests"
+                )
+        except Exception as e:  # the error goes to every request of the batch
+            results = [e] * len(ready)
+        for (i, _), result in zip(ready, results):
+            outcomes[i] = result
+        return outcomes
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes.append(len(batch))
+            self._current = batch
+            outcomes = await asyncio.to_thread(
+                self._process, [item for item, _ in batch]
+            )
+            self._current = []
+            for (_, future), outcome in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if isinstance(outcome, Exception):
+                    future.set_exception(outcome)
+                else:
+                    future.set_result(outcome)
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+class TrajectoryService:
+    """
+    Serves summarize, generate and detokenize requests concurrently.
+
+    Every request kind has its own MicroBatcher. A summarize request is
+    validated and tokenized on its own, then its batch goes through routing,
+    the model and detokenization: with a `router` (e.g. a BatchRouter), every
+    trajectory is sent to the model of the pyramid cell enclosing it, with one
+    model call per cell, otherwise the whole batch goes to `model`. The
+    per-request overhead of the pipeline is paid once per batch, while a
+    malformed request or a trajectory no model covers only fails its own caller.
+
+    Attributes:
+        model: Object with summarize(lines) and generate(lengths), e.g. StubModel.
+        imputer: The detokenizer, e.g. the pipeline's BERTImputer instance.
+        router: Object with route(trajectories) and dispatch(trajectories,
+                run_batch), whose models have summarize(lines), or None.
+        latencies (dict): request kind -> list of request latencies in seconds.
+    """
+
+    def __init__(
+        self,
+        model,
+        imputer,
+        max_batch_size=32,
+        max_latency=0.01,
+        detokenization_tier="cluster_centroid",
+        router=None,
+    ):
+        self.model = model
+        self.imputer = imputer
+        self.router = router
+        # Fails on an unknown tier before the service starts
+        imputer.tierFunction(detokenization_tier)
+        self.detokenization_tier = detokenization_tier
+        self.latencies = {"summarize": [], "generate": [], "detokenize": []}
+        self.batchers = {
+            "summarize": MicroBatcher(
+                self._summarize_batch,
+                max_batch_size,
+                max_latency,
+                prepare=self._tokenize_request,
+            ),
+            "generate": MicroBatcher(
+                self._generate_batch,
+                max_batch_size,
+                max_latency,
+                prepare=self._check_length,
+            ),
+            # Detokenization is the whole work of a detokenize request
+            "detokenize": MicroBatcher(
+                list,
+                max_batch_size,
+                max_latency,
+                prepare=lambda line: self._detokenize(line, "generation_testing"),
+            ),
+        }
+
+    @classmethod
+    def from_pipeline(cls, pipeline, model=None, **kwargs):
+        # Serves the model scripts of the pipeline unless another model is given
+        kwargs.setdefault("detokenization_tier", pipeline.detokenization_tier)
+        return cls(
+            model or ScriptModel(pipeline), pipeline.bert_imputer_instance, **kwargs
+        )
+
+    async def start(self):
+        for batcher in self.batchers.values():
+            await batcher.start()
+
+    async def stop(self):
+        for batcher in self.batchers.values():
+            await batcher.stop()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    async def _request(self, kind, item):
+        start = time.perf_counter()
+        try:
+            return await self.batchers[kind].submit(item)
+        finally:
+            self.latencies[kind].append(time.perf_counter() - start)
+
+    async def summarize(self, trajectory: str) -> dict:
+        """Summarizes one "lat lon,lat lon,..." trajectory."""
+        return await self._request("summarize", trajectory)
+
+    async def generate(self, length: int) -> dict:
+        """Generates one trajectory of the given number of tokens."""
+        return await self._request("generate", length)
+
+    async def detokenize(self, line: str) -> dict:
+        """Detokenizes one line of H3 tokens."""
+        return await self._request("detokenize", line)
+
+    def _detokenize(self, line, mode):
+        trajectory, summary = iterDetokenizeLineArrays(
+            line, self.imputer, mode, self.detokenization_tier
+        )
+        record = {"trajectory": formatPoints(*trajectory)}
+        if summary is not None:
+            record["summary"] = formatPoints(*summary)
+        return record
+
+    def _detokenize_outputs(self, outputs, mode):
+        # A model output that can't be detokenized only fails its own request
+        records = []
+        for line in outputs:
+            try:
+                records.append(
+                    line
+                    if isinstance(line, Exception)
+                    else self._detokenize(line, mode)
+                )
+            except Exception as e:
+                records.append(e)
+        return records
+
+    def _tokenize_request(self, trajectory):
+        # Validation and tokenization of one summarize request
+        if not isinstance(trajectory, str):
+            raise TypeError("A trajectory must be a 'lat lon,lat lon,...' string")
+        data = [{"id": "0", "trajectory": trajectory, "summary": ""}]
+        (line,) = iterTokenizeTrajectories(data, "summarization_testing")
+        return parseTrajectoryStrings([trajectory]).tolist(0), line
+
+    def _check_length(self, length):
+        length = int(length)
+        if length <= 0:
+            raise ValueError("The length of a generated trajectory must be positive")
+        return length
+
+    def _route(self, trajectories, lines):
+        # Routing step, one model call per pyramid cell
+        if self.router is None:
+            return self.model.summarize(lines)
+        outputs = [None] * len(lines)
+        groups = self.router.route(trajectories)
+        for position in groups.pop(None, []):
+            outputs[position] = ValueError("No model covers this trajectory")
+        positions = [position for group in groups.values() for position in group]
+        # dispatch hands back the trajectory objects it was given
+        line_of = {id(trajectories[i]): lines[i] for i in positions}
+        routed = self.router.dispatch(
+            [trajectories[i] for i in positions],
+            lambda model, batch: model.summarize([line_of[id(t)] for t in batch]),
+        )
+        for position, output in zip(positions, routed):
+            outputs[position] = output
+        return outputs
+
+    def _summarize_batch(self, requests):
+        trajectories = [trajectory for trajectory, _ in requests]
+        outputs = self._route(trajectories, [line for _, line in requests])
+        return self._detokenize_outputs(outputs, "summarization_testing")
+
+    def _generate_batch(self, lengths):
+        outputs = self.model.generate(lengths)
+        return self._detokenize_outputs(outputs, "generation_testing")
+
+    def latencyReport(self) -> dict:
+        """p50/p99 latency and mean batch size per request kind."""
+        report = {}
+        for kind, latencies in self.latencies.items():
+            batch_sizes = self.batchers[kind].batch_sizes
+            report[kind] = {
+                "requests": len(latencies),
+                "p50_ms": 1000 * percentile(latencies, 50),
+                "p99_ms": 1000 * percentile(latencies, 99),
+                "mean_batch_size": (
+                    sum(batch_sizes) / len(batch_sizes) if batch_sizes else 0.0
+                ),
+            }
+        return report
@@ -0,0 +1,325 @@
+"""Near-duplicate detection of tokenized trajectories with MinHash/LSH signatures"""
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Multipliers combining the tokens of a shingle and the rows of a band
+SHINGLE_MULTIPLIERS = (
+    np.uint64(0x9E3779B97F4A7C15),
+    np.uint64(0xC2B2AE3D27D4EB4F),
+    np.uint64(0x165667B19E3779F9),
+    np.uint64(0x27D4EB2F165667C5),
+)
+
+
+def mix64(values):
+    # splitmix64 finalizer, spreads the bits of uint64 values
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def lineTokens(line):
+    # The trajectory tokens of a tokenized line: the part before the first
+    # "<end>", without the special and dwell tokens
+    return [
+        token
+        for token in line.split("<end>", 1)[0].split()
+        if not token.startswith("<")
+    ]
+
+
+def shingleHashes(token_lists, shingle_size=3):
+    """
+    Hashes the shingles (runs of shingle_size consecutive tokens) of every
+    trajectory. Consecutive repeated tokens are collapsed first, so stops and
+    GPS jitter in the same cell do not change the shingles.
+
+    Returns:
+        tuple: (uint64 hashes, int64 index of the trajectory of every hash).
+    """
+    lengths = np.fromiter((len(t) for t in token_lists), dtype=np.int64)
+    tokens = np.fromiter(
+        (int(token, 16) for tokens in token_lists for token in tokens),
+        dtype=np.uint64,
+        count=int(lengths.sum()),
+    )
+    owners = np.repeat(np.arange(len(token_lists), dtype=np.int64), lengths)
+    keep = np.ones(len(tokens), dtype=bool)
+    keep[1:] = (tokens[1:] != tokens[:-1]) | (owners[1:] != owners[:-1])
+    tokens, owners = tokens[keep], owners[keep]
+    if not len(tokens):
+        return tokens, owners
+
+    starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+    counts = np.diff(np.r_[starts, len(tokens)])
+    # A trajectory shorter than a shingle is a single shingle of its tokens
+    size = min(shingle_size, len(SHINGLE_MULTIPLIERS))
+    positions = np.arange(len(tokens))
+    first = np.repeat(starts, counts)
+    ends = np.repeat(starts + counts, counts)
+    is_start = (positions + size <= ends) | (positions == first)
+    hashes = np.zeros(len(tokens), dtype=np.uint64)
+    for offset in range(size):
+        shifted = positions + offset
+        valid = shifted < ends
+        term = np.zeros(len(tokens), dtype=np.uint64)
+        term[valid] = tokens[shifted[valid]] * SHINGLE_MULTIPLIERS[offset]
+        hashes += term
+    return mix64(hashes[is_start]), owners[is_start]
+
+
+class NearDuplicateDetector:
+    """
+    Finds near-duplicate trajectories, i.e. pairs whose token shingle sets have
+    a Jaccard similarity of at least `threshold`, in sub-quadratic time.
+
+    Trajectories are streamed in chunks. Each gets a MinHash signature of
+    num_perm uint32 values, appended to a file of the work directory, so only a
+    few bytes per trajectory stay in memory. The signature is cut into `bands`
+    bands of num_perm / bands rows. Trajectories sharing a band are candidate
+    pairs, found by sorting the band keys one band at a time. Every candidate is
+    verified against the first trajectory of its bucket by the share of equal
+    signature values. Duplicates point to the earliest trajectory of their
+    group (the representative).
+
+    Attributes:
+        num_perm (int): Length of the signatures.
+        bands (int): Number of LSH bands, num_perm must be a multiple of it.
+        shingle_size (int): Number of consecutive tokens per shingle (at most 4).
+        threshold (float): Estimated Jaccard similarity of a near-duplicate.
+        count (int): Number of trajectories added.
+    """
+
+    def __init__(
+        self,
+        work_dir=None,
+        num_perm=64,
+        bands=16,
+        shingle_size=3,
+        threshold=0.8,
+        seed=0,
+        chunk_size=2048,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm, self.bands = num_perm, bands
+        self.shingle_size, self.threshold = shingle_size, threshold
+        self.chunk_size = chunk_size
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hash family, one odd multiplier per permutation
+        self.multipliers = rng.integers(
+            1, 2**63, size=num_perm, dtype=np.uint64
+        ) * np.uint64(2) + np.uint64(1)
+        self.increments = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+        self.own_work_dir = work_dir is None
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix="dedup")
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.signatures_path = os.path.join(self.work_dir, "signatures.bin")
+        self.signatures_file = open(self.signatures_path, "wb")
+        self.lengths = []
+        self.count = 0
+        self.duplicate_of = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        if not self.signatures_file.closed:
+            self.signatures_file.close()
+        if self.own_work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def signatures(self, token_lists) -> np.ndarray:
+        """
+        Returns the (n, num_perm) uint32 MinHash signatures of the trajectories,
+        rows of empty trajectories are all 0xFFFFFFFF.
+        """
+        hashes, owners = shingleHashes(token_lists, self.shingle_size)
+        signatures = np.full((len(token_lists), self.num_perm), 0xFFFFFFFF, np.uint32)
+        if not len(hashes):
+            return signatures
+        values = (
+            (hashes[:, None] * self.multipliers[None, :] + self.increments[None, :])
+            >> np.uint64(32)
+        ).astype(np.uint32)
+        starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+        signatures[owners[starts]] = np.minimum.reduceat(values, starts, axis=0)
+        return signatures
+
+    def add(self, token_lists):
+        """Adds a chunk of trajectories, given as lists of H3 tokens."""
+        for start in range(0, len(token_lists), self.chunk_size):
+            chunk = token_lists[start : start + self.chunk_size]
+            self.signatures_file.write(self.signatures(chunk).tobytes())
+            self.lengths.append(
+                np.fromiter((len(t) for t in chunk), dtype=np.int32, count=len(chunk))
+            )
+            self.count += len(chunk)
+        self.duplicate_of = None
+
+    def addLines(self, lines):
+        """Adds tokenized lines (see lineTokens), streamed chunk by chunk."""
+        chunk = []
+        for line in lines:
+            chunk.append(lineTokens(line))
+            if len(chunk) == self.chunk_size:
+                self.add(chunk)
+                chunk = []
+        if chunk:
+            self.add(chunk)
+
+    def _band_keys(self, signatures, band):
+        rows = self.num_perm // self.bands
+        keys = np.empty(self.count, dtype=np.uint64)
+        for start in range(0, self.count, 1 << 16):
+            block = signatures[
+                start : start + (1 << 16), band * rows : (band + 1) * rows
+            ]
+            key = np.full(len(block), band, dtype=np.uint64)
+            for row in range(rows):
+                key = mix64(
+                    key * SHINGLE_MULTIPLIERS[0] + block[:, row].astype(np.uint64)
+                )
+            keys[start : start + len(block)] = key
+        return keys
+
+    def findDuplicates(self) -> np.ndarray:
+        """
+        Runs the LSH bucketing and verification over all added trajectories.
+
+        Returns:
+            np.ndarray: int64 array, the representative of every duplicate and
+                        -1 for the trajectories that are kept as representatives.
+        """
+        self.signatures_file.flush()
+        duplicate_of = np.full(self.count, -1, dtype=np.int64)
+        if self.count < 2:
+            self.duplicate_of = duplicate_of
+            return duplicate_of
+        signatures = np.memmap(
+            self.signatures_path,
+            dtype=np.uint32,
+            mode="r",
+            shape=(self.count, self.num_perm),
+        )
+        lengths = np.concatenate(self.lengths)
+        best = np.full(self.count, self.count, dtype=np.int64)
+        for band in range(self.bands):
+            keys = self._band_keys(signatures, band)
+            order = np.argsort(keys, kind="stable")
+            sorted_keys = keys[order]
+            starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+            sizes = np.diff(np.r_[starts, self.count])
+            # The first (earliest) trajectory of every bucket is the candidate
+            representatives = np.repeat(order[starts], sizes)
+            candidates = representatives != order
+            members, representatives = order[candidates], representatives[candidates]
+            # Empty trajectories share their signature but are no duplicates
+            valid = (lengths[members] > 0) & (representatives < best[members])
+            members, representatives = members[valid], representatives[valid]
+            # Reads the signatures of the members in file order
+            by_member = np.argsort(members)
+            members, representatives = members[by_member], representatives[by_member]
+            for start in range(0, len(members), 1 << 14):
+                block_members = members[start : start + (1 << 14)]
+                block_representatives = representatives[start : start + (1 << 14)]
+                similarity = (
+                    signatures[block_members] == signatures[block_representatives]
+                ).mean(axis=1)
+                matched = similarity >= self.threshold
+                best[block_members[matched]] = np.minimum(
+                    best[block_members[matched]], block_representatives[matched]
+                )
+        found = best < self.count
+        duplicate_of[found] = best[found]
+        # Follows chains of duplicates to their representative
+        parent = np.where(found, duplicate_of, np.arange(self.count))
+        while True:
+            grand_parent = parent[parent]
+            if np.array_equal(grand_parent, parent):
+                break
+            parent = grand_parent
+        duplicate_of = np.where(parent == np.arange(self.count), -1, parent)
+        self.duplicate_of = duplicate_of
+        return duplicate_of
+
+    def selection(self, policy="drop"):
+        """
+        Chooses the trajectories kept for training.
+
+        With policy "drop" only the representative of every group is kept. With
+        "downweight" a group of n near-duplicates keeps its first ceil(sqrt(n))
+        trajectories, so frequent trajectories still weigh more than rare ones,
+        but sublinearly.
+
+        Returns:
+            tuple: (bool keep mask, float weights) where the weight of a kept
+                   trajectory is the number of trajectories it stands for, zero
+                   for the dropped ones.
+        """
+        if policy not in ("drop", "downweight"):
+            raise ValueError(f"Unknown deduplication policy: {policy}")
+        if self.duplicate_of is None:
+            self.findDuplicates()
+        positions = np.arange(self.count)
+        roots = np.where(self.duplicate_of < 0, positions, self.duplicate_of)
+        sizes = np.bincount(roots, minlength=self.count)
+        order = np.lexsort((positions, roots))
+        group_starts = np.searchsorted(roots[order], roots[order], side="left")
+        rank = np.empty(self.count, dtype=np.int64)
+        rank[order] = np.arange(self.count) - group_starts
+        if policy == "drop":
+            quota = np.ones(self.count, dtype=np.int64)
+        else:
+            quota = np.ceil(np.sqrt(sizes)).astype(np.int64)
+        keep = rank < quota[roots]
+        kept_per_group = np.minimum(sizes, quota)
+        weights = np.where(keep, sizes[roots] / kept_per_group[roots], 0.0)
+        return keep, weights
+
+    def report(self, keep) -> dict:
+        """Corpus reduction of a selection."""
+        lengths = np.concatenate(self.lengths) if self.lengths else np.array([])
+        duplicate_of = self.duplicate_of
+        sizes = np.bincount(
+            np.where(duplicate_of < 0, np.arange(self.count), duplicate_of),
+            minlength=self.count,
+        )
+        tokens_before = int(lengths.sum())
+        tokens_after = int(lengths[keep].sum())
+        kept = int(keep.sum())
+        return {
+            "trajectories": self.count,
+            "kept_trajectories": kept,
+            "near_duplicates": int((duplicate_of >= 0).sum()),
+            "duplicate_groups": int((sizes > 1).sum()),
+            "largest_group": int(sizes.max()) if self.count else 0,
+            "tokens_before": tokens_before,
+            "tokens_after": tokens_after,
+            "trajectory_reduction": 1 - kept / self.count if self.count else 0.0,
+            "token_reduction": (
+                1 - tokens_after / tokens_before if tokens_before else 0.0
+            ),
+        }
+
+
+def dedupLines(lines, policy="drop", threshold=0.8, work_dir=None, **kwargs):
+    """
+    Deduplicates tokenized lines.
+
+    Returns:
+        tuple: (keep mask, weights, report), see NearDuplicateDetector.
+    """
+    with NearDuplicateDetector(work_dir, threshold=threshold, **kwargs) as detector:
+        detector.addLines(lines)
+        keep, weights = detector.selection(policy)
+        return keep, weights, detector.report(keep)
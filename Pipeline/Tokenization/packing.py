@@ -0,0 +1,154 @@
+"""Length bucketing and packing of tokenized sequences"""
+
+import numpy as np
+
+
+def sequenceLength(line):
+    return len(line.split())
+
+
+def paddingEfficiency(lengths, batches):
+    """
+    Share of real tokens in padded batches, every sequence of a batch being
+    padded to the longest one.
+
+    Args:
+        lengths (list of int): The length of every sequence.
+        batches (list of list of int): The sequence positions of every batch.
+
+    Returns:
+        float: real tokens / (real + padding tokens).
+    """
+    lengths = np.asarray(lengths)
+    real, slots = 0, 0
+    for batch in batches:
+        if len(batch):
+            batch_lengths = lengths[batch]
+            real += int(batch_lengths.sum())
+            slots += int(batch_lengths.max()) * len(batch)
+    return real / slots if slots else 1.0
+
+
+def lengthBatches(lengths, batch_size):
+    """
+    Groups sequences of similar length into batches.
+
+    Args:
+        lengths (list of int): The length of every sequence.
+        batch_size (int): Maximum number of sequences per batch.
+
+    Returns:
+        list of list of int: The sequence positions of every batch, shortest first.
+    """
+    order = np.argsort(np.asarray(lengths), kind="stable")
+    return [
+        order[start : start + batch_size].tolist()
+        for start in range(0, len(order), batch_size)
+    ]
+
+
+def bucketingReport(lengths, batch_size):
+    # Padding efficiency of batches in arrival order versus length bucketed ones
+    arrival = [
+        list(range(start, min(start + batch_size, len(lengths))))
+        for start in range(0, len(lengths), batch_size)
+    ]
+    return {
+        "sequences": len(lengths),
+        "batch_size": batch_size,
+        "padding_efficiency_arrival_order": paddingEfficiency(lengths, arrival),
+        "padding_efficiency_bucketed": paddingEfficiency(
+            lengths, lengthBatches(lengths, batch_size)
+        ),
+    }
+
+
+class BlockPacker:
+    """
+    Packs sequences into fixed-length blocks, each sequence followed by a
+    separator, with first-fit over a few open blocks. Blocks are closed (and
+    padded) once no more open blocks are allowed. Sequences longer than a
+    block are spread over consecutive blocks, their remainder goes to a fresh
+    padded block emitted right after them so the sequence stays contiguous.
+
+    Attributes:
+        block_size (int): Number of tokens per block.
+        pad (object): Token (or id) used to fill the end of a block.
+        separator (object): Token (or id) appended to every sequence, None for none.
+        real_tokens (int): Number of sequence and separator tokens packed so far.
+        padding_tokens (int): Number of padding tokens written so far.
+    """
+
+    def __init__(self, block_size, pad, separator=None, open_blocks=8):
+        if block_size <= 0:
+            raise ValueError("block_size must be a positive number of tokens")
+        self.block_size = block_size
+        self.pad = pad
+        self.separator = separator
+        self.open_blocks_limit = open_blocks
+        self.open_blocks = []
+        self.real_tokens, self.padding_tokens = 0, 0
+
+    def add(self, sequence):
+        """
+        Adds one sequence and returns the blocks that got completed.
+        """
+        sequence = list(sequence)
+        if self.separator is not None:
+            sequence.append(self.separator)
+        self.real_tokens += len(sequence)
+        completed = []
+        if len(sequence) >= self.block_size:
+            # Too long to share a block: full blocks go out directly
+            full = len(sequence) - len(sequence) % self.block_size
+            for start in range(0, full, self.block_size):
+                completed.append(sequence[start : start + self.block_size])
+            if full < len(sequence):
+                completed.append(self._pad(sequence[full:]))
+            return completed
+        for block in self.open_blocks:
+            if len(block) + len(sequence) <= self.block_size:
+                block.extend(sequence)
+                break
+        else:
+            self.open_blocks.append(sequence)
+        still_open = []
+        for block in self.open_blocks:
+            if len(block) == self.block_size:
+                completed.append(block)
+            else:
+                still_open.append(block)
+        self.open_blocks = still_open
+        if len(self.open_blocks) > self.open_blocks_limit:
+            # Close the fullest block to make room
+            fullest = max(
+                range(len(self.open_blocks)), key=lambda i: len(self.open_blocks[i])
+            )
+            completed.append(self._pad(self.open_blocks.pop(fullest)))
+        return completed
+
+    def _pad(self, block):
+        missing = self.block_size - len(block)
+        self.padding_tokens += missing
+        return block + [self.pad] * missing
+
+    def flush(self):
+        """Pads and returns every open block."""
+        completed = [self._pad(block) for block in self.open_blocks]
+        self.open_blocks = []
+        return completed
+
+    def efficiency(self):
+        total = self.real_tokens + self.padding_tokens
+        return self.real_tokens / total if total else 1.0
+
+
+def packSequences(lines, block_size, pad="<pad>", separator="\n", open_blocks=8):
+    # Packs tokenized lines into fixed-length token blocks, returns the blocks
+    # and the share of real tokens
+    packer = BlockPacker(block_size, pad, separator, open_blocks)
+    blocks = []
+    for line in lines:
+        blocks.extend(packer.add(line.split()))
+    blocks.extend(packer.flush())
+    return blocks, packer.efficiency()
@@ -0,0 +1,160 @@
+"""Bulk parser for the "lat lon,lat lon,..." trajectory string format"""
+
+import json
+import math
+import warnings
+
+import numpy as np
+
+
+class ParsedTrajectories:
+    """
+    A batch of parsed trajectory strings stored as flat coordinate arrays.
+
+    The points of trajectory i are lat[offsets[i]:offsets[i + 1]] and
+    lon[offsets[i]:offsets[i + 1]].
+
+    Attributes:
+        lat (np.ndarray): float64 latitudes of all points.
+        lon (np.ndarray): float64 longitudes of all points.
+        offsets (np.ndarray): int64 array of length n + 1 with the start of each trajectory.
+        errors (list): (trajectory position, point position, point text) of every
+                       malformed point, these points are left out of the arrays.
+    """
+
+    def __init__(self, lat, lon, offsets, errors):
+        self.lat = lat
+        self.lon = lon
+        self.offsets = offsets
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def points(self, i):
+        """Returns the (lat, lon) arrays of trajectory i without copying."""
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return self.lat[start:end], self.lon[start:end]
+
+    def tolist(self, i):
+        """Returns trajectory i as a list of (lat, lon) tuples."""
+        lat, lon = self.points(i)
+        return list(zip(lat.tolist(), lon.tolist()))
+
+
+def _parseFast(strings, counts):
+    # One native pass over the joined buffer. Every point is followed by an
+    # "inf" marker, so a point with one or three values shifts the markers
+    # even when the total count adds up, and real values must be finite.
+    points = " inf ".join(string for string in strings if string)
+    buffer = points.replace(",", " inf ") + " inf"
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        try:
+            values = np.fromstring(buffer, dtype=np.float64, sep=" ")
+        except (ValueError, DeprecationWarning):
+            return None
+    if len(values) != 3 * counts.sum():
+        return None
+    values = values.reshape(-1, 3)
+    if not np.isposinf(values[:, 2]).all() or not np.isfinite(values[:, :2]).all():
+        return None
+    return values[:, 0].copy(), values[:, 1].copy()
+
+
+def _parsePoint(point):
+    parts = point.split()
+    if len(parts) != 2:
+        raise ValueError(point)
+    y, x = float(parts[0]), float(parts[1])
+    if not (math.isfinite(y) and math.isfinite(x)):
+        raise ValueError(point)
+    return y, x
+
+
+def _parseSlow(strings):
+    # Point by point, only used to locate the malformed points of a batch
+    lat, lon, lengths, errors = [], [], [], []
+    for i, string in enumerate(strings):
+        length = 0
+        for j, point in enumerate(string.split(",") if string else []):
+            try:
+                y, x = _parsePoint(point)
+            except ValueError:
+                errors.append((i, j, point))
+                continue
+            lat.append(y)
+            lon.append(x)
+            length += 1
+        lengths.append(length)
+    return (
+        np.array(lat, dtype=np.float64),
+        np.array(lon, dtype=np.float64),
+        np.array(lengths, dtype=np.int64),
+        errors,
+    )
+
+
+def parseTrajectoryStrings(strings, validate_range=True):
+    """
+    Parses a batch of "lat lon,lat lon,..." strings into flat coordinate arrays.
+    Points that are not exactly two finite numbers are reported as malformed.
+
+    Args:
+        strings (list of str): The trajectory (or summary) strings.
+        validate_range (bool): Whether points outside of [-90, 90] x [-180, 180]
+                               are reported as malformed.
+
+    Returns:
+        ParsedTrajectories: The coordinates, offsets and malformed points.
+    """
+    # Detokenized output may carry a dangling separator after the last point
+    strings = [string.strip(" \t\r\n,") for string in strings]
+    counts = np.fromiter(
+        (string.count(",") + 1 if string else 0 for string in strings),
+        dtype=np.int64,
+        count=len(strings),
+    )
+    errors = []
+    parsed = _parseFast(strings, counts)
+    if parsed is not None:
+        lat, lon = parsed
+        lengths = counts
+    else:
+        lat, lon, lengths, errors = _parseSlow(strings)
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    if validate_range and len(lat):
+        out_of_range = (np.abs(lat) > 90) | (np.abs(lon) > 180)
+        if out_of_range.any():
+            bad = np.flatnonzero(out_of_range)
+            owners = np.searchsorted(offsets, bad, side="right") - 1
+            for point, owner in zip(bad.tolist(), owners.tolist()):
+                errors.append(
+                    (owner, int(point - offsets[owner]), f"{lat[point]} {lon[point]}")
+                )
+            keep = ~out_of_range
+            lat, lon = lat[keep], lon[keep]
+            lengths = np.diff(offsets) - np.bincount(owners, minlength=len(strings))
+            np.cumsum(lengths, out=offsets[1:])
+    return ParsedTrajectories(lat, lon, offsets, errors)
+
+
+def formatMalformedPoints(errors, ids=None, limit=5):
+    # Human readable summary of the malformed points reported by the parser
+    shown = [
+        f"trajectory {ids[i] if ids is not None else i}, point {j}: '{text}'"
+        for i, j, text in errors[:limit]
+    ]
+    more = f" (and {len(errors) - limit} more)" if len(errors) > limit else ""
+    return "; ".join(shown) + more
+
+
+def readTrajectoriesJson(filepath, field="trajectory"):
+    # Reads a trajectories JSON file (input data or detokenized output) and
+    # parses the requested field of every record in one pass
+    with open(filepath, "r") as f:
+        data = json.load(f)
+    ids = [item.get("id") for item in data]
+    return ids, parseTrajectoryStrings([item.get(field, "") for item in data])
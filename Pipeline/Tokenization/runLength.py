@@ -0,0 +1,92 @@
+"""Run-length (stay-point) compression of consecutive duplicate tokens"""
+
+import re
+
+# "<r5>" after a token means the token appears 5 times in a row
+DWELL_TOKEN_PATTERN = re.compile(r"^<r(\d+)>$")
+
+
+def dwellToken(count):
+    return f"<r{count}>"
+
+
+def collapseRuns(tokens, dwell_tokens=True):
+    # Keeps one token per run of identical tokens, followed by a dwell token
+    # with the run length when dwell_tokens is set (needed to be lossless)
+    collapsed = []
+    previous, count = None, 0
+    for token in tokens:
+        if token == previous:
+            count += 1
+            continue
+        if dwell_tokens and count > 1:
+            collapsed.append(dwellToken(count))
+        collapsed.append(token)
+        previous, count = token, 1
+    if dwell_tokens and count > 1:
+        collapsed.append(dwellToken(count))
+    return collapsed
+
+
+def expandRuns(tokens):
+    # Inverse of collapseRuns, repeats the token preceding each dwell token
+    expanded = []
+    for token in tokens:
+        match = DWELL_TOKEN_PATTERN.match(token)
+        if match is None:
+            expanded.append(token)
+        elif expanded:
+            expanded.extend([expanded[-1]] * (int(match.group(1)) - 1))
+    return expanded
+
+
+def isDwellToken(token):
+    return DWELL_TOKEN_PATTERN.match(token) is not None
+
+
+class RunLengthReport:
+    """
+    Sequence length reduction achieved by collapsing runs over a dataset.
+    """
+
+    def __init__(self):
+        self.sequences = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.longest_run = 0
+
+    def add(self, tokens, collapsed):
+        self.sequences += 1
+        self.tokens_before += len(tokens)
+        self.tokens_after += len(collapsed)
+        for token in collapsed:
+            match = DWELL_TOKEN_PATTERN.match(token)
+            if match is not None:
+                self.longest_run = max(self.longest_run, int(match.group(1)))
+
+    def merge(self, stats):
+        # Adds the counts of another report, e.g. one restored from a checkpoint
+        self.sequences += stats["sequences"]
+        self.tokens_before += stats["tokens_before"]
+        self.tokens_after += stats["tokens_after"]
+        self.longest_run = max(self.longest_run, stats["longest_run"])
+
+    def stats(self) -> dict:
+        return {
+            "sequences": self.sequences,
+            "tokens_before": self.tokens_before,
+            "tokens_after": self.tokens_after,
+            "reduction": (
+                1 - self.tokens_after / self.tokens_before
+                if self.tokens_before
+                else 0.0
+            ),
+            "longest_run": self.longest_run,
+        }
+
+
+def collapseTokens(tokens, dwell_tokens=True, report=None):
+    collapsed = collapseRuns(tokens, dwell_tokens)
+    if report is not None:
+        report.add(tokens, collapsed)
+    return collapsed
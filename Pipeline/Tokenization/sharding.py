@@ -0,0 +1,265 @@
+"""Binary training shards written directly from the tokenizer output"""
+
+import fcntl
+import json
+import os
+import pickle
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from TrajPipeline.Pipeline.Tokenization.packing import BlockPacker
+from TrajPipeline.Pipeline.runManifest import atomicFile
+
+SPECIAL_TOKENS = ["\n", "<original>", "<end>", "<summary>", "<pad>"]
+# Special tokens (and "<rN>" dwell tokens) may be glued to an H3 token,
+# e.g. "...ffff<end>"
+TOKEN_PATTERN = re.compile(r"<[a-z0-9]+>|[^\s<]+")
+
+
+def loadVocabulary(path):
+    # The itos list of a nanoGPT meta.pkl, None when there is none yet
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        meta = pickle.load(f)
+    itos = [meta["itos"][i] for i in range(meta["vocab_size"])]
+    if itos[: len(SPECIAL_TOKENS)] != SPECIAL_TOKENS:
+        raise ValueError(f"{path} is not a vocabulary of the shard writer")
+    return itos
+
+
+def writeVocabulary(path, itos):
+    with atomicFile(path, "wb") as f:
+        pickle.dump(
+            {
+                "vocab_size": len(itos),
+                "itos": dict(enumerate(itos)),
+                "stoi": {token: i for i, token in enumerate(itos)},
+            },
+            f,
+        )
+
+
+def _writeAt(path, offset, array):
+    # Chunks of a split are written concurrently, each one at its own offset
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, array.tobytes(), offset)
+    finally:
+        os.close(fd)
+
+
+class TrainingShardWriter:
+    """
+    Streams tokenized trajectory lines into the binary train.bin / val.bin
+    files read by nanoGPT's train.py, so no input.txt / prepare.py pass is
+    needed.
+
+    Every line is encoded with a word level vocabulary (H3 tokens plus the
+    special tokens) and terminated by the newline token, exactly as it would
+    have been separated in input.txt. Lines are assigned to the train or val
+    split with a seeded random draw, and each split is cut into chunks of
+    `shard_size` tokens that a thread pool writes at their offset in the
+    split file while the next lines keep coming in.
+
+    The token ids are written as `dtype`, uint16 by default as train.py
+    memmaps the files as uint16, so the vocabulary must stay below 65536
+    tokens. With `vocab_path` set, the vocabulary is read from and saved
+    back to that meta.pkl, new tokens are appended to it, so a token keeps
+    its id across runs and a model can be trained further on new data. The
+    vocabulary file is locked while the writer is open.
+
+    With `block_size` set, lines are additionally packed into fixed-length
+    blocks that start on a line boundary and end with `<pad>` tokens, so a
+    training batch can be cut at block boundaries. Chunks then hold a whole
+    number of blocks.
+
+    Output layout inside `output_dir`:
+        train.bin, val.bin
+        meta.pkl   -> {"vocab_size", "itos", "stoi"} (nanoGPT format)
+        index.json -> dtype, vocab size and the file and counts per split
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        shard_size: int = 1_000_000,
+        val_fraction: float = 0.1,
+        seed: int = 1337,
+        max_workers: int = 4,
+        dtype=np.uint16,
+        block_size: int = None,
+        vocab_path: str = None,
+    ):
+        if shard_size <= 0:
+            raise ValueError("shard_size must be a positive number of tokens")
+        if not 0 <= val_fraction < 1:
+            raise ValueError("val_fraction must be in [0, 1)")
+        if block_size is not None and not 0 < block_size <= shard_size:
+            raise ValueError("block_size must be positive and at most shard_size")
+        self.output_dir = output_dir
+        self.block_size = block_size
+        if block_size is not None:
+            shard_size -= shard_size % block_size
+        self.shard_size = shard_size
+        self.val_fraction = val_fraction
+        self.dtype = np.dtype(dtype)
+        self.vocab_path = vocab_path
+        self._vocab_lock = None
+        if vocab_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(vocab_path)), exist_ok=True)
+            self._vocab_lock = open(f"{vocab_path}.lock", "a")
+            fcntl.flock(self._vocab_lock, fcntl.LOCK_EX)
+        self.itos = loadVocabulary(vocab_path) or list(SPECIAL_TOKENS)
+        self.stoi = {token: i for i, token in enumerate(self.itos)}
+        self._random = random.Random(seed)
+        self._buffers = {"train": [], "val": []}
+        self._files = {split: f"{split}.bin" for split in ("train", "val")}
+        self._num_tokens = {"train": 0, "val": 0}
+        self._num_chunks = {"train": 0, "val": 0}
+        self._num_sequences = {"train": 0, "val": 0}
+        self._packers = {}
+        if block_size is not None:
+            self._packers = {
+                split: BlockPacker(block_size, pad=self.stoi["<pad>"])
+                for split in ("train", "val")
+            }
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+        self._closed = False
+        os.makedirs(self.output_dir, exist_ok=True)
+        for filename in self._files.values():
+            open(os.path.join(self.output_dir, filename), "wb").close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
+            self._release_vocabulary()
+
+    def _release_vocabulary(self):
+        if self._vocab_lock is not None:
+            fcntl.flock(self._vocab_lock, fcntl.LOCK_UN)
+            self._vocab_lock.close()
+            self._vocab_lock = None
+
+    def encode(self, line: str) -> list:
+        """Maps a tokenized line to token ids, growing the vocabulary as needed."""
+        ids = []
+        for token in TOKEN_PATTERN.findall(line):
+            token_id = self.stoi.get(token)
+            if token_id is None:
+                token_id = len(self.itos)
+                if token_id > np.iinfo(self.dtype).max:
+                    raise ValueError(f"Vocabulary does not fit into {self.dtype.name}")
+                self.stoi[token] = token_id
+                self.itos.append(token)
+            ids.append(token_id)
+        ids.append(self.stoi["\n"])
+        return ids
+
+    def add_line(self, line: str):
+        """Adds one tokenized trajectory line to the train or val split."""
+        if self._closed:
+            raise ValueError("Cannot add lines to a closed shard writer")
+        split = "val" if self._random.random() < self.val_fraction else "train"
+        buffer = self._buffers[split]
+        if self._packers:
+            for block in self._packers[split].add(self.encode(line)):
+                buffer.extend(block)
+        else:
+            buffer.extend(self.encode(line))
+        self._num_sequences[split] += 1
+        self._flush_full_shards(split)
+
+    def _flush_full_shards(self, split: str):
+        buffer = self._buffers[split]
+        while len(buffer) >= self.shard_size:
+            self._flush(split, buffer[: self.shard_size])
+            del buffer[: self.shard_size]
+
+    def add_lines(self, lines):
+        for line in lines:
+            self.add_line(line)
+
+    def _flush(self, split: str, ids: list):
+        array = np.asarray(ids, dtype=self.dtype)
+        offset = self._num_tokens[split] * self.dtype.itemsize
+        self._num_tokens[split] += len(ids)
+        self._num_chunks[split] += 1
+        path = os.path.join(self.output_dir, self._files[split])
+        self._futures.append(self._executor.submit(_writeAt, path, offset, array))
+
+    def close(self) -> dict:
+        """
+        Flushes the partially filled chunks, waits for all writes and stores
+        the vocabulary and the index.
+
+        Returns:
+            dict: The index that was written to index.json.
+        """
+        if self._closed:
+            return self.index()
+        for split, packer in self._packers.items():
+            for block in packer.flush():
+                self._buffers[split].extend(block)
+            self._flush_full_shards(split)
+        for split, buffer in self._buffers.items():
+            if buffer:
+                self._flush(split, list(buffer))
+                buffer.clear()
+        self._executor.shutdown(wait=True)
+        try:
+            for future in self._futures:
+                future.result()
+            writeVocabulary(os.path.join(self.output_dir, "meta.pkl"), self.itos)
+            if self.vocab_path is not None:
+                writeVocabulary(self.vocab_path, self.itos)
+        finally:
+            self._release_vocabulary()
+        index = self.index()
+        with atomicFile(os.path.join(self.output_dir, "index.json"), "w") as f:
+            json.dump(index, f, indent=4)
+        self._closed = True
+        return index
+
+    def index(self) -> dict:
+        return {
+            "dtype": self.dtype.name,
+            "vocab_size": len(self.itos),
+            "shard_size": self.shard_size,
+            "block_size": self.block_size,
+            "splits": {
+                split: {
+                    "file": self._files[split],
+                    "num_sequences": self._num_sequences[split],
+                    "num_tokens": self._num_tokens[split],
+                    "num_chunks": self._num_chunks[split],
+                    "padding_efficiency": (
+                        self._packers[split].efficiency() if self._packers else 1.0
+                    ),
+                }
+                for split in ("train", "val")
+            },
+        }
+
+
+def writeTrainingShards(output_dir: str, data, **kwargs):
+    with TrainingShardWriter(output_dir, **kwargs) as writer:
+        writer.add_lines(data)
+    return writer.index()
+
+
+def readTrainingShards(output_dir: str, split: str = "train"):
+    # Returns the token ids of one split as a single array, mostly for inspection
+    with open(os.path.join(output_dir, "index.json"), "r") as f:
+        index = json.load(f)
+    path = os.path.join(output_dir, index["splits"][split]["file"])
+    return np.fromfile(path, dtype=index["dtype"])
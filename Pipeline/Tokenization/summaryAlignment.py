@@ -0,0 +1,153 @@
+"""Summaries stored as index arrays into their original trajectory"""
+
+import numpy as np
+
+from TrajPipeline.NewPipeline.trajectoryBatchClass import ints_to_tokens, tokens_to_ints
+
+
+def alignSummary(trajectory_lats, trajectory_lons, summary_lats, summary_lons):
+    """
+    Aligns the points of a summary to the points of its trajectory.
+
+    Every summary point is matched to the first identical trajectory point.
+    Identical points share their token and coordinates, so which occurrence is
+    referenced does not change the expanded summary.
+
+    Returns:
+        np.ndarray: int32 array with, for every summary point, the position of the
+                    matching trajectory point or -1 when it does not appear in the
+                    trajectory.
+    """
+    n = len(trajectory_lats)
+    # Built from the end so the first occurrence of a repeated point wins
+    positions = dict(
+        zip(
+            zip(trajectory_lats[::-1], trajectory_lons[::-1]),
+            range(n - 1, -1, -1),
+        )
+    )
+    return np.fromiter(
+        (positions.get(point, -1) for point in zip(summary_lats, summary_lons)),
+        dtype=np.int32,
+        count=len(summary_lats),
+    )
+
+
+def expandSummary(trajectory_tokens, indices, fallback_tokens):
+    # Rebuilds the summary tokens, unmatched points take the next fallback token
+    fallback = iter(fallback_tokens)
+    return [
+        trajectory_tokens[index] if index >= 0 else next(fallback)
+        for index in indices.tolist()
+    ]
+
+
+class SummaryAlignedDataset:
+    """
+    A summarization dataset where each summary is an index array into the tokens
+    of its trajectory, with explicit tokens only for the unmatched points.
+
+    All records are kept in flat arrays with offsets:
+        trajectory_tokens / trajectory_offsets: H3 cells as uint64
+        summary_indices / summary_offsets: int32 positions, -1 for a fallback token
+        fallback_tokens / fallback_offsets: uint64 H3 cells of the unmatched points
+    """
+
+    def __init__(self):
+        self.trajectory_tokens, self.summary_indices, self.fallback_tokens = [], [], []
+        self.trajectory_lengths = []
+        self.summary_lengths = []
+        self.fallback_lengths = []
+
+    def add(self, trajectory_tokens, indices, fallback_tokens):
+        self.trajectory_tokens.append(tokens_to_ints(trajectory_tokens))
+        self.summary_indices.append(np.asarray(indices, dtype=np.int32))
+        self.fallback_tokens.append(tokens_to_ints(fallback_tokens))
+        self.trajectory_lengths.append(len(trajectory_tokens))
+        self.summary_lengths.append(len(indices))
+        self.fallback_lengths.append(len(fallback_tokens))
+
+    def __len__(self):
+        return len(self.trajectory_lengths)
+
+    def keep(self, mask):
+        # Drops the records whose mask entry is False, e.g. near-duplicates
+        for name in (
+            "trajectory_tokens",
+            "summary_indices",
+            "fallback_tokens",
+            "trajectory_lengths",
+            "summary_lengths",
+            "fallback_lengths",
+        ):
+            values = getattr(self, name)
+            setattr(self, name, [value for value, k in zip(values, mask) if k])
+
+    def stats(self) -> dict:
+        """Share of summary points served by the trajectory and bytes saved."""
+        summary_points = sum(self.summary_lengths)
+        fallback_points = sum(self.fallback_lengths)
+        # A text token takes 16 bytes (15 hex digits and a separator)
+        text_bytes = 16 * summary_points
+        aligned_bytes = 4 * summary_points + 8 * fallback_points
+        return {
+            "summaries": len(self),
+            "summary_points": summary_points,
+            "matched_points": summary_points - fallback_points,
+            "matched_ratio": (
+                (summary_points - fallback_points) / summary_points
+                if summary_points
+                else 0.0
+            ),
+            "summary_text_bytes": text_bytes,
+            "summary_aligned_bytes": aligned_bytes,
+        }
+
+    def save(self, filepath):
+        def flat(arrays, dtype):
+            return np.concatenate(arrays) if arrays else np.array([], dtype=dtype)
+
+        def offsets(lengths):
+            result = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=result[1:])
+            return result
+
+        np.savez(
+            filepath,
+            trajectory_tokens=flat(self.trajectory_tokens, np.uint64),
+            trajectory_offsets=offsets(self.trajectory_lengths),
+            summary_indices=flat(self.summary_indices, np.int32),
+            summary_offsets=offsets(self.summary_lengths),
+            fallback_tokens=flat(self.fallback_tokens, np.uint64),
+            fallback_offsets=offsets(self.fallback_lengths),
+        )
+
+
+def readSummaryAlignedDataset(filepath):
+    # Yields (trajectory_tokens, summary_tokens) for every stored record
+    with np.load(filepath) as data:
+        arrays = {name: data[name] for name in data.files}
+    for i in range(len(arrays["trajectory_offsets"]) - 1):
+        start, end = arrays["trajectory_offsets"][i : i + 2]
+        trajectory_tokens = ints_to_tokens(arrays["trajectory_tokens"][start:end])
+        start, end = arrays["summary_offsets"][i : i + 2]
+        indices = arrays["summary_indices"][start:end]
+        start, end = arrays["fallback_offsets"][i : i + 2]
+        fallback_tokens = ints_to_tokens(arrays["fallback_tokens"][start:end])
+        yield trajectory_tokens, expandSummary(
+            trajectory_tokens, indices, fallback_tokens
+        )
+
+
+def summaryPoints(trajectory_lats, trajectory_lons, indices, fallback_points):
+    # Original GPS points of a summary: matched points are taken straight from
+    # the trajectory, fallback_points holds the (lat, lon) of the others
+    fallback = iter(fallback_points)
+    return [
+        (
+            (trajectory_lats[index], trajectory_lons[index])
+            if index >= 0
+            else next(fallback)
+        )
+        for index in indices.tolist()
+    ]
@@ -1,4 +1,14 @@
 import h3
+from TrajPipeline.Pipeline.Tokenization.parsing import (
+    formatMalformedPoints,
+    parseTrajectoryStrings,
+)
+from TrajPipeline.Pipeline.Tokenization.summaryAlignment import (
+    alignSummary,
+    expandSummary,
+)
+from TrajPipeline.Pipeline.Tokenization.runLength import collapseTokens
+from TrajPipeline.Pipeline.runManifest import atomicFile
 
 
 def token2centroid_h3_yx(lat, long):
@@ -8,36 +18,89 @@ def token2centroid_h3_yx(lat, long):
 
 
 def tokenizeTrajectories(data, mode):
-    result_lines = []
-
-    for item in data:
-        trajectory_id = item["id"]
-        trajectory_points = item["trajectory"].split(",")
-        summary_tokens, trajectory_tokens = [], []
-        # For each line in data (trajectory, summary) apply the defined tokenization function
-        trajectory_tokens = [
-            token2centroid_h3_yx(float(lat), float(long))
-            for lat, long in (point.split() for point in trajectory_points)
-        ]
-        if mode != "generation_training":
-            summary_points = item["summary"].split(",")
+    return list(iterTokenizeTrajectories(data, mode))
+
+
+def parseRecords(records, field):
+    parsed = parseTrajectoryStrings([item[field] for item in records])
+    if parsed.errors:
+        ids = [item.get("id") for item in records]
+        raise ValueError(
+            f"Malformed {field} points: {formatMalformedPoints(parsed.errors, ids)}"
+        )
+    return parsed
+
 
-            summary_tokens = [
-                token2centroid_h3_yx(float(lat), float(long))
-                for lat, long in (point.split() for point in summary_points)
-            ]
-        if mode == "summarization_training":
-            result_line = f'<original> {" ".join(trajectory_tokens)} <end> <summary> {" ".join(summary_tokens)}<end>'
-        elif mode == "summarization_testing":
-            result_line = f'<original> {" ".join(trajectory_tokens)} <end> <summary> {" ".join(summary_tokens)}'
-        elif mode == "generation_training":
-            result_line = f'{" ".join(trajectory_tokens)}'
-        result_lines.append(result_line)
+def tokenizeParsed(parsed, i):
+    lat, lon = parsed.points(i)
+    return [token2centroid_h3_yx(y, x) for y, x in zip(lat.tolist(), lon.tolist())]
 
-    return result_lines
+
+def tokenizeSummary(trajectories, summaries, i, trajectory_tokens):
+    # Summary points are mostly a subset of the trajectory points, those reuse
+    # the trajectory tokens and only the unmatched ones go through H3
+    trajectory_lats, trajectory_lons = trajectories.points(i)
+    summary_lats, summary_lons = summaries.points(i)
+    summary_lats, summary_lons = summary_lats.tolist(), summary_lons.tolist()
+    indices = alignSummary(
+        trajectory_lats.tolist(), trajectory_lons.tolist(), summary_lats, summary_lons
+    )
+    fallback_tokens = [
+        token2centroid_h3_yx(summary_lats[j], summary_lons[j])
+        for j in (indices < 0).nonzero()[0].tolist()
+    ]
+    summary_tokens = expandSummary(trajectory_tokens, indices, fallback_tokens)
+    return summary_tokens, indices, fallback_tokens
+
+
+def iterTokenizeTrajectories(
+    data,
+    mode,
+    chunk_size=1024,
+    aligned_dataset=None,
+    collapse_runs=False,
+    dwell_tokens=True,
+    run_length_report=None,
+):
+    # Yields the tokenized lines one by one so consumers (e.g. the training
+    # shard writer) can start working while tokenization is still running.
+    # The point strings of each chunk of records are parsed in one bulk pass.
+    # If aligned_dataset (a SummaryAlignedDataset) is given, every summary is
+    # also added to it as an index array into its trajectory.
+    # With collapse_runs, consecutive duplicate tokens are collapsed into one
+    # (plus a "<rN>" dwell token) and the reduction is added to run_length_report.
+    for chunk_start in range(0, len(data), chunk_size):
+        chunk = data[chunk_start : chunk_start + chunk_size]
+        trajectories = parseRecords(chunk, "trajectory")
+        if mode != "generation_training":
+            summaries = parseRecords(chunk, "summary")
+        for i in range(len(chunk)):
+            summary_tokens, trajectory_tokens = [], []
+            # For each line in data (trajectory, summary) apply the defined tokenization function
+            trajectory_tokens = tokenizeParsed(trajectories, i)
+            if mode != "generation_training":
+                summary_tokens, indices, fallback_tokens = tokenizeSummary(
+                    trajectories, summaries, i, trajectory_tokens
+                )
+                if aligned_dataset is not None:
+                    aligned_dataset.add(trajectory_tokens, indices, fallback_tokens)
+            if collapse_runs:
+                trajectory_tokens = collapseTokens(
+                    trajectory_tokens, dwell_tokens, run_length_report
+                )
+                summary_tokens = collapseTokens(
+                    summary_tokens, dwell_tokens, run_length_report
+                )
+            if mode == "summarization_training":
+                result_line = f'<original> {" ".join(trajectory_tokens)} <end> <summary> {" ".join(summary_tokens)}<end>'
+            elif mode == "summarization_testing":
+                result_line = f'<original> {" ".join(trajectory_tokens)} <end> <summary> {" ".join(summary_tokens)}'
+            elif mode == "generation_training":
+                result_line = f'{" ".join(trajectory_tokens)}'
+            yield result_line
 
 
 def writeTokenizedTrajectories(filepath: str, data):
-    with open(filepath, "w") as file:
+    with atomicFile(filepath) as file:
         for line in data:
             file.write(line + "\n")
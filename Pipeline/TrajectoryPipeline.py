@@ -1,24 +1,246 @@
 import json
 from typing import List, Dict
 from TrajPipeline.Pipeline.Tokenization.tokenization import *
+from TrajPipeline.Pipeline.Tokenization.sharding import TrainingShardWriter
+from TrajPipeline.Pipeline.Tokenization.summaryAlignment import SummaryAlignedDataset
+from TrajPipeline.Pipeline.Tokenization.runLength import RunLengthReport
+from TrajPipeline.Pipeline.Tokenization.dedup import NearDuplicateDetector
+from TrajPipeline.Pipeline.Tokenization.parsing import (
+    formatMalformedPoints,
+    parseTrajectoryStrings,
+)
+from TrajPipeline.Pipeline.Tokenization.summaryAlignment import alignSummary
+from TrajPipeline.Pipeline.Tokenization.packing import (
+    bucketingReport,
+    lengthBatches,
+    sequenceLength,
+)
 from TrajPipeline.Pipeline.Detokenization.detokenization import *
+from TrajPipeline.Pipeline.Evaluation.evaluation import (
+    evaluateDetokenizedOutput,
+    formatSummary,
+)
+from TrajPipeline.Pipeline.runManifest import RunManifest, atomicFile, runFingerprint
+from TrajPipeline.NewPipeline.cacheClass import DEFAULT_CACHE_DIR, ResultCache
+from TrajPipeline.NewPipeline.noiseFilterClass import NoiseFilter
+from contextlib import contextmanager
+import ast
+import fcntl
+import itertools
 import os
+import shutil
 import subprocess
 import logging
+import threading
+import time
+import uuid
+
+import numpy as np
+
+# Pipelines of one process share a single ResultCache per cache directory
+_result_caches = {}
+_result_caches_lock = threading.Lock()
+
+
+def sharedResultCache(cache_dir):
+    cache_dir = os.path.abspath(cache_dir)
+    with _result_caches_lock:
+        if cache_dir not in _result_caches:
+            _result_caches[cache_dir] = ResultCache(cache_dir)
+        return _result_caches[cache_dir]
+
+
+@contextmanager
+def modelLock(model_path):
+    # The nanoGPT scripts read and write fixed files in their own directory, so
+    # only one pipeline (thread or process) at a time may drive a model
+    with open(os.path.join(model_path, ".pipeline.lock"), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def newRunId():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def moveInto(source_dir, target_dir):
+    # Moves the files of source_dir over those of target_dir, each one appearing
+    # at once in target_dir. Subdirectories are merged the same way, a directory
+    # can't replace a non-empty one.
+    os.makedirs(target_dir, exist_ok=True)
+    for name in os.listdir(source_dir):
+        source, target = os.path.join(source_dir, name), os.path.join(target_dir, name)
+        if os.path.isdir(source) and os.path.isdir(target):
+            moveInto(source, target)
+            os.rmdir(source)
+            continue
+        tmp_path = os.path.join(target_dir, f".{name}.{os.getpid()}.tmp")
+        shutil.move(source, tmp_path)
+        os.replace(tmp_path, target)
+
+
+def readTrainingConfig(config_path):
+    # The top-level assignments of literal values of a nanoGPT config file.
+    # nanoGPT's configurator executes the file, only the values the pipeline
+    # needs (out_dir, init_from) are read here, without running any code.
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, "r") as file:
+        tree = ast.parse(file.read(), config_path)
+    config = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign):
+            continue
+        try:
+            value = ast.literal_eval(node.value)
+        except ValueError:
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                config[target.id] = value
+    return config
+
+
+def pruneRuns(runs_dir, max_age_days, keep=()):
+    """
+    Removes the run directories of runs_dir in which nothing changed for
+    max_age_days. Runs holding a training dataset (a data/ directory) are kept,
+    as the checkpoints trained on them read their vocabulary from there.
+
+    Returns:
+        list of str: The removed directories.
+    """
+    if max_age_days is None or not os.path.isdir(runs_dir):
+        return []
+    cutoff = time.time() - max_age_days * 86400
+    keep = {os.path.abspath(path) for path in keep}
+    removed = []
+    for name in os.listdir(runs_dir):
+        path = os.path.abspath(os.path.join(runs_dir, name))
+        if not os.path.isdir(path) or any(
+            kept == path or kept.startswith(path + os.sep) for kept in keep
+        ):
+            continue
+        stale = True
+        for directory, subdirectories, files in os.walk(path):
+            if "data" in subdirectories or any(
+                os.path.getmtime(os.path.join(directory, entry)) > cutoff
+                for entry in files + subdirectories
+            ):
+                stale = False
+                break
+        if stale:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+    return removed
 
 
 class TrajectoryPipeline:
-    def __init__(self):
+    def __init__(self, run_dir=None, bert_imputer=None):
         self.trajectories = []
         self.summaries = []
         self.params = {}
         self.mode, self.city, self.input_file_path = "", "", ""
         self.trajectories_length, self.trajectories_count = 0, 0
+        self.seed = None
         self.data = []
+        # Optional noise filtering of the input trajectories, None or the keyword
+        # arguments of a NoiseFilter. The input has no timestamps, the speed
+        # outliers are only removed when "sample_interval" is given.
+        self.noise_filter, self.noise_filter_report = None, None
         # Get the directory of the pipeline
         self.script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.bert_imputer_instance = BERTImputer()
+        # Every run writes its intermediate files to its own directory, so several
+        # pipelines can run side by side without clobbering each other. Without
+        # an explicit run_dir, a checkpointed run moves to Runs/run-<fingerprint>
+        # when it starts, so running the same params again resumes it.
+        self.run_id = newRunId()
+        self.runs_path = os.path.join(self.script_dir, "Runs")
+        self.run_dir = run_dir or os.path.join(self.runs_path, self.run_id)
+        self.run_dir_given = run_dir is not None
+        # Run directories of runs_path untouched for that many days are removed
+        # when a run starts (None keeps them all)
+        self.runs_max_age_days = 7
+        # The detokenization bundle is read only, pipelines may share one instance
+        self.bert_imputer_instance = bert_imputer or BERTImputer()
         self.tokenized_trajectories, self.detokenized_trajectories = [], []
+        self.transformers_path = "/speakingTrajectories/Transformers"
+        # Training modes get their tokens as binary shards in these datasets of the
+        # run directory, train.py is pointed to them with --dataset
+        self.training_datasets = {
+            "summarization_training": "data/newTrajectorySummary",
+            "generation_training": "data/newTrajectoryGeneration",
+        }
+        self.shard_size, self.val_fraction = 1_000_000, 0.1
+        # The vocabulary of every training dataset outlives the runs, so a token
+        # keeps its id from one training run to the next
+        self.vocabularies_path = os.path.join(self.script_dir, "ModelsRepo", "vocab")
+        # Optional fixed-length packing of the training shards (None keeps one stream)
+        self.block_size = None
+        # summarization_testing requests are sent to the model ordered by length.
+        # The script batches the request file itself, inference_batch_size only
+        # sizes the padding report of the bucketing.
+        self.length_bucketing, self.inference_batch_size = True, 32
+        self.training_shards_index = {}
+        # Detokenized output as indented JSON (default) or compact JSONL
+        self.compact_output = False
+        # One of DETOKENIZATION_TIERS, trading precision for detokenization speed
+        self.detokenization_tier = "cluster_centroid"
+        # summarization_training can also store summaries as indices into their trajectory
+        self.store_aligned_summaries = False
+        # Optional collapsing of consecutive duplicate tokens ("<rN>" dwell tokens keep it lossless)
+        self.collapse_runs, self.dwell_tokens = False, True
+        self.run_length_report = None
+        # Near-duplicate trajectories of the training data are dropped ("drop"
+        # keeps one per group) or down-weighted ("downweight" keeps about the
+        # square root of a group size), None keeps everything
+        self.dedup, self.dedup_threshold, self.dedup_report = None, 0.8, None
+        # summarization_testing output can be evaluated against the input data,
+        # opt-in with "evaluate": true (None for evaluation_workers uses every CPU)
+        self.evaluate, self.evaluation_workers = False, None
+        self.evaluation_summary = None
+        # Stages and chunks are checkpointed in a manifest of the run directory,
+        # running again in the same run directory resumes an interrupted run
+        self.checkpointing, self.checkpoint_chunk_size = True, 1024
+        self.manifest, self._stage_failed = None, False
+        # The first stage of the last run_pipeline call that failed, if any
+        self.failed_stage = None
+        # Outputs of the testing modes are cached per model, mode, input and params
+        self.use_result_cache = True
+        # The model_path of the pyramid cell serving the testing modes, the cache
+        # entries are tagged with it so updating that cell invalidates them.
+        # None is the checkpoint of the nanoGPT directory.
+        self.model_cell_path = None
+        self.result_cache = sharedResultCache(DEFAULT_CACHE_DIR)
+
+    def runPath(self, relative_path):
+        # Path of an intermediate file of this run, its directory is created on demand
+        path = os.path.join(self.run_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    @property
+    def tokenized_trajectories_path(self):
+        return self.runPath("Tokenization/tokenizedTrajectories.txt")
+
+    @property
+    def model_output_path(self):
+        return self.runPath("Detokenization/tokenizedTrajectories.txt")
+
+    @property
+    def detokenized_trajectories_path(self):
+        return self.runPath("Detokenization/detokenizedTrajectories.json")
+
+    @property
+    def evaluation_metrics_path(self):
+        return self.runPath("Evaluation/metrics.csv")
+
+    @property
+    def evaluation_summary_path(self):
+        return self.runPath("Evaluation/evaluation.json")
 
     def load_data(self):
         with open(self.input_file_path, "r") as file:
@@ -31,14 +253,59 @@ class TrajectoryPipeline:
                     self.trajectories = [item["trajectory"] for item in self.data]
             else:
                 raise ValueError("Invalid data format")
+        if self.noise_filter is not None:
+            self.filterNoise()
+
+    def filterNoise(self):
+        # Drops the noisy points of the loaded trajectories in one vectorized pass.
+        # Points of the summaries are protected, so every summary stays a
+        # subset of its trajectory.
+        parsed = parseTrajectoryStrings(self.trajectories)
+        if parsed.errors:
+            ids = [item.get("id") for item in self.data]
+            raise ValueError(
+                f"Malformed trajectory points: {formatMalformedPoints(parsed.errors, ids)}"
+            )
+        protected = None
+        if self.summaries:
+            summaries = parseTrajectoryStrings(self.summaries)
+            protected = np.zeros(len(parsed.lat), dtype=bool)
+            for i in range(len(parsed)):
+                lat, lon = parsed.points(i)
+                summary_lat, summary_lon = summaries.points(i)
+                indices = alignSummary(
+                    lat.tolist(),
+                    lon.tolist(),
+                    summary_lat.tolist(),
+                    summary_lon.tolist(),
+                )
+                protected[parsed.offsets[i] + indices[indices >= 0]] = True
+        keep, self.noise_filter_report = NoiseFilter(**self.noise_filter).filter_arrays(
+            parsed.lat, parsed.lon, parsed.offsets, protected=protected
+        )
+        # The kept point strings are copied as they are, without reformatting
+        bounds = parsed.offsets.tolist()
+        keep = keep.tolist()
+        for i, item in enumerate(self.data):
+            points = item["trajectory"].strip(" \t\r\n,").split(",")
+            kept = keep[bounds[i] : bounds[i + 1]]
+            trajectory = ",".join(point for point, k in zip(points, kept) if k)
+            self.data[i] = {**item, "trajectory": trajectory}
+            self.trajectories[i] = trajectory
+        print("Noise filtering:", self.noise_filter_report)
 
     def load_params(self, filepath: str):
         with open(filepath, "r") as file:
             params = json.load(file)
+        self.set_params(params)
 
+    def set_params(self, params: Dict[str, str]):
         self.mode = params.get("mode", self.mode)
         self.city = params.get("city", self.city)
         self.input_file_path = params.get("input_path", self.input_file_path)
+        if "run_dir" in params:
+            self.run_dir, self.run_dir_given = params["run_dir"], True
+        self.noise_filter = params.get("noise_filter", self.noise_filter)
         # The only case we don't need to load a dataset is when a user wants generation testing
         if self.mode != "generation_testing":
             self.load_data()
@@ -48,6 +315,41 @@ class TrajectoryPipeline:
         self.trajectories_count = params.get(
             "trajectories_count", self.trajectories_count
         )
+        self.seed = params.get("seed", self.seed)
+        self.compact_output = params.get("compact_output", self.compact_output)
+        self.detokenization_tier = params.get(
+            "detokenization_tier", self.detokenization_tier
+        )
+        if self.detokenization_tier not in DETOKENIZATION_TIERS:
+            raise ValueError(
+                f"Unknown detokenization tier {self.detokenization_tier!r}, "
+                f"expected one of {', '.join(DETOKENIZATION_TIERS)}"
+            )
+        self.store_aligned_summaries = params.get(
+            "store_aligned_summaries", self.store_aligned_summaries
+        )
+        self.collapse_runs = params.get("collapse_runs", self.collapse_runs)
+        self.dwell_tokens = params.get("dwell_tokens", self.dwell_tokens)
+        self.dedup = params.get("dedup", self.dedup)
+        if self.dedup not in (None, "drop", "downweight"):
+            raise ValueError(f"Unknown deduplication policy: {self.dedup}")
+        self.dedup_threshold = float(
+            params.get("dedup_threshold", self.dedup_threshold)
+        )
+        self.runs_max_age_days = params.get("runs_max_age_days", self.runs_max_age_days)
+        self.evaluate = params.get("evaluate", self.evaluate)
+        self.evaluation_workers = params.get(
+            "evaluation_workers", self.evaluation_workers
+        )
+        self.block_size = params.get("block_size", self.block_size)
+        self.length_bucketing = params.get("length_bucketing", self.length_bucketing)
+        self.inference_batch_size = params.get(
+            "inference_batch_size", self.inference_batch_size
+        )
+        self.checkpointing = params.get("checkpointing", self.checkpointing)
+        self.checkpoint_chunk_size = params.get(
+            "checkpoint_chunk_size", self.checkpoint_chunk_size
+        )
         print("Params loaded successfully...")
 
     def save_data(self, filepath: str, data: List[Dict[str, str]]):
@@ -60,41 +362,203 @@ class TrajectoryPipeline:
 
     def tokenizationModule(self):
         # Go to Tokenization directory do the tokenization based on the scripts over there to the data loaded here.
-        tokenized_trajectories_path = os.path.join(
-            self.script_dir, "Tokenization/tokenizedTrajectories.txt"
-        )
-        self.tokenized_trajectories = tokenizeTrajectories(
-            data=self.data, mode=self.mode
-        )
+        tokenized_trajectories_path = self.tokenized_trajectories_path
+        self.run_length_report = RunLengthReport() if self.collapse_runs else None
+        if self.mode in self.training_datasets:
+            # Shards are written in parallel while the lines are being tokenized
+            shards_path = self.runPath(self.training_datasets[self.mode])
+            self.tokenized_trajectories = []
+            aligned_dataset = None
+            if self.store_aligned_summaries and self.mode == "summarization_training":
+                aligned_dataset = SummaryAlignedDataset()
+            lines = self.iterTokenizedLines(aligned_dataset)
+            if self.dedup is not None:
+                # Deduplication needs to see every line, sharding starts once it is done
+                lines = self.dedupTokenizedLines(lines, aligned_dataset)
+            with TrainingShardWriter(
+                shards_path,
+                shard_size=self.shard_size,
+                val_fraction=self.val_fraction,
+                block_size=self.block_size,
+                vocab_path=os.path.join(
+                    self.vocabularies_path,
+                    os.path.basename(self.training_datasets[self.mode]) + ".pkl",
+                ),
+            ) as shard_writer:
+                for line in lines:
+                    self.tokenized_trajectories.append(line)
+                    shard_writer.add_line(line)
+            self.training_shards_index = shard_writer.index()
+            print(f"Training shards written to {shards_path}")
+            if self.block_size is not None:
+                print(
+                    "Padding efficiency of the packed blocks:",
+                    self.training_shards_index["splits"]["train"]["padding_efficiency"],
+                )
+            if aligned_dataset is not None:
+                aligned_dataset_path = self.runPath(
+                    "Tokenization/summaryAlignedDataset.npz"
+                )
+                aligned_dataset.save(aligned_dataset_path)
+                print("Summary alignment:", aligned_dataset.stats())
+        else:
+            self.tokenized_trajectories = list(self.iterTokenizedLines())
         writeTokenizedTrajectories(
             filepath=tokenized_trajectories_path, data=self.tokenized_trajectories
         )
         print(f"Tokenization complete to {tokenized_trajectories_path}")
+        if self.run_length_report is not None:
+            print("Run-length compression:", self.run_length_report.stats())
         # Now I wrote the tokenized data, and I also have it stored in my variable self.tokenized_trajectories.
 
+    def dedupTokenizedLines(self, lines, aligned_dataset=None):
+        # Yields the lines selected by the near-duplicate detection in two passes:
+        # the first one spools the lines to a file of the run while computing
+        # their signatures, the second one streams the kept lines back from it
+        spool_path = self.runPath("Tokenization/dedupSpool.txt")
+        with NearDuplicateDetector(threshold=self.dedup_threshold) as detector:
+            with open(spool_path, "w") as spool:
+
+                def spooled():
+                    for line in lines:
+                        spool.write(line + "\n")
+                        yield line
+
+                detector.addLines(spooled())
+            keep, _ = detector.selection(self.dedup)
+            self.dedup_report = detector.report(keep)
+        if aligned_dataset is not None:
+            aligned_dataset.keep(keep)
+        print("Near-duplicate reduction:", self.dedup_report)
+        try:
+            with open(spool_path, "r") as spool:
+                for line, kept in zip(spool, keep.tolist()):
+                    if kept:
+                        yield line.rstrip("\n")
+        finally:
+            os.remove(spool_path)
+
+    def iterTokenizedLines(self, aligned_dataset=None):
+        # Tokenizes self.data chunk by chunk. With a run manifest every chunk is
+        # checkpointed, and the chunks completed by an interrupted run are read
+        # back instead of being tokenized again. The summary alignment is only
+        # held in memory, so it always needs the chunks to be tokenized.
+        chunk_size = self.checkpoint_chunk_size
+        for index, start in enumerate(range(0, len(self.data), chunk_size)):
+            info = None
+            if self.manifest is not None and aligned_dataset is None:
+                info = self.manifest.chunk("tokenization", index)
+            if info is not None:
+                with open(info["path"], "r") as file:
+                    lines = file.read().splitlines()
+                if self.run_length_report is not None:
+                    self.run_length_report.merge(info["run_length"])
+            else:
+                report = RunLengthReport() if self.collapse_runs else None
+                lines = list(
+                    iterTokenizeTrajectories(
+                        data=self.data[start : start + chunk_size],
+                        mode=self.mode,
+                        chunk_size=chunk_size,
+                        aligned_dataset=aligned_dataset,
+                        collapse_runs=self.collapse_runs,
+                        dwell_tokens=self.dwell_tokens,
+                        run_length_report=report,
+                    )
+                )
+                if report is not None:
+                    self.run_length_report.merge(report.stats())
+                if self.manifest is not None:
+                    path = self.manifest.chunk_path("tokenization", index)
+                    writeTokenizedTrajectories(filepath=path, data=lines)
+                    self.manifest.mark_chunk(
+                        "tokenization",
+                        index,
+                        path,
+                        lines=len(lines),
+                        run_length=report.stats() if report is not None else None,
+                    )
+            yield from lines
+
     def deTokenizationModule(self):
         # Go to Detokenization directory do the detokenization based on the scripts over there to the data loaded here.
 
-        tokenized_trajectories_path = os.path.join(
-            self.script_dir, "Detokenization/tokenizedTrajectories.txt"
-        )
-        deTokenized_trajectories_path = os.path.join(
-            self.script_dir, "Detokenization/detokenizedTrajectories.json"
-        )
-        self.detokenized_trajectories = detokenizeTrajectories(
-            tokenized_trajectories_path,
-            self.bert_imputer_instance,
-            mode=self.mode,
-        )
-        # print("Hello")
-        # print(self.detokenized_trajectories)
-        writeDetokenizedTrajectories(
-            detokenized_trajectories=self.detokenized_trajectories,
-            output_file=deTokenized_trajectories_path,
-            mode=self.mode,
-        )
+        tokenized_trajectories_path = self.model_output_path
+        deTokenized_trajectories_path = self.detokenized_trajectories_path
+        # Points are detokenized line by line and streamed straight to the output file
+        if self.manifest is not None:
+            records = self.iterDetokenizedChunks(tokenized_trajectories_path)
+        else:
+            records = iterDetokenizeTrajectories(
+                tokenized_trajectories_path,
+                self.bert_imputer_instance,
+                self.mode,
+                self.detokenization_tier,
+            )
+        with DetokenizedTrajectoriesWriter(
+            deTokenized_trajectories_path, self.mode, compact=self.compact_output
+        ) as writer:
+            for trajectory, summary in records:
+                writer.write(trajectory, summary)
         print("Detokenization complete. Data saved to", deTokenized_trajectories_path)
 
+    def iterDetokenizedChunks(self, tokenized_trajectories_path):
+        # Detokenizes the model output chunk by chunk, every chunk is kept as
+        # JSONL of formatted points and recorded in the run manifest
+        chunk_size = self.checkpoint_chunk_size
+        with open(tokenized_trajectories_path, "r") as f:
+            index = 0
+            while True:
+                lines = list(itertools.islice(f, chunk_size))
+                if not lines:
+                    break
+                info = self.manifest.chunk("detokenization", index)
+                if info is not None:
+                    with open(info["path"], "r") as file:
+                        records = [json.loads(record) for record in file]
+                else:
+                    records = []
+                    for line in lines:
+                        trajectory, summary = iterDetokenizeLineArrays(
+                            line,
+                            self.bert_imputer_instance,
+                            self.mode,
+                            self.detokenization_tier,
+                        )
+                        record = {"trajectory": formatPoints(*trajectory)}
+                        if summary is not None:
+                            record["summary"] = formatPoints(*summary)
+                        records.append(record)
+                    path = self.manifest.chunk_path("detokenization", index, "jsonl")
+                    with atomicFile(path) as file:
+                        for record in records:
+                            file.write(json.dumps(record) + "\n")
+                    self.manifest.mark_chunk(
+                        "detokenization", index, path, records=len(records)
+                    )
+                for record in records:
+                    yield record["trajectory"], record.get("summary")
+                index += 1
+
+    def evaluationModule(self):
+        # Compares the detokenized output to the input data: metrics of every
+        # trajectory go to a CSV file and their aggregates to a JSON file
+        metrics, self.evaluation_summary = evaluateDetokenizedOutput(
+            self.detokenized_trajectories_path,
+            self.trajectories,
+            self.summaries or None,
+            metrics_path=self.evaluation_metrics_path,
+            max_workers=self.evaluation_workers,
+        )
+        with atomicFile(self.evaluation_summary_path) as file:
+            json.dump(self.evaluation_summary, file, indent=4)
+        print(formatSummary(self.evaluation_summary))
+        print("Evaluation complete. Metrics saved to", self.evaluation_metrics_path)
+
+    def restoreEvaluation(self):
+        with open(self.evaluation_summary_path, "r") as file:
+            self.evaluation_summary = json.load(file)
+
     def fineTuningModule(self):
         # Go to finetuning directory and see training params over there, the user can edit them to tune their model.
         # we should read the params from there and tune the model accordingly.
@@ -105,94 +569,82 @@ class TrajectoryPipeline:
         # we should read the constraints from there and adjust the model accordingly to apply these rules.
         pass
 
+    def trainModel(self, configurations_model_path, task):
+        # The training data is already sharded by tokenizationModule, so train.py can start right away
+        working_directory = os.path.join(self.transformers_path, "nanoGPT")
+        training_model_path = "train.py"
+        # nanoGPT joins data/ with the dataset name, an absolute path is used as is
+        dataset_path = os.path.abspath(self.runPath(self.training_datasets[self.mode]))
+        # Training writes its checkpoint to the run directory, only the handoff
+        # with the out_dir of the config (shared by every run) holds the model lock
+        config_path = os.path.join(working_directory, configurations_model_path)
+        config = readTrainingConfig(config_path)
+        shared_out_dir = os.path.join(working_directory, config.get("out_dir", "out"))
+        out_dir = os.path.abspath(os.path.dirname(self.runPath("Model/out/ckpt.pt")))
+        if config.get("init_from") == "resume" and os.path.isdir(shared_out_dir):
+            with modelLock(working_directory):
+                shutil.copytree(shared_out_dir, out_dir, dirs_exist_ok=True)
+        print("Starting Model Training Now...")
+        # Assuming I have the new model architecure
+        try:
+            # The script runs in the nanoGPT directory, the cwd of this process is left alone
+            process = subprocess.run(
+                [
+                    "python",
+                    training_model_path,
+                    configurations_model_path,
+                    f"--dataset={dataset_path}",
+                    f"--out_dir={out_dir}",
+                ],
+                cwd=working_directory,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+            )
+            print("Script output:", process.stdout)
+            with modelLock(working_directory):
+                moveInto(out_dir, shared_out_dir)
+                # Cached outputs of the previous model must not be served anymore
+                self.result_cache.invalidate_model(working_directory)
+            print(f"Trained model for {task} successfully.")
+            return True
+        except subprocess.CalledProcessError as e:
+            print(f"Error training model for {task}:", e)
+            # stderr is merged into stdout
+            print("Script error output:", e.stdout)
+            return False
+
     def modelsRepository(self):
-        transformers_path = "/speakingTrajectories/Transformers"
+        # Returns whether the model step succeeded
+        transformers_path = self.transformers_path
         # This where we will dump the output, i.e. from generated_trajecories and simplified_trajectories from Transformers
         # These will still be tokenized, as output of Transformers is tokens, so we pass this to Detokenization and we are done.
         # This is only needed in the "Testing" Phase
-        final_trajectories_path = os.path.join(
-            self.script_dir, "Detokenization/tokenizedTrajectories.txt"
-        )
-        working_directory = "/speakingTrajectories/Transformers/nanoGPT"
-        training_model_path = "train.py"
+        final_trajectories_path = self.model_output_path
+        model_path = os.path.join(transformers_path, "nanoGPT")
 
         # Go to models repo directory and save/load the model there. We need to apply the pyramid idea, but not now.
         if self.mode == "summarization_training":
-            # I need to pass the given self.tokenized_trajectories to /speakingTrajectories/Transformers/nanoGPT/data/trajectorySummary/input.txt
-            # Then run prepare.py and start the training process with the new finetuning arch. and (spatial constrainsts?).
-            configurations_model_path = "config/train_trajectory_summary.py"
-            input_trajectories_path = os.path.join(
-                transformers_path, "nanoGPT/data/newTrajectorySummary"
+            # tokenizationModule already wrote self.tokenized_trajectories as train/val shards to
+            # data/newTrajectorySummary in the run directory
+            # so we start the training process with the new finetuning arch. and (spatial constrainsts?).
+            return self.trainModel(
+                "config/train_trajectory_summary.py", "summarization"
             )
-
-            with open(os.path.join(input_trajectories_path, "input.txt"), "w") as file:
-                for line in self.tokenized_trajectories:
-                    file.write(line + "\n")
-
-            try:
-                result = subprocess.run(
-                    ["python", os.path.join(input_trajectories_path, "prepare.py")],
-                    capture_output=True,
-                    text=True,
-                )
-                print("Script output:", result.stdout)
-                print("Data prepared successfully for the model...")
-            except subprocess.CalledProcessError as e:
-                print("Error preparing data for the model:", e)
-            print("Starting Model Training Now...")
-            # Assuming I have the new model architecure
-            os.chdir(working_directory)
-            try:
-                process = subprocess.run(
-                    ["python", training_model_path, configurations_model_path],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                )
-                print("Script output:", process.stdout)
-                print("Trained model for summarization successfully.")
-            except subprocess.CalledProcessError as e:
-                print("Error training model for summarization:", e)
-                print("Script error output:", e.stderr)
         elif self.mode == "generation_training":
-            # I need to pass the given self.tokenized_trajectories to /speakingTrajectories/Transformers/nanoGPT/data/trajectorySummary/input.txt
-            # Then run prepare.py and start the training process with the new finetuning arch. and (spatial constrainsts?).
-            configurations_model_path = "config/train_trajectory.py"
-            input_trajectories_path = os.path.join(
-                transformers_path, "nanoGPT/data/newTrajectoryGeneration"
-            )
-
-            with open(os.path.join(input_trajectories_path, "input.txt"), "w") as file:
-                for line in self.tokenized_trajectories:
-                    file.write(line + "\n")
-
-            try:
-                result = subprocess.run(
-                    ["python", os.path.join(input_trajectories_path, "prepare.py")],
-                    capture_output=True,
-                    text=True,
-                )
-                print("Script output:", result.stdout)
-                print("Data prepared successfully for the model...")
-            except subprocess.CalledProcessError as e:
-                print("Error preparing data for the model:", e)
-            print("Starting Model Training Now...")
-            # Assuming I have the new model architecure
-            os.chdir(working_directory)
-            try:
-                process = subprocess.run(
-                    ["python", training_model_path, configurations_model_path],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                )
-                print("Script output:", process.stdout)
-                print("Trained model for generation successfully.")
-            except subprocess.CalledProcessError as e:
-                print("Error training model for generation:", e)
-                print("Script error output:", e.stderr)
+            # Same as above, with the shards in data/newTrajectoryGeneration
+            return self.trainModel("config/train_trajectory.py", "generation")
 
         elif self.mode == "summarization_testing":
+            cache_key, content = self.cachedModelOutput(
+                self.tokenized_trajectories, {"arg1": 2}
+            )
+            if content is not None:
+                with open(final_trajectories_path, "w") as destination_file:
+                    destination_file.write(content)
+                print("Summaries served from the result cache.")
+                return True
             # I need to pass the given self.tokenized_trajectories to /speakingTrajectories/Transformers/nanoGPT/requestedTrajectories.txt
             # Then run ./generateTrajectoriesScript.sh 1 2 and start the summarization process with the (spatial constrainsts?).
             requested_trajectories_path = os.path.join(
@@ -201,9 +653,17 @@ class TrajectoryPipeline:
             simplified_trajectories_path = os.path.join(
                 transformers_path, "nanoGPT/simplifiedTrajectories.txt"
             )
-            with open(requested_trajectories_path, "w") as file:
-                for line in self.tokenized_trajectories:
-                    file.write(line + "\n")
+            # Sorted by length, the batches the script cuts from the request file
+            # hold requests of similar length
+            request_order = list(range(len(self.tokenized_trajectories)))
+            if self.length_bucketing:
+                lengths = [sequenceLength(line) for line in self.tokenized_trajectories]
+                batches = lengthBatches(lengths, self.inference_batch_size)
+                request_order = [i for batch in batches for i in batch]
+                print(
+                    "Inference batching:",
+                    bucketingReport(lengths, self.inference_batch_size),
+                )
 
             script_path = os.path.join(
                 transformers_path, "generateTrajectoriesScript.sh"
@@ -212,27 +672,44 @@ class TrajectoryPipeline:
             # arg2 = 1
             # arg3 = 1
 
-            try:
-                result = subprocess.run(
-                    [script_path, str(arg1)],
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-                print("Script output:", result.stdout.decode())
-                print("Script executed successfully.")
-            except subprocess.CalledProcessError as e:
-                print("Error executing script:", e)
-                print("Script error output:", e.stderr.decode())
-
-            # Open the source file in read mode and the destination file in write mode
-            with open(simplified_trajectories_path, "r") as source_file:
-                with open(final_trajectories_path, "w") as destination_file:
-                    # Read content from the source file
+            # The request and output files of the script are shared by every run,
+            # they are only touched while holding the model lock
+            with modelLock(model_path):
+                with open(requested_trajectories_path, "w") as file:
+                    for i in request_order:
+                        file.write(self.tokenized_trajectories[i] + "\n")
+                if not self.runModelScript([script_path, str(arg1)]):
+                    # The output file still holds the output of an earlier call
+                    return False
+                # Read content from the source file
+                with open(simplified_trajectories_path, "r") as source_file:
                     content = source_file.read()
-                    # Write content to the destination file
-                    destination_file.write(content)
+            if self.length_bucketing:
+                # Outputs come back one line per request, restore the input order
+                try:
+                    content = self.restoreRequestOrder(content, request_order)
+                except ValueError as e:
+                    print("Error matching the model outputs to their requests:", e)
+                    return False
+            with open(final_trajectories_path, "w") as destination_file:
+                destination_file.write(content)
+            self.storeModelOutput(cache_key, content)
+            return True
         elif self.mode == "generation_testing":
+            # Generation is only reproducible, hence cacheable, when a seed is given
+            generation_params = {
+                "trajectories_count": self.trajectories_count,
+                "trajectories_length": self.trajectories_length,
+                "seed": self.seed,
+            }
+            cache_key, content = None, None
+            if self.seed is not None:
+                cache_key, content = self.cachedModelOutput([], generation_params)
+            if content is not None:
+                with open(final_trajectories_path, "w") as destination_file:
+                    destination_file.write(content)
+                print("Generated trajectories served from the result cache.")
+                return True
             print("Started generating trajectories...")
             generated_trajectories_path = os.path.join(
                 transformers_path, "nanoGPT/generatedTrajectories.txt"
@@ -243,28 +720,73 @@ class TrajectoryPipeline:
             arg1 = 1
             arg2 = self.trajectories_count
             arg3 = self.trajectories_length
-
-            try:
-                result = subprocess.run(
-                    [script_path, str(arg1), str(arg2), str(arg3)],
-                    check=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-                print("Script output:", result.stdout.decode())
-                print("Script executed successfully.")
-            except subprocess.CalledProcessError as e:
-                print("Error executing script:", e)
-                print("Script error output:", e.stderr.decode())
-
-            # Open the source file in read mode and the destination file in write mode
-            with open(generated_trajectories_path, "r") as source_file:
-                with open(final_trajectories_path, "w") as destination_file:
-                    # Read content from the source file
+            script_args = [script_path, str(arg1), str(arg2), str(arg3)]
+            if self.seed is not None:
+                script_args.append(str(self.seed))
+
+            with modelLock(model_path):
+                if not self.runModelScript(script_args):
+                    # The output file still holds the output of an earlier call
+                    return False
+                # Read content from the source file
+                with open(generated_trajectories_path, "r") as source_file:
                     content = source_file.read()
-                    # Write content to the destination file
-                    destination_file.write(content)
-        pass
+            with open(final_trajectories_path, "w") as destination_file:
+                destination_file.write(content)
+            self.storeModelOutput(cache_key, content)
+            return True
+        return False
+
+    def runModelScript(self, script_args):
+        try:
+            result = subprocess.run(
+                script_args,
+                cwd=self.transformers_path,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            print("Script output:", result.stdout.decode())
+            print("Script executed successfully.")
+            return True
+        except subprocess.CalledProcessError as e:
+            print("Error executing script:", e)
+            print("Script error output:", e.stderr.decode())
+            return False
+
+    def restoreRequestOrder(self, content, request_order):
+        # Only called on the output of a successful script
+        output_lines = content.splitlines()
+        if len(output_lines) != len(request_order):
+            raise ValueError(
+                f"The model returned {len(output_lines)} output lines for "
+                f"{len(request_order)} requests, the outputs can't be matched "
+                "to their requests to restore the input order"
+            )
+        ordered = [None] * len(request_order)
+        for output_line, i in zip(output_lines, request_order):
+            ordered[i] = output_line
+        return "".join(line + "\n" for line in ordered)
+
+    def cachedModelOutput(self, tokenized_trajectories, params):
+        # Returns the cache key of the current request and the cached output, if any
+        if not self.use_result_cache:
+            return None, None
+        cache_key = self.result_cache.make_key(
+            self.servingModelPath(), self.mode, tokenized_trajectories, params
+        )
+        return cache_key, self.result_cache.get(cache_key)
+
+    def storeModelOutput(self, cache_key, content):
+        if self.use_result_cache and cache_key is not None:
+            self.result_cache.put(cache_key, content, self.servingModelPath())
+
+    def servingModelPath(self):
+        # The model the testing modes are served by, trainModel and the updates
+        # of a pyramid cell invalidate the cache entries of this same path
+        if self.model_cell_path is not None:
+            return self.model_cell_path
+        return os.path.join(self.transformers_path, "nanoGPT")
 
     def summarize_trajectories(self):
         if not self.trajectories:
@@ -284,45 +806,122 @@ class TrajectoryPipeline:
         ]
         return generated_trajectories
 
+    def startManifest(self):
+        # Opens the checkpoint of this run directory, resuming it when it was
+        # written for the same inputs and options
+        self.manifest = None
+        if not self.checkpointing:
+            return
+        fingerprint = runFingerprint(
+            {
+                "mode": self.mode,
+                "city": self.city,
+                "input_path": self.input_file_path,
+                "trajectories_count": self.trajectories_count,
+                "trajectories_length": self.trajectories_length,
+                "seed": self.seed,
+                "collapse_runs": self.collapse_runs,
+                "dwell_tokens": self.dwell_tokens,
+                "block_size": self.block_size,
+                "store_aligned_summaries": self.store_aligned_summaries,
+                "checkpoint_chunk_size": self.checkpoint_chunk_size,
+                "dedup": self.dedup,
+                "dedup_threshold": self.dedup_threshold,
+                "detokenization_tier": self.detokenization_tier,
+                "noise_filter": self.noise_filter,
+            },
+            self.input_file_path if self.mode != "generation_testing" else None,
+        )
+        if not self.run_dir_given:
+            self.run_dir = os.path.join(self.runs_path, f"run-{fingerprint[:16]}")
+        self.manifest = RunManifest(self.run_dir, fingerprint)
+        if self.manifest.resumed:
+            print(f"Resuming run from {self.manifest.path}")
+
+    def runStage(self, stage, module, restore=None):
+        # Runs a stage unless the manifest records it as completed. A stage
+        # returning False failed, the stages after it are skipped and none of
+        # them is recorded.
+        if self._stage_failed:
+            print(f"Stage {stage} skipped, stage {self.failed_stage} failed")
+            return
+        if self.manifest is None:
+            if module() is False:
+                self._stage_failed, self.failed_stage = True, stage
+            return
+        if self.manifest.stage_done(stage):
+            print(f"Stage {stage} already completed, skipping it")
+            if restore is not None:
+                restore()
+            return
+        if stage == "model":
+            # Detokenized chunks of an earlier model output are stale now
+            self.manifest.clear_chunks("detokenization")
+        if module() is not False:
+            self.manifest.mark_stage(stage)
+        else:
+            self._stage_failed, self.failed_stage = True, stage
+
+    def restoreTokenization(self):
+        with open(self.tokenized_trajectories_path, "r") as file:
+            self.tokenized_trajectories = file.read().splitlines()
+
     def run_pipeline(
         self,
         output_filepath: str = "output.json",
-    ):
+    ) -> bool:
+        # Returns whether every stage succeeded, see failed_stage otherwise
+        self.startManifest()
+        removed = pruneRuns(self.runs_path, self.runs_max_age_days, [self.run_dir])
+        if removed:
+            print(f"Removed {len(removed)} old run directories from {self.runs_path}")
+        self._stage_failed, self.failed_stage = False, None
         if self.mode == "summarization_training":
 
             # Tokenization
-            self.tokenizationModule()
+            self.runStage(
+                "tokenization", self.tokenizationModule, self.restoreTokenization
+            )
             # Finetuning
             self.fineTuningModule()
             # Spatial Constrains
             self.spatialConstraintsModule()
             # Proceed with training your summarization model using self.trajectories and self.summaries
             # Save the model in the models repo
-            self.modelsRepository()
+            self.runStage("model", self.modelsRepository)
             print("New model saved to repository...")
 
         elif self.mode == "generation_training":
 
             # Tokenization
-            self.tokenizationModule()
+            self.runStage(
+                "tokenization", self.tokenizationModule, self.restoreTokenization
+            )
             # Finetuning
             self.fineTuningModule()
             # Spatial Constrains
             self.spatialConstraintsModule()
             # Proceed with training your generation model using self.trajectories
             # Save the model in the models repo
-            self.modelsRepository()
+            self.runStage("model", self.modelsRepository)
             print("New model saved to repository...")
 
         elif self.mode == "summarization_testing":
-            self.tokenizationModule()
+            self.runStage(
+                "tokenization", self.tokenizationModule, self.restoreTokenization
+            )
             # Call the suitable model in the models repo and summarize trajectories
-            self.modelsRepository()
+            self.runStage("model", self.modelsRepository)
             # summaries = self.summarize_trajectories()
             # Apply the spatial constraints on the genrated summarizes or make sure they are applied...think later about this
             self.spatialConstraintsModule()
             # Apply the detokenization module and save the output
-            self.deTokenizationModule()
+            self.runStage("detokenization", self.deTokenizationModule)
+            # Evaluate the detokenized output against the original data
+            if self.evaluate:
+                self.runStage(
+                    "evaluation", self.evaluationModule, self.restoreEvaluation
+                )
             # output_data = [
             #     {"trajectory": traj, "summary": summary}
             #     for traj, summary in zip(self.trajectories, summaries)
@@ -332,12 +931,12 @@ class TrajectoryPipeline:
         elif self.mode == "generation_testing":
             print("I am doing Trajectory Generation Testing from the Pipeline now")
             # Call the suitable model in the models repo and generate trajectories
-            self.modelsRepository()
+            self.runStage("model", self.modelsRepository)
             # trajectories = self.generate_trajectories()
             # Apply the spatial constraints on the genrated output or make sure they are applied...think later about this
             self.spatialConstraintsModule()
             # Apply the detokenization module and save the output
-            self.deTokenizationModule()
+            self.runStage("detokenization", self.deTokenizationModule)
             # output_data = [{"trajectory": traj} for traj in trajectories]
             # self.save_data(output_filepath, output_data)
 
@@ -345,6 +944,7 @@ class TrajectoryPipeline:
             raise ValueError(
                 "Invalid mode. Choose from 'summarization_training', 'generation_training', 'summarization_testing', or 'generation_testing'"
             )
+        return not self._stage_failed
 
 
 # Example usage
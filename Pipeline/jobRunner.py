@@ -0,0 +1,295 @@
+"""Runs the scenarios of a multi-scenario params file as a dependency-aware job plan"""
+
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from TrajPipeline.Pipeline.TrajectoryPipeline import TrajectoryPipeline, newRunId
+from TrajPipeline.Pipeline.Detokenization.detokenization import BERTImputer
+
+# A testing job waits for the training job of the same task and city
+TRAINING_MODE_OF = {
+    "summarization_testing": "summarization_training",
+    "generation_testing": "generation_training",
+}
+
+
+class Job:
+    """
+    One scenario of a params file.
+
+    Attributes:
+        name (str): The scenario name, unique within a plan.
+        params (dict): The params given to TrajectoryPipeline.set_params.
+        depends_on (list of str): Names of the jobs that must succeed first.
+        status (str): 'pending', 'running', 'done', 'failed' or 'skipped'.
+    """
+
+    def __init__(self, name, params, depends_on=None):
+        self.name = name
+        self.params = dict(params)
+        self.depends_on = list(depends_on or self.params.pop("depends_on", []))
+        self.status = "pending"
+        self.error = None
+        self.run_dir = None
+        self.worker = None
+        self.queued, self.started, self.finished = None, None, None
+
+    @property
+    def mode(self):
+        return self.params.get("mode", "")
+
+    @property
+    def city(self):
+        return str(self.params.get("city", "")).strip().lower()
+
+    def record(self, origin) -> dict:
+        def relative(timestamp):
+            return None if timestamp is None else timestamp - origin
+
+        return {
+            "name": self.name,
+            "mode": self.mode,
+            "city": self.city,
+            "status": self.status,
+            "depends_on": self.depends_on,
+            "worker": self.worker,
+            "run_dir": self.run_dir,
+            "queued_s": relative(self.queued),
+            "started_s": relative(self.started),
+            "finished_s": relative(self.finished),
+            "duration_s": (
+                self.finished - self.started
+                if self.started is not None and self.finished is not None
+                else None
+            ),
+            "error": self.error,
+        }
+
+
+def loadJobs(path):
+    """
+    Reads job specs from a params file or a directory of them.
+
+    A file either holds a single scenario (a params dict with a "mode") or
+    several, like params_allScenarios.json, as a dict of scenario name -> params.
+    In a directory every *.json file is read, single scenarios are named after
+    their file. A scenario can list the names of other jobs in "depends_on".
+
+    Returns:
+        list of Job: The jobs, in file order.
+    """
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(path, name)
+            for name in os.listdir(path)
+            if name.endswith(".json")
+        )
+    else:
+        files = [path]
+    jobs = []
+    for filepath in files:
+        with open(filepath, "r") as file:
+            specs = json.load(file)
+        if not isinstance(specs, dict):
+            raise ValueError(f"Invalid job spec in {filepath}")
+        if "mode" in specs:
+            specs = {os.path.splitext(os.path.basename(filepath))[0]: specs}
+        jobs.extend(Job(name.strip(), params) for name, params in specs.items())
+    names = [job.name for job in jobs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate job names: {', '.join(duplicates)}")
+    return jobs
+
+
+def planJobs(jobs):
+    """
+    Adds the implicit dependencies and orders the jobs into stages.
+
+    Testing jobs depend on every training job of the same task and city, on top
+    of their explicit "depends_on". Jobs of one stage only depend on jobs of
+    earlier stages, so they can run in parallel.
+
+    Returns:
+        list of list of Job: The stages, in execution order.
+    """
+    by_name = {job.name: job for job in jobs}
+    for job in jobs:
+        training_mode = TRAINING_MODE_OF.get(job.mode)
+        for other in jobs:
+            if (
+                training_mode is not None
+                and other.mode == training_mode
+                and other.city == job.city
+                and other.name not in job.depends_on
+            ):
+                job.depends_on.append(other.name)
+        unknown = [name for name in job.depends_on if name not in by_name]
+        if unknown:
+            raise ValueError(f"Job '{job.name}' depends on unknown jobs: {unknown}")
+
+    stages, placed = [], set()
+    remaining = list(jobs)
+    while remaining:
+        stage = [job for job in remaining if set(job.depends_on) <= placed]
+        if not stage:
+            names = ", ".join(job.name for job in remaining)
+            raise ValueError(f"Cyclic job dependencies between: {names}")
+        stages.append(stage)
+        placed.update(job.name for job in stage)
+        remaining = [job for job in remaining if job.name not in placed]
+    return stages
+
+
+class JobRunner:
+    """
+    Executes a job plan on a pool of worker threads.
+
+    A job starts as soon as all of its dependencies succeeded, jobs whose
+    dependency failed are skipped. Every job gets its own TrajectoryPipeline and
+    run directory; the detokenization bundle is loaded once and shared. The run
+    directories of a plan live in runs_dir/<run_id>, a new run id is drawn per
+    runner, so running a plan again starts from scratch while passing the
+    run_id of an interrupted run resumes its jobs from their checkpoints. Threads
+    rather than processes are used so the bundle is not copied per worker, the
+    model scripts themselves run as subprocesses. As for a single pipeline, the
+    evaluation of testing jobs is opt-in ("evaluate": true in their params),
+    its worker processes default to an equal share of the CPUs per running job.
+
+    Attributes:
+        jobs (list of Job): The jobs of the plan.
+        stages (list of list of Job): The jobs grouped by dependency depth.
+        runs_dir (str): Parent directory of the plan runs.
+        run_id (str): The run of the plan, its directory holds the job run directories.
+        max_workers (int): Number of jobs running at the same time.
+    """
+
+    def __init__(
+        self, jobs, runs_dir=None, max_workers=4, pipeline_factory=None, run_id=None
+    ):
+        self.jobs = list(jobs)
+        self.stages = planJobs(self.jobs)
+        self.runs_dir = runs_dir or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "Runs"
+        )
+        self.run_id = run_id or newRunId()
+        self.max_workers = max_workers
+        self.pipeline_factory = pipeline_factory or TrajectoryPipeline
+        self.bert_imputer = None
+        self._imputer_lock = threading.Lock()
+        self.origin = None
+
+    @classmethod
+    def from_path(cls, path, **kwargs):
+        return cls(loadJobs(path), **kwargs)
+
+    def shared_imputer(self):
+        # Loaded by the first job that needs it
+        with self._imputer_lock:
+            if self.bert_imputer is None:
+                self.bert_imputer = BERTImputer()
+            return self.bert_imputer
+
+    def run_dir(self, job):
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "_", job.name).strip("_") or "job"
+        return os.path.join(self.runs_dir, self.run_id, name)
+
+    def _run_job(self, job):
+        job.started = time.perf_counter()
+        job.worker = threading.current_thread().name
+        job.status = "running"
+        job.run_dir = self.run_dir(job)
+        try:
+            pipeline = self.pipeline_factory(
+                run_dir=job.run_dir, bert_imputer=self.shared_imputer()
+            )
+            pipeline.set_params(job.params)
+            # The plan decides where the job writes, not the params
+            pipeline.run_dir = job.run_dir
+            if job.params.get("evaluation_workers") is None:
+                pipeline.evaluation_workers = max(
+                    1, (os.cpu_count() or 1) // self.max_workers
+                )
+            if pipeline.run_pipeline() is False:
+                job.status = "failed"
+                job.error = f"stage {pipeline.failed_stage} failed"
+            else:
+                job.status = "done"
+        except Exception as e:
+            job.status = "failed"
+            job.error = f"{type(e).__name__}: {e}"
+        finally:
+            job.finished = time.perf_counter()
+        return job
+
+    def run(self) -> list:
+        """
+        Runs every job of the plan and returns the timeline.
+        """
+        self.origin = time.perf_counter()
+        by_name = {job.name: job for job in self.jobs}
+        pending = list(self.jobs)
+        running = {}
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="job"
+        ) as executor:
+            while pending or running:
+                for job in list(pending):
+                    statuses = [by_name[name].status for name in job.depends_on]
+                    if any(status in ("failed", "skipped") for status in statuses):
+                        job.status = "skipped"
+                        job.error = "a dependency did not succeed"
+                        pending.remove(job)
+                    elif all(status == "done" for status in statuses):
+                        job.queued = time.perf_counter()
+                        running[executor.submit(self._run_job, job)] = job
+                        pending.remove(job)
+                if not running:
+                    continue
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    del running[future]
+        timeline = self.timeline()
+        plan_dir = os.path.join(self.runs_dir, self.run_id)
+        os.makedirs(plan_dir, exist_ok=True)
+        with open(os.path.join(plan_dir, "timeline.json"), "w") as file:
+            json.dump(timeline, file, indent=4)
+        return timeline
+
+    def timeline(self) -> list:
+        """Per job status, worker, start and end time relative to the run start."""
+        origin = self.origin if self.origin is not None else time.perf_counter()
+        return [job.record(origin) for job in self.jobs]
+
+
+def formatTimeline(timeline, width=40):
+    # One text bar per job, scaled to the end of the last job
+    end = max((record["finished_s"] or 0.0 for record in timeline), default=0.0)
+    scale = width / end if end > 0 else 0.0
+    lines = []
+    for record in timeline:
+        bar = ""
+        if record["started_s"] is not None and record["finished_s"] is not None:
+            start = int(record["started_s"] * scale)
+            length = max(1, int(record["finished_s"] * scale) - start)
+            bar = " " * start + "#" * length
+        duration = record["duration_s"]
+        lines.append(
+            f"{record['name'][:24]:<24} {record['status']:<8} "
+            f"{'' if duration is None else f'{duration:8.2f}s':>9} |{bar:<{width}}|"
+        )
+    return "\n".join(lines)
+
+
+# Example usage
+# runner = JobRunner.from_path(
+#     "/speakingTrajectories/Pipeline/Input/sampleParams/params_allScenarios.json",
+#     max_workers=4,
+# )
+# print(formatTimeline(runner.run()))
+# Resuming the jobs of an interrupted run:
+# JobRunner.from_path(path, run_id=runner.run_id).run()
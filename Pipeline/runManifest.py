@@ -0,0 +1,115 @@
+"""Run manifest recording the completed stages and chunks of a pipeline run"""
+
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomicFile(path, mode="w"):
+    # The content goes to a temporary file that replaces `path` only once it was
+    # written completely, readers never see a partial file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    file = open(tmp_path, mode)
+    try:
+        yield file
+        file.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        file.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomicWrite(path, content, mode="w"):
+    with atomicFile(path, mode) as file:
+        file.write(content)
+
+
+def runFingerprint(values: dict, input_path=None) -> str:
+    """
+    Hash of what a run depends on: its options and the size and modification
+    time of its input file. A checkpoint is only resumed for the same fingerprint.
+    """
+    digest = hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode())
+    if input_path and os.path.exists(input_path):
+        stat = os.stat(input_path)
+        digest.update(
+            f"{os.path.abspath(input_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+        )
+    return digest.hexdigest()
+
+
+class RunManifest:
+    """
+    Checkpoint of a pipeline run, stored as manifest.json in its run directory.
+
+    Stages (tokenization, model, detokenization) are recorded once completed,
+    stages that work in chunks record every completed chunk together with the
+    file holding its output, so a restarted run skips straight to the first
+    missing chunk. The manifest is rewritten atomically after every change.
+
+    Attributes:
+        path (str): The manifest file.
+        fingerprint (str): The fingerprint of the run (see runFingerprint).
+        resumed (bool): Whether a matching manifest was found on disk.
+    """
+
+    def __init__(self, run_dir, fingerprint):
+        self.run_dir = run_dir
+        self.path = os.path.join(run_dir, "manifest.json")
+        self.fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self.state = {"fingerprint": fingerprint, "stages": {}, "chunks": {}}
+        self.resumed = False
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                state = json.load(file)
+            # A checkpoint of other inputs or options must not be resumed
+            if state.get("fingerprint") == fingerprint:
+                self.state = state
+                self.resumed = True
+        os.makedirs(run_dir, exist_ok=True)
+        self._save()
+
+    def _save(self):
+        atomicWrite(self.path, json.dumps(self.state, indent=4))
+
+    def stage_done(self, stage) -> bool:
+        return stage in self.state["stages"]
+
+    def mark_stage(self, stage, **info):
+        with self._lock:
+            self.state["stages"][stage] = info
+            self._save()
+
+    def chunk_path(self, stage, index, extension="txt"):
+        path = os.path.join(self.run_dir, "chunks", stage, f"{index:05d}.{extension}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def chunk(self, stage, index):
+        # The recorded info of a completed chunk whose file is still there, else None
+        info = self.state["chunks"].get(stage, {}).get(str(index))
+        if info is None or not os.path.exists(info["path"]):
+            return None
+        return info
+
+    def mark_chunk(self, stage, index, path, **info):
+        with self._lock:
+            self.state["chunks"].setdefault(stage, {})[str(index)] = {
+                "path": path,
+                **info,
+            }
+            self._save()
+
+    def clear_chunks(self, stage):
+        with self._lock:
+            if self.state["chunks"].pop(stage, None) is not None:
+                self._save()
+
+    def completed_chunks(self, stage) -> int:
+        return len(self.state["chunks"].get(stage, {}))
@@ -0,0 +1,22 @@
+"""Makes the repository importable as the TrajPipeline package for the tests"""
+
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def install_package_alias():
+    # The code imports itself as TrajPipeline.*, whatever the checkout is named
+    if "TrajPipeline" not in sys.modules:
+        package = types.ModuleType("TrajPipeline")
+        package.__path__ = [ROOT]
+        sys.modules["TrajPipeline"] = package
+    # The NewPipeline modules import their helpers as top level modules
+    new_pipeline = os.path.join(ROOT, "NewPipeline")
+    if new_pipeline not in sys.path:
+        sys.path.insert(0, new_pipeline)
+
+
+install_package_alias()
@@ -0,0 +1,66 @@
+import os
+
+from TrajPipeline.NewPipeline.cacheClass import ResultCache
+
+
+def test_the_cache_directory_is_created_by_the_first_put(tmp_path):
+    cache_dir = tmp_path / "resultCache"
+    cache = ResultCache(str(cache_dir))
+    key = cache.make_key("cell", "summarization_testing", ["a b"])
+    assert cache.get(key) is None
+    cache.clear()
+    assert not cache_dir.exists()
+    cache.put(key, "output\n", "cell")
+    assert cache.get(key) == "output\n"
+
+
+def test_updating_the_serving_cell_invalidates_its_entries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = ResultCache(str(tmp_path / "resultCache"))
+    cell_path = os.path.join("modelsRepo", "1_2")
+    other_cell_path = os.path.join("modelsRepo", "1_3")
+    key = cache.make_key(cell_path, "summarization_testing", ["a b"])
+    other_key = cache.make_key(other_cell_path, "summarization_testing", ["a b"])
+    cache.put(key, "old\n", cell_path)
+    cache.put(other_key, "other\n", other_cell_path)
+
+    # The cell is referred to by its absolute path on update
+    cache.invalidate_model(os.path.abspath(cell_path))
+    assert cache.get(key) is None
+    assert cache.get(other_key) == "other\n"
+    new_key = cache.make_key(cell_path, "summarization_testing", ["a b"])
+    assert new_key != key
+
+
+def test_hits_are_persisted_lazily(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=2)
+    keys = [
+        cache.make_key("cell", "generation_testing", [], {"seed": i}) for i in range(3)
+    ]
+    cache.put(keys[0], "0\n", "cell")
+    cache.put(keys[1], "1\n", "cell")
+    index_mtime = os.stat(cache.index_path).st_mtime_ns
+
+    assert cache.get(keys[0]) == "0\n"
+    assert os.stat(cache.index_path).st_mtime_ns == index_mtime
+    # The put applies the hit before evicting, keys[1] is the least recently used
+    cache.put(keys[2], "2\n", "cell")
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == "0\n"
+    assert cache.stats()["hits"] == 2
+
+
+def test_flush_writes_the_recency_of_hits_for_other_instances(tmp_path):
+    cache = ResultCache(str(tmp_path), max_entries=2)
+    keys = [
+        cache.make_key("cell", "generation_testing", [], {"seed": i}) for i in range(3)
+    ]
+    cache.put(keys[0], "0\n", "cell")
+    cache.put(keys[1], "1\n", "cell")
+    cache.get(keys[0])
+    cache.flush()
+
+    other = ResultCache(str(tmp_path), max_entries=2)
+    other.put(keys[2], "2\n", "cell")
+    assert other.get(keys[0]) == "0\n"
+    assert other.get(keys[1]) is None
@@ -0,0 +1,133 @@
+import os
+import threading
+
+import h3
+import numpy as np
+import pytest
+
+from TrajPipeline.NewPipeline.cellIndexClass import CellIndex
+
+
+def datasets(count=3, size=30, seed=0):
+    rng = np.random.default_rng(seed)
+    result = {}
+    for d in range(count):
+        trajectories = []
+        for _ in range(size):
+            start = rng.uniform([-6.4, 106.6], [-6.0, 107.0])
+            steps = rng.normal(0, 1e-3, size=(int(rng.integers(1, 40)), 2))
+            points = start + steps.cumsum(axis=0)
+            trajectories.append([h3.geo_to_h3(lat, lon, 10) for lat, lon in points])
+        result[f"dataset{d}"] = trajectories
+    return result
+
+
+def brute_force(data, cells):
+    # Trajectories with a token inside one of the cells, at any resolution
+    by_resolution = {}
+    for cell in cells:
+        resolution = h3.h3_get_resolution(cell)
+        if resolution > 10:
+            cell, resolution = h3.h3_to_parent(cell, 10), 10
+        by_resolution.setdefault(resolution, set()).add(cell)
+    result = {}
+    for dataset_id, trajectories in data.items():
+        matches = [
+            i
+            for i, tokens in enumerate(trajectories)
+            if any(
+                h3.h3_to_parent(token, resolution) in wanted
+                for token in tokens
+                for resolution, wanted in by_resolution.items()
+            )
+        ]
+        if matches:
+            result[dataset_id] = matches
+    return result
+
+
+def as_lists(results):
+    return {dataset_id: positions.tolist() for dataset_id, positions in results.items()}
+
+
+@pytest.fixture
+def indexed(tmp_path):
+    data = datasets()
+    index = CellIndex(str(tmp_path / "index"))
+    for dataset_id, trajectories in data.items():
+        index.add_dataset(dataset_id, f"{dataset_id}.pkl", trajectories)
+    return index, data
+
+
+def test_queries_match_a_brute_force_scan(indexed):
+    index, data = indexed
+    token = data["dataset1"][4][0]
+    for cells in (
+        [token],
+        # Base, rollup, between rollups and finer than the base resolution
+        [h3.h3_to_parent(token, 7)],
+        [h3.h3_to_parent(token, 5)],
+        [h3.h3_to_parent(token, 6)],
+        [h3.h3_to_parent(token, 4)],
+        list(h3.h3_to_children(token, 12))[:1],
+        [data["dataset0"][0][-1], data["dataset2"][7][0]],
+    ):
+        assert as_lists(index.query_cells(cells)) == brute_force(data, cells)
+    ring = h3.k_ring(token, 2)
+    assert as_lists(index.query_k_ring(token, 2)) == brute_force(data, ring)
+    assert index.query_cells([]) == {}
+
+
+def test_bounds_queries_match_the_cells_of_the_box(indexed):
+    index, data = indexed
+    bounds = (-6.3, -6.1, 106.7, 106.9)
+    polygon = [(-6.3, 106.7), (-6.3, 106.9), (-6.1, 106.9), (-6.1, 106.7)]
+    cells = h3.polyfill({"type": "Polygon", "coordinates": [polygon]}, 10)
+    assert as_lists(index.query_bounds(bounds)) == brute_force(data, cells)
+
+
+def test_load_trajectories_and_removal(indexed):
+    index, data = indexed
+    results = index.query_cells([data["dataset2"][3][0]])
+    loaded = index.load_trajectories(results, lambda path: data[path[:-4]])
+    assert loaded["dataset2"] == [data["dataset2"][i] for i in results["dataset2"]]
+    index.remove_dataset("dataset2")
+    assert "dataset2" not in index.query_cells([data["dataset2"][3][0]])
+    assert CellIndex(index.index_dir).stats()["datasets"] == 2
+
+
+def test_concurrent_instances_merge_their_datasets(tmp_path):
+    data = datasets(count=6, size=10, seed=1)
+    index_dir = str(tmp_path / "index")
+    errors = []
+
+    def add(dataset_id):
+        try:
+            CellIndex(index_dir).add_dataset(dataset_id, "", data[dataset_id])
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=add, args=(d,)) for d in data]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    index = CellIndex(index_dir)
+    assert sorted(index.segments) == sorted(data)
+    token = data["dataset5"][0][0]
+    assert as_lists(index.query_cells([token])) == brute_force(data, [token])
+
+
+def test_replacing_a_dataset_keeps_mapped_segments_readable(tmp_path):
+    data = datasets(count=1, size=5)
+    reader = CellIndex(str(tmp_path))
+    writer = CellIndex(str(tmp_path))
+    writer.add_dataset("dataset0", "", data["dataset0"])
+    token = data["dataset0"][0][0]
+    assert 0 in reader.query_cells([token])["dataset0"]
+    # The reader catches up with the new segment, the old one is gone
+    writer.add_dataset("dataset0", "", data["dataset0"][1:])
+    assert 0 not in reader.query_cells([token]).get("dataset0", [])
+    segments = [name for name in os.listdir(tmp_path) if name.startswith("segment_")]
+    assert len(segments) == 1
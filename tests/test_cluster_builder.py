@@ -0,0 +1,106 @@
+import logging
+
+import h3
+import numpy as np
+
+from TrajPipeline.NewPipeline.clusterBuilderClass import ClusterModelBuilder
+from TrajPipeline.NewPipeline.trajectoryBatchClass import (
+    TrajectoryBatch,
+    tokens_to_ints,
+)
+
+
+def batch(seed, count=40, center=(-6.2, 106.8)):
+    # Trajectories crossing a few resolution 8 cells in both directions
+    rng = np.random.default_rng(seed)
+    trajectories = []
+    for _ in range(count):
+        start = np.array(center) + rng.normal(0, 2e-3, 2)
+        direction = rng.choice([-1.0, 1.0]) * np.array([1.0, rng.normal(0, 0.3)])
+        steps = direction * 2e-4 + rng.normal(0, 2e-5, size=(30, 2))
+        trajectories.append(start + steps.cumsum(axis=0))
+    points = np.concatenate(trajectories)
+    offsets = np.arange(0, len(points) + 1, 30)
+    tokens = tokens_to_ints(h3.geo_to_h3(lat, lon, 8) for lat, lon in points)
+    return TrajectoryBatch(points[:, 0], points[:, 1], offsets, tokens=tokens)
+
+
+def builder(path, **kwargs):
+    return ClusterModelBuilder(str(path), min_count=5, **kwargs)
+
+
+def assert_same_artifacts(a, b):
+    assert a.h3_clusters.keys() == b.h3_clusters.keys()
+    for token, cluster in a.h3_clusters.items():
+        assert cluster["current_count"] == b.h3_clusters[token]["current_count"]
+        assert np.allclose(
+            [cluster["x"], cluster["y"]],
+            [b.h3_clusters[token]["x"], b.h3_clusters[token]["y"]],
+        )
+    assert a.h3_kmeans.keys() == b.h3_kmeans.keys()
+    for token, (model, means) in a.h3_kmeans.items():
+        other_model, other_means = b.h3_kmeans[token]
+        assert np.allclose(model.cluster_centers_, other_model.cluster_centers_)
+        assert np.allclose(means, other_means)
+
+
+def test_incremental_builds_match_a_build_from_scratch(tmp_path):
+    first = builder(tmp_path / "incremental")
+    assert first.add_dataset("first", batch(0))
+    first.fit(max_workers=1)
+    first.save()
+    fitted = dict(first.h3_clusters)
+
+    second = builder(tmp_path / "incremental")
+    assert second.datasets == ["first"]
+    assert second.h3_clusters == fitted
+    # Only the cells of the new dataset are refitted
+    far_away = batch(1, center=(-6.25, 106.85))
+    new_cells = set(far_away.tokens.tolist())
+    assert new_cells.isdisjoint(batch(0).tokens.tolist())
+    assert second.add_dataset("second", far_away)
+    assert second.dirty == new_cells
+    kept = dict(second.h3_clusters)
+    assert second.fit(max_workers=1) == len(new_cells)
+    assert not second.dirty
+    for token, cluster in kept.items():
+        assert second.h3_clusters[token] is cluster
+    assert second.h3_kmeans.keys() - first.h3_kmeans.keys()
+
+    scratch = builder(tmp_path / "scratch")
+    scratch.add_dataset("first", batch(0))
+    scratch.add_dataset("second", batch(1, center=(-6.25, 106.85)))
+    scratch.fit(max_workers=1)
+    assert_same_artifacts(second, scratch)
+
+
+def test_parallel_fits_match_serial_fits(tmp_path):
+    serial, parallel = builder(tmp_path / "serial"), builder(tmp_path / "parallel")
+    for b in (serial, parallel):
+        b.add_dataset("first", batch(0))
+        b.add_dataset("second", batch(2))
+    serial.fit(max_workers=1)
+    parallel.fit(max_workers=2, chunk_cells=2)
+    assert_same_artifacts(serial, parallel)
+
+
+def test_unfitted_cells_survive_a_save(tmp_path):
+    b = builder(tmp_path)
+    b.add_dataset("first", batch(0))
+    b.save()
+    reloaded = builder(tmp_path)
+    cells = set(batch(0).tokens.tolist())
+    assert reloaded.dirty == cells
+    assert reloaded.fit(max_workers=1) == len(cells)
+    assert len(reloaded.h3_clusters) == len(cells)
+
+
+def test_skipped_datasets_are_logged(tmp_path, caplog):
+    b = builder(tmp_path)
+    b.add_dataset("first", batch(0))
+    with caplog.at_level(logging.INFO):
+        assert not b.add_dataset("first", batch(0))
+        assert not b.add_dataset("tokens", [["88658f1a5bfffff"]])
+    assert "first: already in the statistics" in caplog.text
+    assert "tokens: stored as token lists" in caplog.text
+    assert b.datasets == ["first"]
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from TrajPipeline.Pipeline.Tokenization.dedup import NearDuplicateDetector, dedupLines
+
+
+def random_tokens(rng, n=40):
+    return [format(value, "x") for value in rng.integers(1, 2**60, size=n).tolist()]
+
+
+@pytest.fixture
+def lines():
+    rng = np.random.default_rng(0)
+    a, b, c = random_tokens(rng), random_tokens(rng), random_tokens(rng)
+    # A stop repeats a token, a dwell token marks the run
+    a_with_stop = a[:10] + [a[9], "<r2>"] + a[10:]
+    return [
+        " ".join(a),
+        " ".join(b),
+        " ".join(a) + " <end> " + " ".join(b[:5]),
+        " ".join(a_with_stop),
+        "",
+        "<end>",
+        " ".join(a),
+        " ".join(c),
+    ]
+
+
+def test_exact_duplicates_point_to_their_first_occurrence(lines):
+    with NearDuplicateDetector(chunk_size=3) as detector:
+        detector.addLines(lines)
+        duplicate_of = detector.findDuplicates()
+    assert duplicate_of.tolist() == [-1, -1, 0, 0, -1, -1, 0, -1]
+
+
+def test_distinct_trajectories_are_kept():
+    rng = np.random.default_rng(1)
+    lines = [" ".join(random_tokens(rng)) for _ in range(200)]
+    keep, weights, report = dedupLines(lines)
+    assert keep.all()
+    assert (weights == 1).all()
+    assert report["near_duplicates"] == 0
+    assert report["trajectory_reduction"] == 0.0
+
+
+def test_drop_keeps_one_representative_weighted_by_its_group(lines):
+    keep, weights, report = dedupLines(lines, policy="drop", chunk_size=3)
+    assert keep.tolist() == [True, True, False, False, True, True, False, True]
+    assert weights.tolist() == [4.0, 1.0, 0.0, 0.0, 1.0, 1.0, 0.0, 1.0]
+    assert report["trajectories"] == 8
+    assert report["kept_trajectories"] == 5
+    assert report["near_duplicates"] == 3
+    assert report["duplicate_groups"] == 1
+    assert report["largest_group"] == 4
+    assert report["tokens_after"] == 120
+
+
+def test_downweight_keeps_the_square_root_of_a_group(lines):
+    keep, weights, _ = dedupLines(lines, policy="downweight")
+    assert keep.tolist() == [True, True, True, False, True, True, False, True]
+    assert weights.tolist() == [2.0, 1.0, 2.0, 0.0, 1.0, 1.0, 0.0, 1.0]
+    # The weights of a group add up to its size
+    assert weights.sum() == len(lines)
+
+
+def test_empty_input_and_unknown_policy():
+    keep, weights, report = dedupLines([])
+    assert len(keep) == len(weights) == 0
+    assert report["trajectories"] == 0
+    with pytest.raises(ValueError):
+        dedupLines(["a b c"], policy="merge")
+
+
+def test_near_duplicates_above_the_threshold():
+    rng = np.random.default_rng(2)
+    a = random_tokens(rng, 60)
+    variant = a[:30] + random_tokens(rng, 1) + a[31:]
+    different = a[:20] + random_tokens(rng, 40)
+    keep, _, report = dedupLines(
+        [" ".join(a), " ".join(variant), " ".join(different)], threshold=0.7
+    )
+    assert keep.tolist() == [True, False, True]
+    assert report["near_duplicates"] == 1
@@ -0,0 +1,108 @@
+import json
+
+import numpy as np
+import pytest
+
+from TrajPipeline.Pipeline.Detokenization.detokenization import (
+    DetokenizedTrajectoriesWriter,
+    formatPoints,
+)
+
+
+def old_format_points(lats, lons):
+    return ",".join(f"{round(lat, 6)} {round(lon, 6)}" for lat, lon in zip(lats, lons))
+
+
+def sample_points(n, seed):
+    rng = np.random.default_rng(seed)
+    lats, lons = rng.uniform(-90, 90, n), rng.uniform(-180, 180, n)
+    # Values within float error of a rounding tie
+    lats[::5] = np.round(lats[::5], 6) + 5e-7
+    return lats.tolist(), lons.tolist()
+
+
+@pytest.mark.parametrize("as_array", [False, True])
+def test_format_points_matches_per_point_rounding(as_array):
+    lats, lons = sample_points(5000, 0)
+    lats += [float("nan"), -0.0, 1e-7, -4e-7, 2.675]
+    lons += [float("inf"), 0.0, 5e-7, 1234567.0000005, -2.675]
+    if as_array:
+        lats, lons = np.array(lats), np.array(lons)
+    assert formatPoints(lats, lons) == old_format_points(lats, lons)
+    assert formatPoints([], []) == ""
+
+
+def records(n):
+    result = []
+    for i in range(n):
+        trajectory, summary = sample_points(20, i), sample_points(4, i + 100)
+        result.append((trajectory, summary))
+    return result
+
+
+@pytest.mark.parametrize("count", [0, 1, 3])
+def test_pretty_output_is_the_old_json_dump(tmp_path, count):
+    output = tmp_path / "detokenized.json"
+    with DetokenizedTrajectoriesWriter(str(output), "summarization_testing") as writer:
+        for trajectory, summary in records(count):
+            writer.write(trajectory, summary)
+    expected = [
+        {
+            "id": str(i + 1),
+            "trajectory": old_format_points(*trajectory),
+            "summary": old_format_points(*summary),
+        }
+        for i, (trajectory, summary) in enumerate(records(count))
+    ]
+    with open(tmp_path / "expected.json", "w") as f:
+        json.dump(expected, f, indent=4)
+    assert output.read_bytes() == (tmp_path / "expected.json").read_bytes()
+
+
+def test_jsonl_output_round_trips(tmp_path):
+    output = tmp_path / "detokenized.jsonl"
+    with DetokenizedTrajectoriesWriter(
+        str(output), "generation_testing", compact=True
+    ) as writer:
+        for trajectory, summary in records(3):
+            # Summaries are only written in summarization_testing
+            writer.write(trajectory, summary)
+        writer.write("1.0 2.0,3.0 4.0")
+    with open(output) as f:
+        loaded = [json.loads(line) for line in f]
+    assert loaded[:3] == [
+        {"id": str(i + 1), "trajectory": old_format_points(*trajectory)}
+        for i, (trajectory, _) in enumerate(records(3))
+    ]
+    assert loaded[3] == {"id": "4", "trajectory": "1.0 2.0,3.0 4.0"}
+
+
+def test_a_failed_write_keeps_the_previous_output(tmp_path):
+    output = tmp_path / "detokenized.json"
+    output.write_text("previous")
+    with pytest.raises(RuntimeError):
+        with DetokenizedTrajectoriesWriter(str(output), "generation_testing") as writer:
+            writer.write("1.0 2.0")
+            raise RuntimeError("detokenization failed")
+    assert output.read_text() == "previous"
+    assert [path.name for path in tmp_path.iterdir()] == ["detokenized.json"]
+
+
+def test_hybrid_cells_need_a_cluster_shift():
+    from TrajPipeline.Pipeline.Detokenization.detokenization import BERTImputer
+
+    centroid = {"x": 106.8, "y": -6.2, "current_count": 50}
+    imputer = BERTImputer(hybrid_min_shift=5.0)
+    imputer.h3_clusters = {
+        "near": centroid,
+        "far": centroid,
+        "sparse": {**centroid, "current_count": 3},
+    }
+    # Means are (x, y, weight), 1e-4 degrees of latitude are about 11 m
+    imputer.h3_kmeans = {
+        "near": (None, [[106.8, -6.20001, 1.0], [106.8, -6.19999, 1.0]]),
+        "far": (None, [[106.8, -6.2001, 1.0], [106.8, -6.1999, 1.0]]),
+        "sparse": (None, [[106.8, -6.21, 1.0]]),
+        "unknown": (None, [[106.8, -6.21, 1.0]]),
+    }
+    assert imputer.hybrid_cells == {"far"}
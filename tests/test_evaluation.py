@@ -0,0 +1,80 @@
+import math
+
+import numpy as np
+
+from TrajPipeline.Pipeline.Evaluation import evaluation
+from TrajPipeline.Pipeline.Evaluation.evaluation import trajectoryDistances
+from TrajPipeline.Pipeline.Tokenization.parsing import parseTrajectoryStrings
+
+
+def haversine(a, b):
+    lat1, lon1, lat2, lon2 = map(math.radians, (*a, *b))
+    term = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * 6371008.8 * math.asin(math.sqrt(min(term, 1.0)))
+
+
+def brute_force_hausdorff(a, b):
+    forward = max(min(haversine(p, q) for q in b) for p in a)
+    backward = max(min(haversine(p, q) for p in a) for q in b)
+    return max(forward, backward)
+
+
+def brute_force_frechet(a, b):
+    table = [[math.inf] * len(b) for _ in a]
+    for i, p in enumerate(a):
+        for j, q in enumerate(b):
+            if i == 0 and j == 0:
+                previous = 0.0
+            else:
+                previous = min(
+                    table[i - 1][j] if i else math.inf,
+                    table[i][j - 1] if j else math.inf,
+                    table[i - 1][j - 1] if i and j else math.inf,
+                )
+            table[i][j] = max(previous, haversine(p, q))
+    return table[-1][-1]
+
+
+def random_trajectories(rng, count):
+    trajectories = []
+    for _ in range(count):
+        start = rng.uniform([-6.5, 106.5], [-6.0, 107.0])
+        steps = rng.normal(0, 1e-3, size=(int(rng.integers(1, 30)), 2))
+        trajectories.append(start + steps.cumsum(axis=0))
+    return trajectories
+
+
+def as_strings(trajectories):
+    return [",".join(f"{lat} {lon}" for lat, lon in t.tolist()) for t in trajectories]
+
+
+def test_distances_match_a_brute_force_reference(monkeypatch):
+    # A small budget splits the pairs over many padded groups
+    monkeypatch.setattr(evaluation, "DISTANCE_BUDGET", 2000)
+    rng = np.random.default_rng(0)
+    a, b = random_trajectories(rng, 40), random_trajectories(rng, 40)
+    # Identical trajectories are at distance 0
+    b[0] = a[0]
+    hausdorff, frechet = trajectoryDistances(
+        parseTrajectoryStrings(as_strings(a)), parseTrajectoryStrings(as_strings(b))
+    )
+    expected_hausdorff = [brute_force_hausdorff(p, q) for p, q in zip(a, b)]
+    expected_frechet = [brute_force_frechet(p, q) for p, q in zip(a, b)]
+    # Up to float error, about 1e-9 m at tens of kilometers
+    np.testing.assert_allclose(hausdorff, expected_hausdorff, rtol=1e-12, atol=1e-9)
+    np.testing.assert_allclose(frechet, expected_frechet, rtol=1e-12, atol=1e-9)
+    assert hausdorff[0] == frechet[0] == 0
+    # The Fréchet distance bounds the Hausdorff distance
+    assert (frechet >= hausdorff - 1e-9).all()
+
+
+def test_distances_of_empty_trajectories_are_nan():
+    hausdorff, frechet = trajectoryDistances(
+        parseTrajectoryStrings(["-6.2 106.8", "", "-6.2 106.8,-6.3 106.9"]),
+        parseTrajectoryStrings(["-6.2 106.8", "-6.2 106.8", ""]),
+    )
+    assert hausdorff[0] == frechet[0] == 0
+    assert np.isnan(hausdorff[1:]).all() and np.isnan(frechet[1:]).all()
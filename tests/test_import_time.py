@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+
+from TrajPipeline.NewPipeline.installPackages import IMPORT_TIME_BUDGET
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULE = "TrajPipeline.NewPipeline.Pipeline"
+
+SCRIPT = f"""
+import json, sys, time
+sys.path.insert(0, {ROOT!r})
+import conftest
+start = time.perf_counter()
+import {MODULE}
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "heavy": sorted(name for name in ("numpy", "h3") if name in sys.modules),
+}}))
+"""
+
+
+def import_pipeline():
+    # A fresh interpreter, so modules imported by other tests don't count
+    output = subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_pipeline_import_skips_numpy_and_h3():
+    assert import_pipeline()["heavy"] == []
+
+
+def test_pipeline_import_time_budget():
+    # Best of a few runs, a cold disk cache only slows down the first one
+    seconds = min(import_pipeline()["seconds"] for _ in range(3))
+    assert seconds < IMPORT_TIME_BUDGET[MODULE]
@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from TrajPipeline.NewPipeline.modelPoolClass import ModelPool
+
+
+class Loader:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, model_path):
+        with self.lock:
+            self.calls.append(model_path)
+        time.sleep(self.delay)
+        if model_path.startswith("broken"):
+            raise OSError(f"no model in {model_path}")
+        return f"model of {model_path}"
+
+
+def pool(loader, **kwargs):
+    return ModelPool(loader=loader, size_fn=lambda path, model: 100, **kwargs)
+
+
+def test_least_recently_used_models_are_evicted():
+    models = pool(Loader(), max_models=2)
+    assert models.get("a") == "model of a"
+    models.get("b")
+    models.get("a")
+    models.get("c")
+    assert "a" in models and "c" in models and "b" not in models
+    assert models.metrics()["evictions"] == 1
+    # The memory budget evicts too
+    models = pool(Loader(), max_models=8, memory_budget_bytes=250)
+    for path in "abc":
+        models.get(path)
+    assert list(models.models) == ["b", "c"]
+
+
+def test_hits_and_misses_are_counted():
+    loader = Loader()
+    models = pool(loader)
+    for path in "aab":
+        models.get(path)
+    metrics = models.metrics()
+    assert (metrics["hits"], metrics["misses"], metrics["loads"]) == (1, 2, 2)
+    assert loader.calls == ["a", "b"]
+    with pytest.raises(ValueError):
+        models.get(None)
+
+
+def test_concurrent_misses_share_a_single_load():
+    loader = Loader(delay=0.1)
+    models = pool(loader)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(models.get("a")))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loader.calls == ["a"]
+    assert results == ["model of a"] * 5
+    assert models.metrics()["misses"] == 5
+
+
+def test_failed_loads_reach_every_waiter_and_are_retried():
+    loader = Loader(delay=0.1)
+    models = pool(loader)
+    errors = []
+
+    def get():
+        try:
+            models.get("broken")
+        except OSError as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=get) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3 and loader.calls == ["broken"]
+    with pytest.raises(OSError):
+        models.get("broken")
+    assert loader.calls == ["broken", "broken"]
+
+
+def test_a_model_invalidated_while_loading_is_not_kept():
+    loader = Loader(delay=0.2)
+    models = pool(loader)
+    thread = threading.Thread(target=models.get, args=("a",))
+    thread.start()
+    time.sleep(0.05)
+    models.invalidate("a")
+    thread.join()
+    assert "a" not in models
+    models.get("a")
+    assert loader.calls == ["a", "a"]
+
+
+def test_preload_hot_cells():
+    loader = Loader()
+    models = pool(loader, max_models=2)
+    for path in ["a", "b", "b", "c", "c", "c", "broken"]:
+        try:
+            models.get(path)
+        except OSError:
+            pass
+    models.models.clear()
+    loader.calls.clear()
+    assert models.hot_cells(2) == ["c", "b"]
+    assert models.preload_hot_cells() == 2
+    assert loader.calls == ["c", "b"]
+    # Preloading counts no requests, failing models are skipped
+    assert models.request_counts["c"] == 3
+    assert models.preload(["broken", "c"]) == 0
@@ -0,0 +1,106 @@
+import numpy as np
+
+from TrajPipeline.NewPipeline.noiseFilterClass import NoiseFilter
+from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
+from TrajPipeline.NewPipeline.utilFunctions import haversine_meters
+
+# Meters per degree of latitude
+METERS = 111194.9
+
+
+def line(meters, lat=-6.2, lon=106.8):
+    """Points north of (lat, lon) at the given distances in meters."""
+    return lat + np.asarray(meters, dtype=np.float64) / METERS, np.full(
+        len(meters), lon
+    )
+
+
+def speed_filter(**kwargs):
+    return NoiseFilter(stationary_radius=None, resample_meters=None, **kwargs)
+
+
+def test_teleport_spikes_are_dropped():
+    # 20 m/s with a 1 km jump out and back at the fifth point
+    meters = np.arange(10) * 20.0
+    meters[4] += 1000
+    lat, lon = line(meters)
+    keep, report = speed_filter(sample_interval=1).filter_arrays(lat, lon, [0, 10])
+    assert np.flatnonzero(~keep).tolist() == [4]
+    assert report["dropped_speed"] == 1
+    assert report["points_out"] == 9
+
+
+def test_endpoint_spikes_are_dropped():
+    meters = np.arange(10) * 20.0
+    meters[0] -= 1000
+    meters[-1] += 1000
+    lat, lon = line(meters)
+    timestamps = np.arange(10, dtype=np.float64)
+    keep, _ = speed_filter().filter_arrays(lat, lon, [0, 10], timestamps)
+    assert np.flatnonzero(~keep).tolist() == [0, 9]
+
+
+def test_the_speed_step_needs_a_time_base():
+    meters = np.arange(10) * 20.0
+    meters[4] += 1000
+    lat, lon = line(meters)
+    keep, report = speed_filter().filter_arrays(lat, lon, [0, 10])
+    assert keep.all()
+    assert report["dropped_speed"] == 0
+
+
+def test_stationary_points_collapse_into_the_first_one():
+    # Moving, then 20 points jittering within half a meter, then moving again
+    rng = np.random.default_rng(0)
+    meters = np.r_[np.arange(5) * 20.0, 100 + rng.uniform(0, 0.5, 20), 120, 140]
+    lat, lon = line(meters)
+    noise_filter = NoiseFilter(max_speed=None, resample_meters=None)
+    keep, report = noise_filter.filter_arrays(lat, lon, [0, len(lat)])
+    assert np.flatnonzero(keep).tolist() == [0, 1, 2, 3, 4, 5, 25, 26]
+    assert report["dropped_stationary"] == 19
+
+
+def test_resampling_spaces_the_kept_points():
+    lat, lon = line(np.arange(101, dtype=np.float64))
+    noise_filter = NoiseFilter(max_speed=None, stationary_radius=None)
+    keep, report = noise_filter.filter_arrays(lat, lon, [0, 101])
+    kept = np.flatnonzero(keep)
+    assert kept[0] == 0 and kept[-1] == 100
+    # Only the last point may be closer to the point kept before it
+    spacing = haversine_meters(
+        lat[kept[:-2]], lon[kept[:-2]], lat[kept[1:-1]], lon[kept[1:-1]]
+    )
+    assert (spacing >= 10 - 1e-6).all()
+    assert report["dropped_resampling"] == 101 - len(kept)
+    assert report["estimated_speedup"] == 101 / len(kept)
+
+
+def test_protected_points_are_never_dropped():
+    meters = np.r_[
+        np.arange(5) * 20.0, 1080, np.arange(6, 10) * 20.0, 180.2, 180.4, 200
+    ]
+    lat, lon = line(meters)
+    protected = np.zeros(len(lat), dtype=bool)
+    protected[[5, 10]] = True
+    noise_filter = NoiseFilter(sample_interval=1, resample_meters=None)
+    keep, report = noise_filter.filter_arrays(
+        lat, lon, [0, len(lat)], protected=protected
+    )
+    assert keep[[5, 10]].all()
+    assert np.flatnonzero(~keep).tolist() == [11]
+    unprotected, _ = noise_filter.filter_arrays(lat, lon, [0, len(lat)])
+    assert np.flatnonzero(~unprotected).tolist() == [5, 10, 11]
+
+
+def test_trajectories_are_filtered_separately():
+    # The second trajectory starts where the first one ends
+    first, _ = line(np.arange(5) * 20.0)
+    second, _ = line(80 + np.arange(5) * 0.5)
+    lat = np.r_[first, second]
+    lon = np.full(len(lat), 106.8)
+    batch = TrajectoryBatch(lat, lon, np.array([0, 5, 10]), ids=["a", "b"])
+    filtered, report = NoiseFilter(max_speed=None).filter_batch(batch)
+    assert filtered.offsets.tolist() == [0, 5, 7]
+    assert filtered.ids == ["a", "b"]
+    assert np.array_equal(filtered.lat, lat[[0, 1, 2, 3, 4, 5, 9]])
+    assert report["trajectories"] == 2
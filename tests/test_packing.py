@@ -0,0 +1,86 @@
+import os
+import stat
+
+from TrajPipeline.Pipeline.Detokenization.detokenization import BERTImputer
+from TrajPipeline.Pipeline.Tokenization.packing import (
+    BlockPacker,
+    bucketingReport,
+    lengthBatches,
+    packSequences,
+)
+from TrajPipeline.Pipeline.TrajectoryPipeline import TrajectoryPipeline
+
+
+def test_length_batches_group_similar_lengths():
+    lengths = [5, 1, 4, 1, 5, 2]
+    batches = lengthBatches(lengths, 2)
+    assert batches == [[1, 3], [5, 2], [0, 4]]
+    assert sorted(i for batch in batches for i in batch) == list(range(6))
+    assert lengthBatches([], 4) == []
+
+
+def test_bucketing_report_compares_padding_efficiency():
+    report = bucketingReport([1, 8, 1, 8], 2)
+    assert report["sequences"] == 4
+    assert report["batch_size"] == 2
+    assert report["padding_efficiency_arrival_order"] == 18 / 32
+    assert report["padding_efficiency_bucketed"] == 1.0
+
+
+def test_block_packer_fills_open_blocks_first_fit():
+    packer = BlockPacker(5, pad="<pad>", separator="|")
+    assert packer.add(["a", "b"]) == []
+    assert packer.add(["c", "d"]) == []
+    # Fits in the first open block and completes it
+    assert packer.add(["e"]) == [["a", "b", "|", "e", "|"]]
+    assert packer.flush() == [["c", "d", "|", "<pad>", "<pad>"]]
+
+
+def test_pack_sequences():
+    blocks, efficiency = packSequences(["a b", "c", "d e f"], 4)
+    assert blocks == [
+        ["d", "e", "f", "\n"],
+        ["a", "b", "\n", "<pad>"],
+        ["c", "\n", "<pad>", "<pad>"],
+    ]
+    assert efficiency == 9 / 12
+
+
+def test_block_packer_keeps_long_sequences_contiguous():
+    packer = BlockPacker(4, pad=0, separator=-1, open_blocks=2)
+    assert packer.add([1, 2]) == []
+    # 9 tokens with the separator: two full blocks and a padded remainder
+    completed = packer.add(list(range(10, 18)))
+    assert completed == [[10, 11, 12, 13], [14, 15, 16, 17], [-1, 0, 0, 0]]
+    # The short sequence packed before is still open, not mixed into the long one
+    assert packer.flush() == [[1, 2, -1, 0]]
+    assert packer.real_tokens == 12
+    assert packer.padding_tokens == 4
+    assert packer.efficiency() == 12 / 16
+
+
+def test_block_packer_closes_the_fullest_block_over_the_open_limit():
+    packer = BlockPacker(4, pad=0, open_blocks=1)
+    assert packer.add([1, 2, 3]) == []
+    assert packer.add([4, 5]) == [[1, 2, 3, 0]]
+    assert packer.flush() == [[4, 5, 0, 0]]
+
+
+def test_unmatched_model_outputs_fail_the_model_stage(tmp_path):
+    # A model script returning fewer lines than requests
+    transformers = tmp_path / "Transformers"
+    (transformers / "nanoGPT").mkdir(parents=True)
+    script = transformers / "generateTrajectoriesScript.sh"
+    script.write_text("#!/bin/sh\necho 'a b' > nanoGPT/simplifiedTrajectories.txt\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+
+    pipeline = TrajectoryPipeline(
+        run_dir=str(tmp_path / "run"), bert_imputer=BERTImputer()
+    )
+    pipeline.transformers_path = str(transformers)
+    pipeline.mode = "summarization_testing"
+    pipeline.use_result_cache = False
+    pipeline.tokenized_trajectories = ["a b c", "a"]
+    pipeline.runStage("model", pipeline.modelsRepository)
+    assert pipeline.failed_stage == "model"
+    assert not os.path.exists(pipeline.model_output_path)
@@ -0,0 +1,44 @@
+import numpy as np
+
+from TrajPipeline.Pipeline.Tokenization.parsing import parseTrajectoryStrings
+
+
+def test_parses_well_formed_points():
+    parsed = parseTrajectoryStrings(["1.5 2.5,3 4", "", "-5 6,"])
+    assert parsed.errors == []
+    assert parsed.offsets.tolist() == [0, 2, 2, 3]
+    assert parsed.tolist(0) == [(1.5, 2.5), (3.0, 4.0)]
+    assert parsed.tolist(2) == [(-5.0, 6.0)]
+
+
+def test_rejects_points_without_two_values_even_if_the_total_matches():
+    # Three values then one value add up to the expected four
+    parsed = parseTrajectoryStrings(["1 2 3,4"])
+    assert [(i, j) for i, j, _ in parsed.errors] == [(0, 0), (0, 1)]
+    assert len(parsed.lat) == 0
+    assert parsed.offsets.tolist() == [0, 0]
+
+
+def test_shifted_values_across_trajectories_are_reported():
+    parsed = parseTrajectoryStrings(["1 2 3", "4,5 6"])
+    assert [(i, j) for i, j, _ in parsed.errors] == [(0, 0), (1, 0)]
+    assert parsed.tolist(1) == [(5.0, 6.0)]
+
+
+def test_rejects_values_that_are_not_finite():
+    parsed = parseTrajectoryStrings(["nan 2,1 2", "1 inf,3 -inf", "5 6"])
+    assert [(i, j) for i, j, _ in parsed.errors] == [(0, 0), (1, 0), (1, 1)]
+    assert parsed.offsets.tolist() == [0, 1, 1, 2]
+    assert parsed.tolist(2) == [(5.0, 6.0)]
+
+
+def test_rejects_coordinates_out_of_range():
+    parsed = parseTrajectoryStrings(["91 0,45 181,-90 -180"])
+    assert [(i, j) for i, j, _ in parsed.errors] == [(0, 0), (0, 1)]
+    assert parsed.tolist(0) == [(-90.0, -180.0)]
+
+
+def test_out_of_range_points_are_kept_without_validation():
+    parsed = parseTrajectoryStrings(["91 0,45 181"], validate_range=False)
+    assert parsed.errors == []
+    np.testing.assert_array_equal(parsed.lat, [91.0, 45.0])
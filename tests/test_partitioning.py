@@ -0,0 +1,122 @@
+import json
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from TrajPipeline.NewPipeline.cacheClass import ResultCache
+from TrajPipeline.NewPipeline.partioningClass import PartitioningModule
+from TrajPipeline.NewPipeline.splitterClass import DatasetSplitter
+from TrajPipeline.NewPipeline.utilFunctions import load_metadata
+
+# Cells of height 2 span one degree, the thresholds are 2, 8 and 32 tokens
+CONFIG = {
+    "H": 2,
+    "L": 3,
+    "build_pyramid_from_scratch": False,
+    "projection": "extent",
+    "extent": {"min_lat": 0.0, "max_lat": 4.0, "min_lon": 0.0, "max_lon": 4.0},
+}
+
+
+@pytest.fixture
+def partitioning(tmp_path):
+    models_repo = tmp_path / "modelsRepo"
+    models_repo.mkdir()
+    (models_repo / "pyramidConfigs.json").write_text(json.dumps(CONFIG))
+
+    def make():
+        module = PartitioningModule(
+            str(models_repo), result_cache=ResultCache(str(tmp_path / "cache"))
+        )
+        module.tokens_threshold_per_cell = 2
+        return module
+
+    return make
+
+
+def write_dataset(directory, name, dataset):
+    # Same layout as the trajectory store, including the empty type_of_data
+    data_path = os.path.join(directory, f"{name}.pkl")
+    with open(data_path, "wb") as f:
+        pickle.dump(dataset, f)
+    metadata_path = os.path.join(directory, f"{name}_metadata.txt")
+    metadata = {
+        "total_number_of_trajectories": len(dataset),
+        "total_number_of_tokens": sum(len(trajectory) for trajectory in dataset),
+        "type_of_data": "",
+    }
+    with open(metadata_path, "w") as f:
+        for key, value in metadata.items():
+            f.write(f"{key}: {value}\n")
+    return data_path, metadata_path
+
+
+def test_metadata_with_empty_values_round_trips(tmp_path):
+    _, metadata_path = write_dataset(str(tmp_path), "dataset", [[(0.5, 0.5)]])
+    assert load_metadata(metadata_path) == {
+        "total_number_of_trajectories": "1",
+        "total_number_of_tokens": "1",
+        "type_of_data": "",
+    }
+
+
+def test_splitter_pushes_down_and_rolls_up_below_the_threshold(partitioning):
+    dataset = [
+        # Dense enough for the height 2 cell 0
+        [(0.2, 0.2), (0.3, 0.3), (0.4, 0.4)],
+        # Alone in its cells, too sparse for any of them
+        [(3.5, 3.5)],
+        # Crosses the borders of the height 2 cells of the height 1 cell 0
+        [
+            (0.5, 0.5),
+            (0.7, 0.7),
+            (0.9, 0.9),
+            (1.1, 1.1),
+            (1.3, 1.3),
+            (1.5, 1.5),
+            (1.7, 1.7),
+        ],
+        # Too sparse for the height 2 cell 4, rolls up to the height 1 cell 0
+        [(1.2, 0.2)],
+        [],
+    ]
+    assigned, unassigned = DatasetSplitter(partitioning()).split(dataset)
+    assert {key: value.tolist() for key, value in assigned.items()} == {
+        (2, 0): [0],
+        (1, 0): [2, 3],
+    }
+    assert unassigned.tolist() == [1, 4]
+
+
+def test_splitter_keeps_everything_in_the_enclosing_cell_when_it_is_sparse(
+    partitioning,
+):
+    assigned, unassigned = DatasetSplitter(partitioning()).split([[(0.2, 0.2)]])
+    assert assigned == {}
+    assert unassigned.tolist() == [0]
+
+
+def test_repeated_updates_of_a_cell(partitioning, tmp_path):
+    module = partitioning()
+    cell_path = os.path.join(module.model_repo_dir, "2_0")
+    dataset = [[(0.2, 0.2), (0.3, 0.3), (0.4, 0.4)]]
+    for version in (1, 2):
+        key = module.result_cache.make_key(cell_path, "summarization_testing", ["a"])
+        module.result_cache.put(key, f"output {version}\n", cell_path)
+        data_path, metadata_path = write_dataset(
+            str(tmp_path), f"dataset{version}", dataset
+        )
+        updated = module.update_repository(data_path, metadata_path, split=False)
+        assert updated == {(2, 0): 3}
+        cell = module.pyramid[2][0]
+        assert cell["model_version"] == version
+        assert cell["dataset_path"] == data_path
+        # The output of the previous model is gone
+        assert module.result_cache.get(key) is None
+
+    reloaded = partitioning().pyramid[2][0]
+    assert reloaded["model_version"] == 2
+    assert reloaded["occupied"]
+    assert np.isclose(reloaded["bounds"], (0.0, 1.0, 0.0, 1.0)).all()
@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from TrajPipeline.NewPipeline.pyramidStoreClass import PyramidStore
+
+
+def empty_pyramid():
+    return {
+        h: {i: {"occupied": False, "model_version": 0} for i in range(4**h)}
+        for h in range(2)
+    }
+
+
+def commit(store, h, index, **fields):
+    with store.transaction() as transaction:
+        transaction.update_cell(h, index, **fields)
+
+
+def test_commits_are_logged_and_replayed_over_the_snapshot(tmp_path):
+    store = PyramidStore(str(tmp_path))
+    store.reset(empty_pyramid())
+    with open(store.snapshot_path) as file:
+        snapshot = file.read()
+    commit(store, 1, 2, occupied=True, model_version=1)
+    commit(store, 1, 2, model_version=2)
+
+    with open(store.snapshot_path) as file:
+        assert file.read() == snapshot
+    with open(store.log_path) as file:
+        assert len(file.readlines()) == 2
+    pyramid = PyramidStore(str(tmp_path)).load()
+    assert pyramid[1][2] == {"occupied": True, "model_version": 2}
+    assert pyramid[1][3] == {"occupied": False, "model_version": 0}
+
+
+def test_refresh_catches_up_with_other_writers(tmp_path):
+    reader, writer = PyramidStore(str(tmp_path)), PyramidStore(str(tmp_path))
+    reader.reset(empty_pyramid())
+    writer.load()
+    commit(writer, 0, 0, occupied=True)
+    assert reader.refresh()[0][0]["occupied"]
+    writer.compact()
+    commit(writer, 1, 0, occupied=True)
+    pyramid = reader.refresh()
+    assert pyramid[0][0]["occupied"] and pyramid[1][0]["occupied"]
+
+
+def test_compaction_writes_a_snapshot_and_empties_the_log(tmp_path):
+    store = PyramidStore(str(tmp_path), compact_every=2)
+    store.reset(empty_pyramid())
+    commit(store, 1, 0, model_version=1)
+    assert store.logged_transactions == 1
+    commit(store, 1, 1, model_version=1)
+    assert store.logged_transactions == 0
+    with open(store.log_path) as file:
+        assert file.read() == ""
+    pyramid = PyramidStore(str(tmp_path)).load()
+    assert pyramid[1][0]["model_version"] == pyramid[1][1]["model_version"] == 1
+
+
+def test_recovery_from_a_torn_log_tail(tmp_path):
+    store = PyramidStore(str(tmp_path))
+    store.reset(empty_pyramid())
+    commit(store, 1, 0, model_version=1)
+    # A writer crashed in the middle of its commit
+    with open(store.log_path, "a") as file:
+        file.write('{"time": 0, "updates": [{"height": 1, "ind')
+
+    recovered = PyramidStore(str(tmp_path))
+    assert recovered.load()[1][0]["model_version"] == 1
+    commit(recovered, 1, 1, model_version=1)
+    pyramid = PyramidStore(str(tmp_path)).load()
+    assert pyramid[1][0]["model_version"] == pyramid[1][1]["model_version"] == 1
+    with open(store.log_path) as file:
+        assert len(file.readlines()) == 2
+
+
+def test_a_failed_transaction_is_dropped(tmp_path):
+    store = PyramidStore(str(tmp_path))
+    store.reset(empty_pyramid())
+    with pytest.raises(RuntimeError):
+        with store.transaction() as transaction:
+            transaction.update_cell(0, 0, occupied=True)
+            raise RuntimeError("training failed")
+    assert not store.pyramid[0][0]["occupied"]
+    assert not PyramidStore(str(tmp_path)).load()[0][0]["occupied"]
+
+
+def test_only_one_writer_builds_an_empty_store(tmp_path):
+    builds = []
+
+    def build():
+        builds.append(None)
+        # Leaves the other writer time to take the same decision
+        time.sleep(0.1)
+        return empty_pyramid()
+
+    def start():
+        store = PyramidStore(str(tmp_path))
+        store.load_or_build(build)
+        commit(store, 1, threading.get_ident() % 4, occupied=True)
+
+    threads = [threading.Thread(target=start) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(builds) == 1
+    with open(PyramidStore(str(tmp_path)).log_path) as file:
+        assert len(file.readlines()) == 2
@@ -0,0 +1,87 @@
+import json
+
+import numpy as np
+import pytest
+
+from TrajPipeline.NewPipeline.cacheClass import ResultCache
+from TrajPipeline.NewPipeline.modelPoolClass import ModelPool
+from TrajPipeline.NewPipeline.partioningClass import PartitioningModule
+from TrajPipeline.NewPipeline.routerClass import BatchRouter, trajectories_mbrs
+from TrajPipeline.NewPipeline.trajectoryBatchClass import TrajectoryBatch
+
+# Cells of height 2 span one degree
+CONFIG = {
+    "H": 2,
+    "extent": {"min_lat": 0.0, "max_lat": 4.0, "min_lon": 0.0, "max_lon": 4.0},
+}
+
+TRAJECTORIES = [
+    # Inside the occupied height 2 cell 0
+    [(0.2, 0.2), (0.5, 0.5)],
+    # The height 2 cell 15 has no model, its parent has one
+    [(3.5, 3.5), (3.6, 3.7)],
+    # Crosses the height 1 borders, only the root encloses it
+    [(1.5, 1.5), (2.5, 2.5)],
+    # Outside of the pyramid
+    [(10.0, 10.0)],
+    [],
+    [(0.3, 0.3)],
+]
+
+
+@pytest.fixture
+def partitioning(tmp_path):
+    (tmp_path / "pyramidConfigs.json").write_text(json.dumps(CONFIG))
+    module = PartitioningModule(
+        str(tmp_path),
+        model_pool=ModelPool(loader=lambda path: path, size_fn=lambda path, model: 1),
+        result_cache=ResultCache(str(tmp_path / "cache")),
+    )
+    with module.pyramid_store.transaction() as transaction:
+        for h, index in [(2, 0), (1, 3), (0, 0)]:
+            transaction.update_cell(h, index, occupied=True, model_path=f"m{h}{index}")
+    return module
+
+
+def test_trajectory_mbrs():
+    mbrs = trajectories_mbrs(TRAJECTORIES)
+    assert mbrs[1].tolist() == [3.5, 3.6, 3.5, 3.7]
+    assert np.isnan(mbrs[4]).all()
+    batch_mbrs = TrajectoryBatch.from_lists(TRAJECTORIES).mbrs()
+    assert np.array_equal(mbrs, batch_mbrs, equal_nan=True)
+
+
+def test_route_groups_trajectories_by_smallest_occupied_cell(partitioning):
+    groups = BatchRouter(partitioning).route(TRAJECTORIES)
+    assert groups == {(0, 0): [2], (1, 3): [1], (2, 0): [0, 5], None: [3, 4]}
+    assert BatchRouter(partitioning).route([]) == {}
+
+
+def test_refresh_picks_up_new_models(partitioning):
+    router = BatchRouter(partitioning)
+    with partitioning.pyramid_store.transaction() as transaction:
+        transaction.update_cell(2, 15, occupied=True, model_path="m215")
+    assert router.route([TRAJECTORIES[1]]) == {(1, 3): [0]}
+    router.refresh()
+    assert router.route([TRAJECTORIES[1]]) == {(2, 15): [0]}
+
+
+@pytest.mark.parametrize("as_batch", [False, True])
+def test_dispatch_runs_one_batch_per_cell(partitioning, as_batch):
+    calls = []
+
+    def run_batch(model, batch):
+        calls.append((model, len(batch)))
+        return [f"{model}:{i}" for i in range(len(batch))]
+
+    trajectories = [TRAJECTORIES[i] for i in (0, 1, 2, 5)]
+    if as_batch:
+        trajectories = TrajectoryBatch.from_lists(trajectories)
+    outputs = BatchRouter(partitioning).dispatch(trajectories, run_batch)
+    assert outputs == ["m20:0", "m13:0", "m00:0", "m20:1"]
+    assert sorted(calls) == [("m00", 1), ("m13", 1), ("m20", 2)]
+
+
+def test_dispatch_fails_for_trajectories_no_model_serves(partitioning):
+    with pytest.raises(ValueError):
+        BatchRouter(partitioning).dispatch(TRAJECTORIES, lambda model, batch: batch)
@@ -0,0 +1,181 @@
+import asyncio
+import time
+
+import h3
+import pytest
+
+from TrajPipeline.Pipeline.Detokenization.detokenization import BERTImputer
+from TrajPipeline.Pipeline.Serving.serving import (
+    MicroBatcher,
+    ScriptModel,
+    StubModel,
+    TrajectoryService,
+)
+
+TRAJECTORY = "-6.2 106.8,-6.201 106.801,-6.202 106.802,-6.203 106.803"
+VOCABULARY = [h3.geo_to_h3(-6.2 + i * 1e-3, 106.8, 10) for i in range(5)]
+
+
+def service(**kwargs):
+    return TrajectoryService(
+        StubModel(VOCABULARY),
+        BERTImputer(),
+        detokenization_tier="h3_centroid",
+        **kwargs,
+    )
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_summarize_and_generate_with_the_stub_model():
+    async def scenario():
+        async with service() as svc:
+            return await asyncio.gather(svc.summarize(TRAJECTORY), svc.generate(3))
+
+    summary, generated = run(scenario())
+    assert len(summary["trajectory"].split(",")) == 4
+    assert len(summary["summary"].split(",")) == 2
+    assert len(generated["trajectory"].split(",")) == 3
+
+
+def test_concurrent_requests_share_a_batch():
+    async def scenario():
+        async with service(max_batch_size=8, max_latency=0.05) as svc:
+            await asyncio.gather(*(svc.summarize(TRAJECTORY) for _ in range(8)))
+            return svc
+
+    svc = run(scenario())
+    assert svc.batchers["summarize"].batch_sizes == [8]
+
+
+def test_a_malformed_request_only_fails_its_own_caller():
+    async def scenario():
+        async with service(max_latency=0.05) as svc:
+            return await asyncio.gather(
+                svc.summarize(TRAJECTORY),
+                svc.summarize("-6.2 x"),
+                svc.summarize(42),
+                svc.generate(0),
+                svc.generate(2),
+                return_exceptions=True,
+            )
+
+    good, malformed, wrong_type, empty, generated = run(scenario())
+    assert "summary" in good
+    assert isinstance(malformed, ValueError)
+    assert isinstance(wrong_type, TypeError)
+    assert isinstance(empty, ValueError)
+    assert "trajectory" in generated
+
+
+def test_trajectories_no_router_cell_covers_fail_alone():
+    class Router:
+        def route(self, trajectories):
+            groups = {}
+            for i, trajectory in enumerate(trajectories):
+                key = "cell" if trajectory[0][0] < 0 else None
+                groups.setdefault(key, []).append(i)
+            return groups
+
+        def dispatch(self, trajectories, run_batch):
+            return run_batch(StubModel(step=1), trajectories)
+
+    async def scenario():
+        async with service(router=Router(), max_latency=0.05) as svc:
+            return await asyncio.gather(
+                svc.summarize(TRAJECTORY),
+                svc.summarize("40.7 -74.0,40.71 -74.01"),
+                return_exceptions=True,
+            )
+
+    routed, uncovered = run(scenario())
+    # The router's model keeps every token in the summary
+    assert len(routed["summary"].split(",")) == 4
+    assert isinstance(uncovered, ValueError)
+
+
+def test_micro_batcher_fails_the_batch_on_a_result_count_mismatch():
+    async def scenario():
+        batcher = MicroBatcher(lambda items: items[:1], max_latency=0.05)
+        await batcher.start()
+        try:
+            return await asyncio.gather(
+                batcher.submit(1), batcher.submit(2), return_exceptions=True
+            )
+        finally:
+            await batcher.stop()
+
+    results = run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_micro_batcher_stop_fails_pending_requests():
+    async def scenario():
+        batcher = MicroBatcher(lambda items: time.sleep(0.2) or items)
+        await batcher.start()
+        pending = [asyncio.ensure_future(batcher.submit(i)) for i in range(3)]
+        await asyncio.sleep(0.05)
+        await batcher.stop()
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        with pytest.raises(RuntimeError):
+            await batcher.submit(4)
+        return results
+
+    results = run(scenario())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_latency_report():
+    async def scenario():
+        async with service() as svc:
+            await asyncio.gather(*(svc.summarize(TRAJECTORY) for _ in range(10)))
+            return svc.latencyReport()
+
+    report = run(scenario())
+    assert report["summarize"]["requests"] == 10
+    assert 0 < report["summarize"]["p50_ms"] <= report["summarize"]["p99_ms"]
+    assert report["summarize"]["mean_batch_size"] >= 1
+    assert report["generate"] == {
+        "requests": 0,
+        "p50_ms": 0.0,
+        "p99_ms": 0.0,
+        "mean_batch_size": 0.0,
+    }
+
+
+class FakePipeline:
+    def __init__(self, tmp_path, outputs, succeeded=True):
+        self.model_output_path = str(tmp_path / "output.txt")
+        self.outputs, self.succeeded = outputs, succeeded
+        self.mode, self.tokenized_trajectories = None, []
+        self.trajectories_count, self.trajectories_length = 0, 0
+
+    def modelsRepository(self):
+        if not self.succeeded:
+            return False
+        with open(self.model_output_path, "w") as f:
+            f.write("".join(line + "\n" for line in self.outputs[: self.count()]))
+        return True
+
+    def count(self):
+        if self.mode == "summarization_testing":
+            return len(self.tokenized_trajectories)
+        return self.trajectories_count
+
+
+def test_script_model_raises_when_the_script_fails(tmp_path):
+    pipeline = FakePipeline(tmp_path, ["stale output"], succeeded=True)
+    model = ScriptModel(pipeline)
+    assert model.summarize(["a"]) == ["stale output"]
+    pipeline.succeeded = False
+    with pytest.raises(RuntimeError):
+        model.summarize(["b"])
+
+
+def test_script_model_checks_the_output_count(tmp_path):
+    model = ScriptModel(FakePipeline(tmp_path, ["x", "y"]))
+    assert model.generate([2, 3, 2]) == ["x", "x", "y"]
+    with pytest.raises(RuntimeError):
+        model.generate([2, 2, 2])
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from TrajPipeline.Pipeline.Tokenization.runLength import (
+    RunLengthReport,
+    collapseTokens,
+    expandRuns,
+)
+from TrajPipeline.Pipeline.Tokenization.summaryAlignment import (
+    SummaryAlignedDataset,
+    alignSummary,
+    readSummaryAlignedDataset,
+    summaryPoints,
+)
+
+TOKENS = ["8a1", "8a1", "8a1", "8a2", "8a3", "8a3", "8a1", "8a4", "8a4"]
+
+
+def test_expand_runs_inverts_collapsing():
+    report = RunLengthReport()
+    collapsed = collapseTokens(TOKENS, report=report)
+    assert collapsed == ["8a1", "<r3>", "8a2", "8a3", "<r2>", "8a1", "8a4", "<r2>"]
+    assert expandRuns(collapsed) == TOKENS
+    assert report.stats()["longest_run"] == 3
+    assert report.stats()["tokens_after"] == 8
+    for tokens in ([], ["8a1"], ["8a1"] * 12):
+        assert expandRuns(collapseTokens(tokens)) == tokens
+
+
+def test_collapsing_without_dwell_tokens_is_lossy():
+    collapsed = collapseTokens(TOKENS, dwell_tokens=False)
+    assert collapsed == ["8a1", "8a2", "8a3", "8a1", "8a4"]
+    assert expandRuns(collapsed) == collapsed
+
+
+def test_align_summary_references_the_first_identical_point():
+    lats = [1.0, 2.0, 3.0, 2.0, 4.0]
+    lons = [5.0, 6.0, 7.0, 6.0, 8.0]
+    indices = alignSummary(lats, lons, [1.0, 2.0, 9.0, 4.0], [5.0, 6.0, 9.0, 8.0])
+    assert indices.dtype == np.int32
+    assert indices.tolist() == [0, 1, -1, 4]
+    assert summaryPoints(lats, lons, indices, [(9.0, 9.0)]) == [
+        (1.0, 5.0),
+        (2.0, 6.0),
+        (9.0, 9.0),
+        (4.0, 8.0),
+    ]
+    assert alignSummary(lats, lons, [], []).tolist() == []
+
+
+def test_aligned_datasets_round_trip(tmp_path):
+    dataset = SummaryAlignedDataset()
+    dataset.add(["8a1", "8a2", "8a3"], np.array([0, -1, 2]), ["8b1"])
+    dataset.add(["8a4"], np.array([0]), [])
+    dataset.add(["8a5", "8a6"], np.array([1]), [])
+    dataset.keep([True, False, True])
+    path = tmp_path / "summaries.npz"
+    dataset.save(str(path))
+    assert list(readSummaryAlignedDataset(str(path))) == [
+        (["8a1", "8a2", "8a3"], ["8a1", "8b1", "8a3"]),
+        (["8a5", "8a6"], ["8a6"]),
+    ]
+    stats = dataset.stats()
+    assert stats["summaries"] == 2
+    assert stats["summary_points"] == 4
+    assert stats["matched_ratio"] == pytest.approx(0.75)
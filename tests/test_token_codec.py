@@ -0,0 +1,110 @@
+import h3
+import numpy as np
+import pytest
+
+from TrajPipeline.NewPipeline.tokenCodecClass import (
+    TokenStreamCodec,
+    TokenStreamReader,
+    decode_varints,
+    delta_decode,
+    delta_encode,
+    encode_varints,
+    read_token_file,
+)
+from TrajPipeline.NewPipeline.trajectoryBatchClass import tokens_to_ints
+
+
+def trajectories(count=60, seed=0):
+    # Random walks of resolution 10 cells, with empty trajectories in between
+    rng = np.random.default_rng(seed)
+    result = []
+    for i in range(count):
+        if i % 7 == 3:
+            result.append([])
+            continue
+        lat, lon = -6.2 + rng.uniform(-0.3, 0.3), 106.8 + rng.uniform(-0.3, 0.3)
+        steps = rng.normal(0, 2e-4, size=(int(rng.integers(1, 80)), 2)).cumsum(axis=0)
+        result.append([h3.geo_to_h3(lat + a, lon + b, 10) for a, b in steps])
+    return result
+
+
+def test_varints_round_trip_at_every_byte_length():
+    values = np.array(
+        [0, 1, 127, 128, 255, 16383, 16384, 2**32, 2**56 - 1, 2**63, 2**64 - 1],
+        dtype=np.uint64,
+    )
+    encoded = encode_varints(values)
+    assert encoded.dtype == np.uint8
+    assert len(encode_varints(np.array([127], dtype=np.uint64))) == 1
+    assert len(encode_varints(np.array([128], dtype=np.uint64))) == 2
+    assert len(encode_varints(np.array([2**64 - 1], dtype=np.uint64))) == 10
+    assert np.array_equal(decode_varints(encoded), values)
+    assert len(encode_varints(np.array([], dtype=np.uint64))) == 0
+    assert len(decode_varints(np.array([], dtype=np.uint8))) == 0
+
+
+def test_xor_delta_restarts_at_trajectory_boundaries():
+    tokens = np.array([5, 7, 7, 9, 4, 4], dtype=np.uint64)
+    # The second trajectory is empty
+    offsets = np.array([0, 3, 3, 6], dtype=np.int64)
+    deltas = delta_encode(tokens, offsets)
+    assert deltas.tolist() == [5, 2, 0, 9, 13, 0]
+    assert np.array_equal(delta_decode(deltas, offsets), tokens)
+    empty = np.array([], dtype=np.uint64)
+    assert (
+        len(delta_decode(delta_encode(empty, np.array([0, 0])), np.array([0, 0]))) == 0
+    )
+
+
+@pytest.mark.parametrize("compression", ["none", "zlib", "lzma"])
+def test_random_access_round_trips(tmp_path, compression):
+    dataset = trajectories()
+    # Small blocks so the dataset spans many of them
+    codec = TokenStreamCodec(compression, block_size=64)
+    path = tmp_path / "dataset.h3z"
+    codec.write(str(path), dataset)
+    reader = TokenStreamReader(str(path))
+    assert reader.compression == compression
+    assert len(reader) == len(dataset)
+    assert len(reader.block_starts) - 1 > 10
+    assert reader.num_tokens == sum(len(t) for t in dataset)
+    for i in np.random.default_rng(1).permutation(len(dataset)).tolist():
+        assert reader[i] == dataset[i]
+    expected = tokens_to_ints(token for tokens in dataset for token in tokens)
+    assert np.array_equal(reader.tokens(), expected)
+    with pytest.raises(IndexError):
+        reader.token_values(len(dataset))
+
+
+def test_block_splitting_never_splits_a_trajectory():
+    dataset = trajectories()
+    data = TokenStreamCodec("none", block_size=32).encode(dataset)
+    reader = TokenStreamReader(data)
+    # A block starts at a trajectory and holds whole trajectories only
+    for block in range(len(reader.block_starts) - 1):
+        first, end = reader.block_starts[block], reader.block_starts[block + 1]
+        size = reader.byte_offsets[end] - reader.byte_offsets[first]
+        assert size == reader.block_bytes[block + 1] - reader.block_bytes[block]
+    assert reader.block_starts[0] == 0 and reader.block_starts[-1] == len(dataset)
+
+
+def test_empty_datasets_and_trajectories():
+    for dataset in ([], [[], []]):
+        reader = TokenStreamReader(TokenStreamCodec().encode(dataset))
+        assert len(reader) == len(dataset)
+        assert len(reader.tokens()) == 0
+        assert [reader[i] for i in range(len(reader))] == dataset
+
+
+def test_token_files_load_as_batches(tmp_path):
+    dataset = trajectories(10)
+    path = tmp_path / "dataset.h3z"
+    TokenStreamCodec("lzma").write(str(path), dataset)
+    batch = read_token_file(str(path))
+    assert batch.to_token_lists() == dataset
+    assert np.allclose(batch.points(1)[0], [h3.h3_to_geo(t)[0] for t in dataset[1]])
+
+
+def test_files_of_another_format_are_rejected():
+    with pytest.raises(ValueError):
+        TokenStreamReader(b"NOPE" + bytes(64))
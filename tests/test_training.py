@@ -0,0 +1,89 @@
+import os
+import textwrap
+
+from TrajPipeline.NewPipeline.cacheClass import ResultCache
+from TrajPipeline.Pipeline.Detokenization.detokenization import BERTImputer
+from TrajPipeline.Pipeline.TrajectoryPipeline import (
+    TrajectoryPipeline,
+    moveInto,
+    readTrainingConfig,
+)
+
+# Appends a line to the checkpoint it resumes from, and writes a log subdirectory
+TRAIN_SCRIPT = """
+import os, sys
+args = dict(arg[2:].split("=", 1) for arg in sys.argv[2:])
+os.makedirs(os.path.join(args["out_dir"], "logs"), exist_ok=True)
+path = os.path.join(args["out_dir"], "ckpt.pt")
+previous = open(path).read() if os.path.exists(path) else ""
+with open(path, "w") as f:
+    f.write(previous + "trained on " + os.path.basename(args["dataset"]) + "\\n")
+with open(os.path.join(args["out_dir"], "logs", "run.txt"), "w") as f:
+    f.write("done")
+"""
+
+
+def test_training_configs_are_read_without_running_them(tmp_path):
+    config_path = tmp_path / "config.py"
+    config_path.write_text(textwrap.dedent("""
+            import sys
+            out_dir = 'out-summary'
+            init_from = "resume"
+            max_iters = 5000
+            eval_interval, log = 250, True
+            device = sys.platform
+            raise SystemExit("executed")
+            """))
+    assert readTrainingConfig(str(config_path)) == {
+        "out_dir": "out-summary",
+        "init_from": "resume",
+        "max_iters": 5000,
+    }
+    assert readTrainingConfig(str(tmp_path / "missing.py")) == {}
+
+
+def test_move_into_merges_subdirectories(tmp_path):
+    source, target = tmp_path / "source", tmp_path / "target"
+    (source / "logs").mkdir(parents=True)
+    (target / "logs").mkdir(parents=True)
+    (source / "ckpt.pt").write_text("new")
+    (source / "logs" / "b.txt").write_text("new")
+    (target / "ckpt.pt").write_text("old")
+    (target / "logs" / "a.txt").write_text("old")
+    (target / "logs" / "b.txt").write_text("old")
+    moveInto(str(source), str(target))
+    assert os.listdir(source) == []
+    assert (target / "ckpt.pt").read_text() == "new"
+    assert (target / "logs" / "a.txt").read_text() == "old"
+    assert (target / "logs" / "b.txt").read_text() == "new"
+    assert sorted(os.listdir(target)) == ["ckpt.pt", "logs"]
+
+
+def test_training_resumes_from_and_hands_off_to_the_shared_out_dir(tmp_path):
+    nanogpt = tmp_path / "Transformers" / "nanoGPT"
+    (nanogpt / "config").mkdir(parents=True)
+    (nanogpt / "train.py").write_text(TRAIN_SCRIPT)
+    (nanogpt / "config" / "train_trajectory.py").write_text(
+        "out_dir = 'out-trajectory'\ninit_from = 'resume'\n"
+    )
+    (nanogpt / "out-trajectory" / "logs").mkdir(parents=True)
+    (nanogpt / "out-trajectory" / "ckpt.pt").write_text("base\n")
+    (nanogpt / "out-trajectory" / "logs" / "old.txt").write_text("old")
+
+    pipeline = TrajectoryPipeline(
+        run_dir=str(tmp_path / "run"), bert_imputer=BERTImputer()
+    )
+    pipeline.transformers_path = str(nanogpt.parent)
+    pipeline.result_cache = ResultCache(str(tmp_path / "cache"))
+    key = pipeline.result_cache.make_key(str(nanogpt), "generation_testing", [])
+    pipeline.result_cache.put(key, "stale\n", str(nanogpt))
+    pipeline.mode = "generation_training"
+    assert pipeline.modelsRepository() is True
+
+    shared = nanogpt / "out-trajectory"
+    assert (
+        shared / "ckpt.pt"
+    ).read_text() == "base\ntrained on newTrajectoryGeneration\n"
+    assert (shared / "logs" / "old.txt").read_text() == "old"
+    assert (shared / "logs" / "run.txt").read_text() == "done"
+    assert pipeline.result_cache.get(key) is None